@@ -11,23 +11,39 @@
 
 from __future__ import division
 
+import chaostest
 import getopt
 import logistic
 import matplotlib.pyplot
 import numpy
 import sys
 
-from utils import split_dict, fp_equal
+from constants import EPSILON
+from utils import split_dict
 
-def bifurcate(r_start, r_end, r_delta, steps, cutoff):
+MAX_PERIOD = 32
+REFINE_TOL = 1e-10
+REFINE_MAX_GAP = 32
+CYCLE_NEWTON_STEPS = 8
+ADAPTIVE_WIDTH = 1200
+ADAPTIVE_HEIGHT = 800
+ADAPTIVE_COARSE = 64
+ADAPTIVE_BINS = 32
+ADAPTIVE_DIST_TOL = 0.1
+ADAPTIVE_FANOUT = 2
+DENSITY_HEIGHT = 800
+
+def bifurcate(r_start, r_end, r_delta, steps, cutoff, **kwargs):
     '''
     Generates R vs. X data for plotting bifuration diagrams.
 
+    Every R value is iterated at once by logistic.lmap_sweep, and keyword
+    arguments (chunk_size, dtype, lyapunov) are passed on to it. A lyapunov
+    vector (len(rs)) gets the exponent of every R value from the same pass,
+    which tells chaotic columns from long periodic windows.
     '''
     rs = numpy.arange(r_start, r_end, r_delta, dtype=numpy.float64)
-    xs = numpy.array([
-                    logistic.lmap(0.5, r, steps, cutoff=cutoff) for r in rs
-                ], dtype=numpy.float64)
+    xs = logistic.lmap_sweep(0.5, rs, steps, cutoff=cutoff, **kwargs)
     return rs, xs
 
 def plot_bifdiag(rs, xs, **kwargs):
@@ -51,56 +67,611 @@ def plot_bifdiag(rs, xs, **kwargs):
     else:
         figure.show()
 
-def _get_period(xs):
-    for p_test in xrange(1, 33):
-        for p_i in xrange(1, p_test+1):
-            x_slice = xs[-p_i:-p_i-(p_test+1):-p_test]
-            if not fp_equal(x_slice[0], x_slice[1]):
-                break
-        else:
-            return p_test
-    return None
+class Density(object):
+    '''
+    A bifurcation diagram as a fixed-size 2-D histogram, which samples are
+    added to as they are generated, so that its memory doesn't depend on the
+    number of iterations.
+
+    Attributes:
+        counts  Number of samples in every cell (width x height), by
+                parameter column and then x row.
+        p_range The (low, high) parameter range the columns cover.
+        x_range The (low, high) range of x the rows cover. Samples outside
+                it, and NaN samples, aren't counted.
+    '''
+    def __init__(self, p_range, x_range, width, height=DENSITY_HEIGHT):
+        self.counts = numpy.zeros((width, height), dtype=numpy.int64)
+        self.p_range = p_range
+        self.x_range = x_range
+
+    def add(self, ps, xs):
+        '''
+        Counts a block of samples (len(ps) x n), one row per parameter value.
+
+        '''
+        width, height = self.counts.shape
+        p_lo, p_hi = self.p_range
+        x_lo, x_hi = self.x_range
+        cols = numpy.floor((numpy.asarray(ps, dtype=numpy.float64) - p_lo) *
+                           (width/(p_hi - p_lo))).astype(numpy.int64)
+        with numpy.errstate(invalid='ignore'):
+            rows = numpy.floor((xs - x_lo)*(height/(x_hi - x_lo)))
+            inside = (rows >= 0) & (rows < height)
+            inside &= ((cols >= 0) & (cols < width))[:,numpy.newaxis]
+        cells = cols[:,numpy.newaxis]*height + rows.astype(numpy.int64)
+        self.counts += numpy.bincount(cells[inside],
+                                      minlength=width*height).reshape(
+                                                            (width, height))
+
+    def image(self, log=False):
+        '''
+        The fraction of every column's samples in each cell, transposed so
+        that x runs up the rows, with log=True as log10 of it. Empty cells
+        are NaN, so they show as background.
+
+        '''
+        totals = self.counts.sum(axis=1)[:,numpy.newaxis]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            values = self.counts / totals
+            if log:
+                values = numpy.log10(values)
+        values[self.counts == 0] = numpy.nan
+        return values.T
+
+def bifurcate_density(r_start, r_end, r_delta, steps, cutoff, **kwargs):
+    '''
+    Generates a bifurcation diagram of the Logistic map as a Density, adding
+    each chunk from logistic.lmap_chunks as it comes.
+
+    Keyword arguments:
+        width       Number of parameter columns. Defaults to one per R
+                    value.
+        height      Number of x rows (default 800).
+        chunk_size, lyapunov
+                    As for logistic.lmap_chunks.
+
+    Returns: a Density over x in [0, 1].
+    '''
+    rs = numpy.arange(r_start, r_end, r_delta, dtype=numpy.float64)
+    # Every R value sits in the middle of its column, clear of rounding.
+    density = Density((r_start - r_delta/2, r_start + (len(rs) - 0.5)*r_delta),
+                      (0.0, 1.0),
+                      kwargs.get('width', len(rs)),
+                      kwargs.get('height', DENSITY_HEIGHT))
+    for chunk in logistic.lmap_chunks(0.5, rs, steps, cutoff=cutoff,
+                                      **split_dict(('chunk_size', 'lyapunov'),
+                                                  kwargs)[0]):
+        density.add(rs, chunk)
+    return density
+
+def plot_density(density, **kwargs):
+    '''
+    Plots a bifurcation diagram from a Density, as a single image.
+
+    Keyword arguments:
+        log         Shade by the logarithm of the density, which brings out
+                    the structure of chaotic bands (default False).
+        xlabel      Label of the parameter axis (default 'R').
+        exponents   A pair (ps, lambdas) of Lyapunov exponents to plot in a
+                    panel below the diagram, on the same parameter axis.
+        title, filename
+                    As for plot_bifdiag.
+    '''
+    figure = matplotlib.pyplot.figure()
+    exponents = kwargs.get('exponents')
+    if exponents is None:
+        axes = figure.gca()
+    else:
+        axes = figure.add_subplot(2, 1, 1)
+    axes.imshow(density.image(log=kwargs.get('log', False)), origin='lower',
+                extent=density.p_range + density.x_range, aspect='auto',
+                cmap='gray_r', interpolation='nearest')
+    axes.set_ylabel('$x_n$')
+    axes.set_title(kwargs.get('title',
+                              'Bifurcation Diagram for the Logistic Map'))
+    if exponents is None:
+        axes.set_xlabel(kwargs.get('xlabel', 'R'))
+    else:
+        lower = figure.add_subplot(2, 1, 2, sharex=axes)
+        ps, lambdas = exponents
+        # Superstable points are -inf, and would only squash the panel.
+        lower.plot(ps, numpy.maximum(lambdas, -2.0), 'k-', linewidth=0.5)
+        lower.axhline(0.0, color='r', linewidth=0.5)
+        lower.set_xlabel(kwargs.get('xlabel', 'R'))
+        lower.set_ylabel('$\\lambda$')
+
+    if kwargs.get('filename') is not None:
+        figure.savefig(kwargs['filename'], dpi=220)
+    else:
+        figure.show()
+
+def periods(xs, max_period=MAX_PERIOD, tol=EPSILON):
+    '''
+    Detects the period of every row of a block of samples at once.
+
+    Params:
+        xs          Samples (n x m), such as those from bifurcate, one row
+                    per parameter value.
+        max_period  The longest period looked for, as an integer.
+        tol         Distance within which samples count as repeating.
+
+    Returns: a vector of the smallest period of each row, or 0 where there
+             is none up to max_period. A period p is judged on the last
+             max_period samples against the ones p before them, so with
+             2*max_period samples or more every period gets the same scrutiny.
+    '''
+    result = numpy.zeros(xs.shape[0], dtype=numpy.int32)
+    width = min(max_period, xs.shape[1] - max_period)
+    if width < 1:
+        return result
+    with numpy.errstate(invalid='ignore'):
+        for p in xrange(1, max_period+1):
+            # Only the rows whose last sample repeats are worth comparing in
+            # full.
+            rows = numpy.flatnonzero((result == 0) &
+                        (numpy.abs(xs[:,-1] - xs[:,-1-p]) < tol))
+            if len(rows) == 0:
+                continue
+            tail = xs[rows,-width:]
+            lagged = xs[rows,-width-p:xs.shape[1]-p]
+            close = (numpy.abs(tail - lagged) < tol).all(axis=1)
+            result[rows[close]] = p
+    return result
 
 def find_period_doubling(rs, xs):
     '''
     Detects period doubling behavior.
 
+    Returns: a tuple of the R values after which the period doubles, or
+             after which a period appears out of chaos.
+    '''
+    ps = periods(xs)
+    p1, p2 = ps[:-1], ps[1:]
+    doubled = ((p1 == 0) & (p2 != 0)) | ((p1 != 0) & (p2 == 2*p1))
+    return tuple(rs[:-1][doubled])
+
+def _cycle(rs, xs, period):
+    '''
+    Newton's method for a point of a cycle of the Logistic map, for every R
+    value at once.
+
+    Params:
+        rs      A vector of R values.
+        xs      Starting points, near the cycle for the matching R values.
+        period  The period of the cycle, as an integer.
+
+    Returns: a tuple (xs, multipliers) of the points on the cycles, and the
+             derivatives of the period-th iterate of the map there.
+    '''
+    def _iterate(xs):
+        ys = xs.copy()
+        ds = numpy.ones_like(xs)
+        for _ in xrange(period):
+            ds *= rs*(1 - 2*ys)
+            ys = rs*ys*(1 - ys)
+        return ys, ds
+
+    # Newton's method stays well conditioned through a doubling, where the
+    # multiplier is -1, even though the orbit itself converges ever slower.
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for _ in xrange(CYCLE_NEWTON_STEPS):
+            ys, ds = _iterate(xs)
+            xs = xs - (ys - xs)/(ds - 1)
+    return xs, _iterate(xs)[1]
+
+def refine_doublings(rs, xs, tol=REFINE_TOL):
+    '''
+    Locates the period doublings of the Logistic map seen in a sweep.
+
+    Every place where the detected period goes from p to 2p, possibly across
+    R values where the orbit had not settled, is bisected until the doubling
+    is known to within tol. The side of the midpoint is told by the
+    multiplier of the p-cycle, which passes through -1 at the doubling, so
+    the bisection doesn't need the ever longer transients near it. Every
+    bracket is bisected at once.
+
+    Params:
+        rs      R values of the sweep, increasing.
+        xs      Samples from the sweep, as from bifurcate.
+
+    Keyword arguments:
+        tol     Width of the final brackets. Defaults to 1e-10.
+
+    Returns: a tuple (points, periods) of the R values of the doublings,
+             increasing, and the period before each.
+    '''
+    ps = periods(xs)
+    found = numpy.flatnonzero(ps > 0)
+    # The columns on either side of every gap of unsettled columns.
+    before, after = found[:-1], found[1:]
+    doubled = ((ps[after] == 2*ps[before]) &
+               (after - before <= REFINE_MAX_GAP))
+    rs = numpy.asarray(rs, dtype=numpy.float64)
+    starts = xs[:,-1].astype(numpy.float64)
+
+    lo, hi, x_lo, period = [], [], [], []
+    for p in numpy.unique(ps[before[doubled]]):
+        b, x, h = _bracket(rs, starts, before[doubled & (ps[before] == p)], p)
+        lo.append(b)
+        hi.append(h)
+        x_lo.append(x)
+        period.append(numpy.repeat(p, len(b)))
+    if not lo:
+        return numpy.empty(0), numpy.empty(0, dtype=numpy.int32)
+    lo, hi, x_lo, period = [numpy.concatenate(v) for v in (lo, hi, x_lo,
+                                                           period)]
+
+    while (hi - lo).max() > tol:
+        mid = (lo + hi)/2
+        for p in numpy.unique(period):
+            group = numpy.flatnonzero(period == p)
+            x_mid, m_mid = _cycle(mid[group], x_lo[group], p)
+            past = m_mid < -1
+            hi[group[past]] = mid[group[past]]
+            lo[group[~past]] = mid[group[~past]]
+            x_lo[group[~past]] = x_mid[~past]
+
+    # Neighbouring gaps can lead to the same doubling.
+    points = (lo + hi)/2
+    order = numpy.lexsort((points, period))
+    points, period = points[order], period[order]
+    fresh = numpy.ones(len(points), dtype=bool)
+    fresh[1:] = (period[1:] != period[:-1]) | (numpy.diff(points) > 2*tol)
+    order = numpy.argsort(points[fresh])
+    return points[fresh][order], period[fresh][order]
+
+def _bracket(rs, starts, columns, period):
+    '''
+    Brackets the doublings of the period-cycles near the given columns of a
+    sweep, by following each cycle along the sweep from its column, in the
+    direction of the doubling, until its multiplier passes -1.
+
+    Params:
+        rs      R values of the sweep.
+        starts  The last sample of every column of the sweep.
+        columns Columns to start from, whose orbits had the given period.
+        period  The period, as an integer.
+
+    Returns: a tuple (lo, x_lo, hi) of the R values below and above each
+             doubling that was found, and points on the cycles at lo.
+    '''
+    x, m = _cycle(rs[columns], starts[columns], period)
+    # Just past the doubling the 2p-cycle splits by less than the tolerance
+    # and passes for a p-cycle, so some columns are already past it.
+    past = m < -1
+    direction = numpy.where(past, -1, 1)
+    cols = columns.copy()
+    lo = numpy.empty(len(cols))
+    hi = numpy.empty(len(cols))
+    x_lo = numpy.empty(len(cols))
+    found = numpy.zeros(len(cols), dtype=bool)
+    pending = numpy.abs(m) <= 1
+    pending |= past
+    for _ in xrange(REFINE_MAX_GAP):
+        k = numpy.flatnonzero(pending)
+        if len(k) == 0:
+            break
+        nxt = numpy.clip(cols[k] + direction[k], 0, len(rs) - 1)
+        x_nxt, m_nxt = _cycle(rs[nxt], x[k], period)
+        crossed = (m_nxt < -1) != past[k]
+        # The bottom of the bracket is whichever side has the stable cycle.
+        c, up = k[crossed], direction[k[crossed]] > 0
+        lo[c] = numpy.where(up, rs[cols[c]], rs[nxt[crossed]])
+        hi[c] = numpy.where(up, rs[nxt[crossed]], rs[cols[c]])
+        x_lo[c] = numpy.where(up, x[c], x_nxt[crossed])
+        found[c] = True
+        pending[c] = False
+        stuck = nxt == cols[k]
+        pending[k[stuck]] = False
+        cols[k], x[k] = nxt, x_nxt
+    return lo[found], x_lo[found], hi[found]
+
+def feigenbaum_ratios(points):
+    '''
+    Successive estimates of the Feigenbaum constant from the R values of a
+    cascade of period doublings, (r[n] - r[n-1]) / (r[n+1] - r[n]).
+
+    '''
+    gaps = numpy.diff(numpy.asarray(points, dtype=numpy.float64))
+    return gaps[:-1]/gaps[1:]
+
+def _features(xs, y_lo, y_hi, bins, max_period, tol):
+    '''
+    What adaptive compares between neighbouring columns: their periods,
+    their cycles sorted (NaN-padded to max_period), their extents, and
+    histograms of their samples over (y_lo, y_hi), normalized.
+
+    '''
+    count = xs.shape[0]
+    period = periods(xs, max_period, tol)
+    cycle = numpy.empty((count, max_period), dtype=numpy.float64)
+    cycle.fill(numpy.nan)
+    for p in numpy.unique(period[period > 0]):
+        rows = numpy.flatnonzero(period == p)
+        cycle[rows,:p] = numpy.sort(xs[rows,-p:], axis=1)
+
+    finite = numpy.isfinite(xs)
+    with numpy.errstate(invalid='ignore'):
+        extent = numpy.vstack((numpy.where(finite, xs, numpy.inf).min(axis=1),
+                               numpy.where(finite, xs, -numpy.inf).max(axis=1)))
+        cells = numpy.clip(((xs - y_lo)/(y_hi - y_lo)*bins).astype(numpy.int64),
+                           0, bins-1)
+    rows = numpy.repeat(numpy.arange(count), xs.shape[1]).reshape(xs.shape)
+    hist = numpy.bincount((rows*bins + cells)[finite],
+                          minlength=count*bins).reshape((count, bins))
+    hist = hist / numpy.maximum(finite.sum(axis=1), 1)[:,numpy.newaxis]
+    return period, cycle, extent.T, hist
+
+def _differ(left, right, y_tol, dist_tol):
+    '''
+    Whether each pair of neighbouring columns, as indices into the features
+    from _features, differ by enough to show on the diagram.
+
+    '''
+    period, cycle, extent, hist = left
+    period2, cycle2, extent2, hist2 = right
+    bounded = numpy.isfinite(extent[:,1])
+    bounded2 = numpy.isfinite(extent2[:,1])
+    differ = (period != period2) | (bounded != bounded2)
+
+    moved = numpy.abs(cycle - cycle2)
+    moved[numpy.isnan(moved)] = 0.0
+    differ |= (period > 0) & (moved.max(axis=1) > y_tol)
+
+    both = bounded & bounded2 & (period == 0) & (period2 == 0)
+    with numpy.errstate(invalid='ignore'):
+        differ |= both & (numpy.abs(extent - extent2).max(axis=1) > y_tol)
+    differ |= both & (numpy.abs(hist - hist2).sum(axis=1) > dist_tol)
+    return differ
+
+def adaptive(sweep, p_start, p_end, **kwargs):
+    '''
+    Generates bifurcation diagram data at a resolution that adapts to the
+    dynamics.
+
+    The parameter range is divided into width pixel columns, of which only
+    a coarse subset is computed at first. Between every two neighbouring
+    columns that differ in period, in the positions of their cycle, in
+    attractor extent or in the distribution of their samples, by enough to
+    show at the given resolution, the middle column is computed too, until
+    no neighbours more than a pixel apart differ. Long periodic stretches end
+    up computed coarsely, and chaotic bands and windows at full resolution.
+
+    Params:
+        sweep   A callable sweep(ps) returning the samples (len(ps) x m) for
+                a vector of parameter values, such as
+                lambda rs: logistic.lmap_sweep(0.5, rs, steps, cutoff=cutoff).
+        p_start The first parameter value.
+        p_end   The end of the parameter range, which isn't included.
+
+    Keyword arguments:
+        width       Number of pixel columns (default 1200).
+        height      Number of pixel rows (default 800). Differences of less
+                    than a pixel row, over the range of all the samples,
+                    don't count.
+        coarse      Number of columns to start with (default 64).
+        bins        Number of histogram bins for comparing the sample
+                    distributions of chaotic columns (default 32).
+        dist_tol    L1 distance between normalized histograms above which
+                    they differ (default 0.1).
+        fanout      Number of pieces every gap between differing columns is
+                    cut into at a time (default 2). Each round of cuts is
+                    one call to sweep, so a larger fanout takes fewer calls
+                    for more columns.
+        max_period, tol
+                    As for periods.
+
+    Returns: a tuple (ps, xs) of the parameter values that were computed, in
+             increasing order, and their samples. See resample to turn them
+             into the full set of pixel columns.
+    '''
+    width = kwargs.get('width', ADAPTIVE_WIDTH)
+    height = kwargs.get('height', ADAPTIVE_HEIGHT)
+    coarse = kwargs.get('coarse', ADAPTIVE_COARSE)
+    bins = kwargs.get('bins', ADAPTIVE_BINS)
+    dist_tol = kwargs.get('dist_tol', ADAPTIVE_DIST_TOL)
+    fanout = kwargs.get('fanout', ADAPTIVE_FANOUT)
+    max_period = kwargs.get('max_period', MAX_PERIOD)
+    tol = kwargs.get('tol', EPSILON)
+
+    delta = (p_end - p_start)/width
+    stride = max(width//coarse, 1)
+    cols = numpy.union1d(numpy.arange(0, width, stride), [width-1])
+    xs = numpy.asarray(sweep(p_start + delta*cols))
+    finite = xs[numpy.isfinite(xs)]
+    y_lo, y_hi = (finite.min(), finite.max()) if len(finite) else (0.0, 1.0)
+    if y_hi <= y_lo:
+        y_hi = y_lo + 1.0
+    y_tol = (y_hi - y_lo)/height
+    features = _features(xs, y_lo, y_hi, bins, max_period, tol)
+    # The samples of every round are only put in order at the end, and rows
+    # says where every column's are among them.
+    blocks = [xs]
+    rows = numpy.arange(len(cols))
+
+    while True:
+        gaps = numpy.flatnonzero(numpy.diff(cols) > 1)
+        split = gaps[_differ([f[gaps] for f in features],
+                             [f[gaps+1] for f in features], y_tol, dist_tol)]
+        if len(split) == 0:
+            break
+        new_cols = numpy.unique(numpy.concatenate([
+                        cols[split] + (cols[split+1] - cols[split])*k//fanout
+                        for k in xrange(1, fanout)]))
+        new_cols = numpy.setdiff1d(new_cols, cols)
+        new_xs = numpy.asarray(sweep(p_start + delta*new_cols))
+        new_features = _features(new_xs, y_lo, y_hi, bins, max_period, tol)
+        order = numpy.argsort(numpy.concatenate((cols, new_cols)),
+                              kind='mergesort')
+        cols = numpy.concatenate((cols, new_cols))[order]
+        rows = numpy.concatenate((rows, sum(len(b) for b in blocks) +
+                                        numpy.arange(len(new_cols))))[order]
+        blocks.append(new_xs)
+        features = [numpy.concatenate((f, g))[order]
+                    for (f, g) in zip(features, new_features)]
+    return p_start + delta*cols, numpy.concatenate(blocks)[rows]
+
+def resample(ps, xs, grid):
     '''
-    results = ()
-    for (i, r) in enumerate(rs[:-1]):
-        p1 = _get_period(xs[i,:])
-        p2 = _get_period(xs[i+1,:])
-        if p1 is None and p2 is not None:
-            results = results + (r,)
-        if p1 is not None and p2 is not None and p2 == (2*p1):
-            results = results + (r,)
-    return results
+    Fills in the columns of an adaptive diagram that weren't computed.
+
+    Params:
+        ps      Parameter values of the computed columns, increasing.
+        xs      Their samples.
+        grid    The parameter values to resample at.
+
+    Returns: the samples (len(grid) x m) of the nearest computed column to
+             every grid value. Where adaptive left columns out, their
+             neighbours agree to within a pixel.
+    '''
+    grid = numpy.asarray(grid, dtype=numpy.float64)
+    right = numpy.clip(numpy.searchsorted(ps, grid), 1, len(ps)-1)
+    nearest = numpy.where(grid - ps[right-1] <= ps[right] - grid,
+                          right-1, right)
+    return xs[nearest]
+
+def bifurcate_adaptive(r_start, r_end, steps, cutoff, **kwargs):
+    '''
+    Generates R vs. X data for the Logistic map at an adaptive resolution.
+
+    Params: as for bifurcate, but without r_delta.
+
+    Keyword arguments: as for adaptive, plus dtype for logistic.lmap_sweep.
+
+    Returns: a tuple (rs, xs) as for adaptive.
+    '''
+    dtype = kwargs.pop('dtype', numpy.float64)
+    return adaptive(lambda rs: logistic.lmap_sweep(0.5, rs, steps,
+                                                   cutoff=cutoff, dtype=dtype),
+                    r_start, r_end, **kwargs)
+
+class TestBifurcation(chaostest.TestCase):
+    '''
+    Unit tests for bifurcation analysis.
+
+    Running this module starts its main program, so run these with
+    python -m unittest bifurcation.
+    '''
+    def test_periods(self):
+        rs = numpy.array([2.9, 3.2, 3.5, 3.55, 3.83, 3.9])
+        _, xs = bifurcate(2.9, 3.95, 0.01, 2000, 1800)
+        ps = periods(xs)
+        picked = ps[numpy.searchsorted(numpy.arange(2.9, 3.95, 0.01),
+                                       rs - 0.001)]
+        self.assertEqual(picked.tolist(), [1, 2, 4, 8, 3, 0])
+        self.assertEqual(find_period_doubling(rs, numpy.vstack(
+                [logistic.lmap(0.5, r, 2000, cutoff=1800) for r in rs])),
+                (2.9, 3.2, 3.5))
+
+    def test_refine(self):
+        '''
+        Tests the refined doublings against the known start of the cascade.
+
+        '''
+        rs, xs = bifurcate(2.9, 3.57, 0.0005, 3000, 2000)
+        points, period = refine_doublings(rs, xs)
+        self.assertEqual(period.tolist(), [1, 2, 4, 8, 16])
+        self.assertArrayEqual(points[:3], [3.0, 1 + numpy.sqrt(6),
+                                           3.5440903595519],
+                              places=10)
+        self.assertAlmostEqual(points[3], 3.5644072661, places=9)
+        ratios = feigenbaum_ratios(points)
+        self.assertAlmostEqual(ratios[0], 4.7514, delta=1e-4)
+        self.assertAlmostEqual(ratios[1], 4.6562, delta=1e-4)
+
+    def test_adaptive(self):
+        '''
+        Tests an adaptive diagram against a uniform one.
+
+        '''
+        ps, ys = bifurcate_adaptive(2.8, 3.4, 2000, 1000, width=600,
+                                    height=400)
+        rs, xs = bifurcate(2.8, 3.4, 0.001, 2000, 1000)
+        rs, xs = rs[:600], xs[:600]
+        self.assertTrue(len(ps) < 400)
+        self.assertArrayEqual(ps, rs[numpy.searchsorted(rs, ps - 1e-9)])
+        zs = resample(ps, ys, rs)
+        self.assertTrue(numpy.array_equal(periods(zs), periods(xs)))
+        # Within a pixel row everywhere.
+        self.assertTrue(numpy.abs(numpy.sort(zs[:,-2:]) -
+                                  numpy.sort(xs[:,-2:])).max() < 0.6/400)
+
+    def test_density(self):
+        '''
+        Tests the streamed density against a histogram of the whole sweep.
+
+        '''
+        rs, xs = bifurcate(2.8, 4.0, 0.01, 1000, 400)
+        lambdas = numpy.empty_like(rs)
+        density = bifurcate_density(2.8, 4.0, 0.01, 1000, 400, height=50,
+                                    chunk_size=32, lyapunov=lambdas)
+        self.assertEqual(density.counts.shape, (len(rs), 50))
+        # Negative in the periodic columns, the period-3 window included,
+        # and positive in the chaotic ones.
+        period = periods(xs)
+        self.assertTrue((lambdas[period > 0] < 0).all())
+        self.assertTrue(lambdas[numpy.searchsorted(rs, 3.83)] < 0)
+        self.assertTrue(lambdas[numpy.searchsorted(rs, 3.9)] > 0)
+        for (row, counts) in zip(xs, density.counts):
+            self.assertTrue(numpy.array_equal(
+                    numpy.histogram(row, bins=50, range=(0.0, 1.0))[0], counts))
+
+        image = density.image(log=True)
+        self.assertEqual(image.shape, (50, len(rs)))
+        # R = 3.2 has period 2, so its 601 samples split 301 to 300.
+        column = image[:,40]
+        self.assertEqual(numpy.isfinite(column).sum(), 2)
+        self.assertEqual(sorted(column[numpy.isfinite(column)]),
+                         sorted(numpy.log10([301/601, 300/601])))
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
 
     file_prefix = None
+    doublings = False
+    log = False
+    exponents = False
 
     try:
-        options, args = getopt.getopt(argv[1:], 'f:')
+        options, args = getopt.getopt(argv[1:], 'f:dly')
         for opt, arg in options:
             if opt == '-f':
                 file_prefix = arg
+            elif opt == '-d':
+                doublings = True
+            elif opt == '-l':
+                log = True
+            elif opt == '-y':
+                exponents = True
     except getopt.GetoptError as err:
         print str(err)
         return 2
 
-    rs, xs = bifurcate(2.8, 4.0, 0.001, 1200, 800)
+    if doublings:
+        rs, xs = bifurcate(2.8, 3.57, 0.0001, 4000, 3000)
+        points, period = refine_doublings(rs, xs)
+        for (r, p) in zip(points, period):
+            print 'period {0:3d} -> {1:3d} at R = {2:.10f}'.format(p, 2*p, r)
+        cascade = points[period == 2**numpy.arange(len(period))]
+        for (n, delta) in enumerate(feigenbaum_ratios(cascade)):
+            print 'delta_{0} = {1:.6f}'.format(n+1, delta)
+        return 0
+
+    rs = numpy.arange(2.8, 4.0, 0.001, dtype=numpy.float64)
+    lambdas = numpy.empty_like(rs)
+    density = bifurcate_density(2.8, 4.0, 0.001, 1200, 800, lyapunov=lambdas)
+    plot_args = dict(log=log)
+    if exponents:
+        plot_args['exponents'] = (rs, lambdas)
 
     if file_prefix is not None:
-        plot_bifdiag(rs, xs, filename='{0}.png'.format(file_prefix))
+        plot_density(density, filename='{0}.png'.format(file_prefix),
+                     **plot_args)
     else:
-        plot_bifdiag(rs, xs)
+        plot_density(density, **plot_args)
 
-#    rs, xs = bifurcate(2.8, 4.0, 0.001, 3000, 2600)
-#    print find_period_doubling(rs, xs)
-#
     return 0
 
 if __name__ == "__main__":
@@ -14,17 +14,54 @@ from __future__ import division
 import multiprocessing
 import numpy
 
+MEMMAP_BLOCK_ROWS = 1 << 18
+
+def _cells(xs, x0, eps):
+    '''
+    Indices of the grid boxes of size eps occupied by the points xs (n x dim).
+
+    Box indices truncate toward zero, like int(), and come back as a
+    (k x dim) array with one row per distinct box.
+    '''
+    keys = numpy.trunc((numpy.asarray(xs) - x0) / eps).astype(numpy.int64)
+    return numpy.unique(keys, axis=0)
+
 def _capacity_n(xs, x0, eps):
-    grid = set([tuple([int((xi-x0[i]) / eps) for (i, xi) in enumerate(xv)])
-                for xv in xs])
-    return len(grid)
+    return len(_cells(xs, x0, eps))
 
 def _capacity_for_tuple(arg):
     return _capacity_n(arg[0], arg[1], arg[2])
 
 def capacity(xs, x0, epss):
+    if isinstance(xs, numpy.memmap):
+        # Don't pickle a memmapped trajectory out to the workers; read it a
+        # block at a time instead.
+        blocks = ((None, xs[i:i+MEMMAP_BLOCK_ROWS].T)
+                    for i in xrange(0, len(xs), MEMMAP_BLOCK_ROWS))
+        return capacity_stream(blocks, x0, epss)
     pool = multiprocessing.Pool()
     pargs = [(xs, x0, eps) for eps in epss]
     n_epss = pool.map(_capacity_for_tuple, pargs)
     pool.close()
     return numpy.array(zip([1.0 / eps for eps in epss], n_epss), dtype=numpy.float64)
+
+def capacity_stream(chunks, x0, epss):
+    '''
+    Computes the same table as capacity from a streamed trajectory.
+
+    Params:
+        chunks  (ts, xs) chunks as produced by rungekutta.rk4_chunks, where xs
+                is (dim x n).
+        x0      The grid origin.
+        epss    The box sizes to count with.
+
+    Returns: an array of (1/eps, N(eps)) rows, as capacity does. Only the set
+             of occupied boxes is kept between chunks, never the points.
+    '''
+    grids = [set() for _ in epss]
+    for (_, xs) in chunks:
+        points = xs.T
+        for (grid, eps) in zip(grids, epss):
+            grid.update(map(tuple, _cells(points, x0, eps)))
+    return numpy.array(zip([1.0 / eps for eps in epss], [len(g) for g in grids]),
+                        dtype=numpy.float64)
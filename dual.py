@@ -0,0 +1,421 @@
+###############################################################################
+#
+# CSCI 4446 - Chaotic Dynamics
+#
+# File: dual.py
+# Author: Ken Sheedlo
+#
+# Forward-mode automatic differentiation with dual number arrays.
+#
+###############################################################################
+
+'''
+Forward-mode automatic differentiation.
+
+A Dual holds an array of values and, for each of k tangent directions, an array
+of derivatives shaped like it. Arithmetic, indexing, slice assignment, sum and
+the common NumPy ufuncs carry the derivatives along by the chain rule, so a
+derivative function written like lorenz.lorenz or mechanics.threebody can be
+called on a Dual as it is. One such call gives the Jacobian applied to all k
+directions at once.
+
+The derivative function has to either support the out= protocol (the system
+factories all do), or build its result from arithmetic on x. A function that
+converts values to float, e.g. with numpy.array([...], dtype=numpy.float64),
+loses the derivatives and raises TypeError.
+'''
+
+from __future__ import division
+
+import chaostest
+import numpy
+import unittest
+
+def _index(idx):
+    return (slice(None),) + (idx if isinstance(idx, tuple) else (idx,))
+
+class Dual(object):
+    '''
+    An array of values with derivatives in k directions.
+
+    Attributes:
+        val     The values, of any shape S.
+        eps     The derivatives, shaped (k,) + S.
+    '''
+    # Make ndarray defer to Dual in mixed arithmetic.
+    __array_priority__ = 1000
+
+    def __init__(self, val, eps):
+        self.val = numpy.asarray(val, dtype=numpy.float64)
+        self.eps = numpy.asarray(eps, dtype=numpy.float64)
+
+    @classmethod
+    def empty(cls, shape, k):
+        return cls(numpy.empty(shape), numpy.empty((k,) + tuple(shape)))
+
+    @property
+    def shape(self):
+        return self.val.shape
+
+    @property
+    def ndim(self):
+        return self.val.ndim
+
+    @property
+    def k(self):
+        return self.eps.shape[0]
+
+    def __len__(self):
+        return len(self.val)
+
+    def __float__(self):
+        raise TypeError('a Dual was converted to float, losing its derivatives')
+
+    def __repr__(self):
+        return 'Dual({0!r}, {1!r})'.format(self.val, self.eps)
+
+    def __getitem__(self, idx):
+        return _make(self.val[idx], self.eps[_index(idx)])
+
+    def __setitem__(self, idx, value):
+        if isinstance(value, Dual):
+            self.val[idx] = value.val
+            self.eps[_index(idx)] = _lift(value, self.val[idx].ndim)
+        else:
+            self.val[idx] = value
+            self.eps[_index(idx)] = 0.0
+
+    def sum(self, axis=None):
+        if axis is None:
+            return Dual(self.val.sum(), self.eps.reshape((self.k, -1)).sum(axis=1))
+        axis = axis % self.ndim
+        return Dual(self.val.sum(axis=axis), self.eps.sum(axis=axis+1))
+
+    def reshape(self, shape):
+        shape = tuple(shape) if isinstance(shape, (tuple, list)) else (shape,)
+        return Dual(self.val.reshape(shape), self.eps.reshape((self.k,) + shape))
+
+    @property
+    def T(self):
+        axes = (0,) + tuple(range(self.ndim, 0, -1))
+        return Dual(self.val.T, self.eps.transpose(axes))
+
+    def __neg__(self):
+        return _make(-self.val, -self.eps)
+
+    def __pos__(self):
+        return self
+
+    def __add__(self, other):
+        return _add(self, other)
+
+    def __radd__(self, other):
+        return _add(other, self)
+
+    def __sub__(self, other):
+        return _add(self, -other)
+
+    def __rsub__(self, other):
+        return _add(other, -self)
+
+    def __mul__(self, other):
+        return _mul(self, other)
+
+    def __rmul__(self, other):
+        return _mul(other, self)
+
+    def __truediv__(self, other):
+        return _div(self, other)
+
+    def __rtruediv__(self, other):
+        return _div(other, self)
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __pow__(self, other):
+        return _pow(self, other)
+
+    def __rpow__(self, other):
+        return _pow(other, self)
+
+    def __abs__(self):
+        return _chain(self, numpy.abs(self.val), numpy.sign(self.val))
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs or ufunc not in _UFUNCS:
+            return NotImplemented
+        return _UFUNCS[ufunc](*inputs)
+
+def _lift(x, ndim):
+    '''
+    The derivatives of x, with axes inserted after the first so that they
+    broadcast against values with ndim dimensions.
+
+    '''
+    pad = ndim - x.val.ndim
+    if pad <= 0:
+        return x.eps
+    return x.eps.reshape((x.eps.shape[0],) + (1,)*pad + x.val.shape)
+
+def _val(x):
+    return x.val if isinstance(x, Dual) else x
+
+def _make(val, eps):
+    '''
+    Builds a Dual from float64 arrays or NumPy scalars, without the checks of
+    Dual.__init__. This is the hot path of every operation.
+
+    '''
+    d = object.__new__(Dual)
+    d.val = val
+    if eps.ndim != val.ndim + 1:
+        k = eps.shape[0] if eps.ndim else 1
+        eps = numpy.broadcast_to(eps, (k,) + val.shape).copy()
+    d.eps = eps
+    return d
+
+def _chain(x, val, deriv):
+    '''
+    Dual result of f(x), given val = f(x.val) and deriv = f'(x.val).
+
+    '''
+    return _make(val, x.eps*deriv)
+
+def _add(a, b):
+    if isinstance(a, Dual):
+        if isinstance(b, Dual):
+            val = a.val + b.val
+            ndim = val.ndim
+            return _make(val, _lift(a, ndim) + _lift(b, ndim))
+        val = a.val + b
+        return _make(val, _lift(a, val.ndim))
+    val = a + b.val
+    return _make(val, _lift(b, val.ndim))
+
+def _mul(a, b):
+    if isinstance(a, Dual):
+        if isinstance(b, Dual):
+            val = a.val * b.val
+            ndim = val.ndim
+            return _make(val, _lift(a, ndim)*b.val + a.val*_lift(b, ndim))
+        val = a.val * b
+        return _make(val, _lift(a, val.ndim)*b)
+    val = a * b.val
+    return _make(val, a*_lift(b, val.ndim))
+
+def _div(a, b):
+    if isinstance(b, Dual):
+        val = _val(a) / b.val
+        eps = -val*_lift(b, val.ndim)
+        if isinstance(a, Dual):
+            eps += _lift(a, val.ndim)
+        return _make(val, eps/b.val)
+    val = a.val / b
+    return _make(val, _lift(a, val.ndim)/b)
+
+def _pow(a, b):
+    aval, bval = _val(a), _val(b)
+    val = numpy.asarray(aval ** bval)
+    ndim = val.ndim
+    eps = 0.0
+    if isinstance(a, Dual):
+        eps = eps + bval*(aval ** (bval - 1))*_lift(a, ndim)
+    if isinstance(b, Dual):
+        eps = eps + val*numpy.log(aval)*_lift(b, ndim)
+    return _make(val, numpy.asarray(eps))
+
+def _unary(f, df):
+    def _apply(x):
+        return _chain(x, f(x.val), df(x.val))
+    return _apply
+
+_UFUNCS = {
+    numpy.add: _add,
+    numpy.subtract: lambda a, b: _add(a, -b),
+    numpy.multiply: _mul,
+    numpy.true_divide: _div,
+    numpy.divide: _div,
+    numpy.power: _pow,
+    numpy.negative: lambda x: -x,
+    numpy.absolute: lambda x: abs(x),
+    numpy.square: lambda x: _mul(x, x),
+    numpy.sqrt: _unary(numpy.sqrt, lambda v: 0.5/numpy.sqrt(v)),
+    numpy.exp: _unary(numpy.exp, numpy.exp),
+    numpy.log: _unary(numpy.log, lambda v: 1/v),
+    numpy.sin: _unary(numpy.sin, numpy.cos),
+    numpy.cos: _unary(numpy.cos, lambda v: -numpy.sin(v)),
+    numpy.tan: _unary(numpy.tan, lambda v: 1/numpy.cos(v)**2),
+    numpy.arctan: _unary(numpy.arctan, lambda v: 1/(1 + v*v)),
+    numpy.sinh: _unary(numpy.sinh, numpy.cosh),
+    numpy.cosh: _unary(numpy.cosh, numpy.sinh),
+    numpy.tanh: _unary(numpy.tanh, lambda v: 1/numpy.cosh(v)**2),
+}
+
+def _evaluate(dfunc, t, x, kwargs):
+    '''
+    Calls dfunc on the Dual x and returns its result as a Dual.
+
+    '''
+    f_args = kwargs.get('f_args', tuple())
+    if kwargs.get('inplace', getattr(dfunc, 'inplace', False)):
+        out = Dual.empty(x.shape, x.k)
+        dfunc(t, x, *f_args, out=out)
+        return out
+    result = dfunc(t, x, *f_args)
+    if isinstance(result, Dual):
+        return result
+    # A list or object array of Duals, one per component.
+    parts = [p if isinstance(p, Dual) else Dual(p, numpy.zeros((x.k,) + numpy.shape(p)))
+                for p in result]
+    return Dual(numpy.array([p.val for p in parts]),
+                numpy.stack([p.eps for p in parts], axis=1))
+
+def jvp(dfunc, t, x, vs, **kwargs):
+    '''
+    Jacobian-vector products of a derivative function.
+
+    Params:
+        dfunc   A derivative function dfunc(t, x), as for rungekutta.rk4.
+        t       Time to evaluate at.
+        x       The state, or a (dim x n) block of states if dfunc accepts
+                them.
+        vs      Tangent vectors: an array shaped like x for one direction (per
+                column of a block), or (k,) + x.shape for k directions.
+
+    Keyword arguments:
+        f_args  Extra positional arguments for dfunc.
+        inplace Whether dfunc supports the out= protocol, as for rk4.
+
+    Returns: a tuple (f, jv) where f is dfunc(t, x) and jv holds the Jacobian
+             of dfunc at x times each tangent vector, shaped like vs.
+    '''
+    x = numpy.asarray(x, dtype=numpy.float64)
+    vs = numpy.asarray(vs, dtype=numpy.float64)
+    single = vs.shape == x.shape
+    result = _evaluate(dfunc, t, Dual(x, vs[numpy.newaxis] if single else vs),
+                       kwargs)
+    return result.val, (result.eps[0] if single else result.eps)
+
+def jacobian(dfunc, t, x, **kwargs):
+    '''
+    Full Jacobian of a derivative function, from one evaluation on duals.
+
+    Params and keyword arguments are those of jvp. For a single state the
+    result is (dim x dim); for a (dim x n) block of states it is
+    (dim x dim x n), one Jacobian per column.
+    '''
+    x = numpy.asarray(x, dtype=numpy.float64)
+    dim = x.shape[0]
+    seeds = numpy.eye(dim).reshape((dim, dim) + (1,)*(x.ndim-1))
+    seeds = numpy.broadcast_to(seeds, (dim,) + x.shape)
+    _, jv = jvp(dfunc, t, x, seeds, **kwargs)
+    # jv[j] is the derivative along x_j, i.e. column j of the Jacobian.
+    return numpy.swapaxes(jv, 0, 1)
+
+def variational(dfunc, n, **kwargs):
+    '''
+    Builds the variational system of any derivative function.
+
+    The result has the state layout of ps7.variational, the n-vector x and
+    then the rows of the (n x n) matrix of variations, and can be used with
+    lyapunov.spectrum. Each call costs one evaluation of dfunc on duals with n
+    directions. Keyword arguments are passed on to jvp.
+
+    Returns: a callable vfunc(t, xs, out=None).
+    '''
+    def _vfunc(t, xs, out=None):
+        if out is None:
+            out = numpy.empty(n + n*n, dtype=numpy.float64)
+        phi = xs[n:].reshape((n, n))
+        f, jv = jvp(dfunc, t, xs[:n], phi.T, **kwargs)
+        out[:n] = f
+        out[n:] = jv.T.ravel()
+        return out
+    _vfunc.inplace = True
+    return _vfunc
+
+class TestDual(chaostest.TestCase):
+    '''
+    Unit tests for dual number differentiation.
+
+    '''
+    def test_arithmetic(self):
+        '''
+        Tests derivatives of elementary expressions against the exact ones.
+
+        '''
+        xs = numpy.array([0.3, 1.7, 2.5])
+        d = Dual(xs, numpy.ones((1, 3)))
+        exprs = (
+            (lambda x: 3*x*x - 1/x + 2, lambda x: 6*x + 1/x**2),
+            (lambda x: numpy.sin(x)*numpy.exp(-x),
+             lambda x: (numpy.cos(x) - numpy.sin(x))*numpy.exp(-x)),
+            (lambda x: x ** 1.5 / (1 + numpy.cos(x)),
+             lambda x: 1.5*x**0.5/(1 + numpy.cos(x)) +
+                        x**1.5*numpy.sin(x)/(1 + numpy.cos(x))**2),
+            (lambda x: numpy.array([2.0, 1.0, 0.5]) - numpy.sqrt(x),
+             lambda x: -0.5/numpy.sqrt(x)),
+        )
+        for (f, df) in exprs:
+            result = f(d)
+            self.assertArrayEqual(result.val, f(xs), places=12)
+            self.assertArrayEqual(result.eps[0], df(xs), places=10)
+
+    def test_systems(self):
+        '''
+        Tests Jacobians of the built-in systems against finite differences.
+
+        '''
+        import lorenz
+        import mechanics
+        import pendulum
+        import ps7
+        systems = (
+            (lorenz.lorenz(16.0, 45.0, 4.0), numpy.array([1.0, -2.0, 30.0])),
+            (pendulum.pendulum(0.1, 0.1, 0.25, ampl=1.0, freq=7.4),
+             numpy.array([3.0, 0.1])),
+            (mechanics.threebody(1.0, 0.5, 0.5, 0.5),
+             numpy.array([0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 20, 0, 0,
+                          -0.15, 0], dtype=numpy.float64)),
+            (lambda t, x: numpy.array([x[1], -numpy.sin(x[0]) + t]),
+             numpy.array([0.4, 0.2])),
+        )
+        for (dfunc, x) in systems:
+            jac = jacobian(dfunc, 0.3, x)
+            h = 1e-6
+            for j in xrange(len(x)):
+                e = numpy.zeros(len(x))
+                e[j] = h
+                fd = (numpy.asarray(dfunc(0.3, x + e)) -
+                      numpy.asarray(dfunc(0.3, x - e))) / (2*h)
+                self.assertArrayEqual(jac[:,j], fd, delta=1e-6)
+
+        # The generated variational system matches the hand-written one.
+        vfunc = variational(lorenz.lorenz(16.0, 45.0, 4.0), 3)
+        xs = ps7.ic(1.0, -2.0, 30.0)
+        xs[3:] = numpy.arange(9.0)
+        self.assertArrayEqual(vfunc(0.0, xs), ps7.variational(16.0, 45.0, 4.0)(0.0, xs),
+                              places=12)
+
+    def test_batched(self):
+        '''
+        Tests Jacobians and JVPs over a block of states.
+
+        '''
+        import lorenz
+        lfunc = lorenz.lorenz(16.0, 45.0, 4.0)
+        block = numpy.array([[1.0, -3.0], [-2.0, 0.5], [30.0, 12.0]])
+        jacs = jacobian(lfunc, 0.0, block)
+        self.assertEqual(jacs.shape, (3, 3, 2))
+        for m in xrange(2):
+            self.assertArrayEqual(jacs[:,:,m].ravel(),
+                                  jacobian(lfunc, 0.0, block[:,m]).ravel())
+        vs = numpy.array([[1.0, 0.0], [0.0, 1.0], [2.0, -1.0]])
+        f, jv = jvp(lfunc, 0.0, block, vs)
+        self.assertArrayEqual(f.ravel(), lfunc(0.0, block).ravel())
+        for m in xrange(2):
+            self.assertArrayEqual(jv[:,m], jacs[:,:,m].dot(vs[:,m]), places=12)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,11 +11,14 @@
 
 from __future__ import division
 
+import bifurcation
+import chaostest
 import getopt
 import matplotlib.pyplot
 import numpy
 import sys
 
+from constants import EPSILON
 from mpl_toolkits.mplot3d import Axes3D
 from utils import split_dict
 
@@ -40,17 +43,478 @@ def hmap(x_start, y_start, a_ratio, b_ratio, steps, cutoff=0):
         result[i+1,:] = (y_i + 1 - a_ratio*(x_i ** 2)), (b_ratio*x_i)
     return result[cutoff:,:]
 
-def bifurcate(a_start, a_end, a_delta, steps, cutoff):
+HENON_CHUNK_SIZE = 64
+HENON_ESCAPE = 1e4
+HENON_CHECK_EVERY = 8
+HENON_MAX_PERIOD = 32
+
+class _Ensemble(object):
+    '''
+    Orbits of the Henon map for flattened arrays of parameters, advanced
+    together. Orbits that escape are dropped, so they stop costing work.
+
+    With tangents, every orbit also carries a pair of tangent vectors through
+    the Jacobian [[-2ax, 1], [b, 0]], which orthonormalize reorthonormalizes
+    as in lyapunov.spectrum.
+
+    Attributes:
+        xs, ys  The current state of the orbits still being iterated.
+        live    Their indices into the parameters, or None while all of them
+                are being iterated.
+        logs    Sums of log|diag R| from orthonormalize (2 x len(xs)), or
+                None without tangents.
+    '''
+    def __init__(self, x_start, y_start, a_ratios, b_ratios, escape,
+                 tangents=False):
+        self.xs = numpy.empty(len(a_ratios), dtype=numpy.float64)
+        self.xs.fill(x_start)
+        self.ys = numpy.empty_like(self.xs)
+        self.ys.fill(y_start)
+        self.live = None
+        self.logs = None
+        self._a_ratios = a_ratios
+        self._b_ratios = b_ratios
+        self._escape = escape
+        self._tmp = numpy.empty_like(self.xs)
+        if tangents:
+            # The x and the y components of both tangent vectors, which start
+            # out as the identity.
+            self._txs = numpy.zeros((2, len(self.xs)), dtype=numpy.float64)
+            self._txs[0] = 1.0
+            self._tys = numpy.zeros_like(self._txs)
+            self._tys[1] = 1.0
+            self._spare = numpy.empty_like(self._txs)
+            self._derivs = numpy.empty_like(self.xs)
+            self.logs = numpy.zeros_like(self._txs)
+
+    def step(self):
+        '''
+        Advances every orbit one step.
+
+        '''
+        xs, ys, tmp = self.xs, self.ys, self._tmp
+        # The same operations in the same order as hmap, except that hmap
+        # squares with pow, which can differ from x*x in the last bit.
+        # Escaping orbits overflow until the next check drops them.
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            if self.logs is not None:
+                numpy.multiply(xs, -2, out=self._derivs)
+                self._derivs *= self._a_ratios
+            numpy.multiply(xs, xs, out=tmp)
+            tmp *= self._a_ratios
+            ys += 1
+            ys -= tmp
+            xs *= self._b_ratios
+            if self.logs is not None:
+                txs, tys, spare = self._txs, self._tys, self._spare
+                numpy.multiply(txs, self._derivs, out=spare)
+                spare += tys
+                numpy.multiply(txs, self._b_ratios, out=tys)
+                self._txs, self._spare = spare, txs
+        self.xs, self.ys = ys, xs
+
+    def orthonormalize(self):
+        '''
+        Reorthonormalizes the tangent vectors by Gram-Schmidt, which is QR in
+        two dimensions, and adds log|diag R| to logs. Does nothing without
+        tangents.
+
+        '''
+        if self.logs is None:
+            return
+        txs, tys = self._txs, self._tys
+        with numpy.errstate(over='ignore', invalid='ignore',
+                            divide='ignore'):
+            r11 = numpy.hypot(txs[0], tys[0])
+            txs[0] /= r11
+            tys[0] /= r11
+            r12 = txs[0]*txs[1] + tys[0]*tys[1]
+            txs[1] -= r12*txs[0]
+            tys[1] -= r12*tys[0]
+            r22 = numpy.hypot(txs[1], tys[1])
+            txs[1] /= r22
+            tys[1] /= r22
+            self.logs[0] += numpy.log(r11)
+            self.logs[1] += numpy.log(r22)
+
+    def drop_escaped(self):
+        '''
+        Drops the orbits that have escaped.
+
+        Returns: a mask over the orbits that were live of the ones that are
+                 kept, or None if none escaped.
+        '''
+        kept = numpy.abs(self.xs) < self._escape
+        if kept.all():
+            return None
+        self.live = (numpy.flatnonzero(kept) if self.live is None
+                     else self.live[kept])
+        self.xs, self.ys = self.xs[kept], self.ys[kept]
+        self._a_ratios = self._a_ratios[kept]
+        self._b_ratios = self._b_ratios[kept]
+        self._tmp = self._tmp[:len(self.live)]
+        if self.logs is not None:
+            self._txs, self._tys = self._txs[:,kept], self._tys[:,kept]
+            self._spare = self._spare[:,:len(self.live)]
+            self._derivs = self._derivs[:len(self.live)]
+            self.logs = self.logs[:,kept]
+        return kept
+
+    def exponents(self, out, steps):
+        '''
+        Writes the Lyapunov exponents over the last steps steps into out
+        (number of parameters x 2), with NaN for the orbits that escaped.
+
+        '''
+        out.fill(numpy.nan)
+        if steps > 0:
+            out[slice(None) if self.live is None else self.live] = \
+                    self.logs.T / steps
+
+def _parameters(a_ratios, b_ratios):
+    '''
+    Broadcasts the parameters against each other, and returns their shape and
+    fresh flattened copies.
+
+    '''
+    a_ratios, b_ratios = numpy.broadcast_arrays(
+                            numpy.asarray(a_ratios, dtype=numpy.float64),
+                            numpy.asarray(b_ratios, dtype=numpy.float64))
+    return a_ratios.shape, a_ratios.ravel().copy(), b_ratios.ravel().copy()
+
+def _restart(ensemble):
+    '''
+    Forgets the stretching of the tangent vectors so far, so that the
+    Lyapunov exponents only average over the steps after the cutoff.
+
+    '''
+    if ensemble.logs is not None:
+        ensemble.orthonormalize()
+        ensemble.logs.fill(0.0)
+
+def _hmap_segments(x_start, y_start, a_ratios, b_ratios, steps, cutoff,
+                   kwargs, exponents=None):
+    '''
+    Body of hmap_chunks over flattened parameters. If exponents (number of
+    parameters x 2) is given, it holds the Lyapunov exponents so far by the
+    time the last segment of every chunk is handed out.
+
+    Yields: tuples (live, segment) where live holds the indices of the orbits
+            still being iterated, or None while all of them are, and segment
+            (len(live) x 2 x n) holds x and y of those orbits for the next n
+            steps. Rows of orbits that escape are NaN from the check before.
+            Segments never straddle a chunk boundary.
+    '''
+    chunk_size = kwargs.get('chunk_size', HENON_CHUNK_SIZE)
+    dtype = kwargs.get('dtype', numpy.float64)
+    check_every = kwargs.get('check_every', HENON_CHECK_EVERY)
+    ensemble = _Ensemble(x_start, y_start, a_ratios, b_ratios,
+                         kwargs.get('escape', HENON_ESCAPE),
+                         tangents=exponents is not None)
+
+    def _new_block():
+        # Blocks are column-major, so that every step writes contiguous
+        # columns.
+        return numpy.empty((len(ensemble.xs), 2, chunk_size), dtype=dtype,
+                           order='F')
+
+    block = _new_block()
+    # Columns of the block: the next one to write, the first one not yet
+    # handed out, and the one written just before the last escape check.
+    fill = start = checked = 0
+    for i in xrange(steps+1):
+        if i > 0:
+            ensemble.step()
+        last = i == steps
+        if i >= cutoff:
+            block[:,0,fill] = ensemble.xs
+            block[:,1,fill] = ensemble.ys
+            fill += 1
+        full = fill == chunk_size
+        if i == cutoff:
+            _restart(ensemble)
+        if i % check_every == 0 or full or last:
+            ensemble.orthonormalize()
+            live = ensemble.live
+            kept = ensemble.drop_escaped()
+            if kept is not None:
+                block[~kept,:,checked:fill] = numpy.nan
+                if fill > start:
+                    yield live, block[:,:,start:fill]
+                block = _new_block()
+                start = fill
+            checked = fill
+        if full or last:
+            if exponents is not None:
+                ensemble.exponents(exponents, i - cutoff)
+            if fill > start:
+                yield ensemble.live, block[:,:,start:fill]
+                block = _new_block()
+            fill = start = checked = 0
+
+def hmap_chunks(x_start, y_start, a_ratios, b_ratios, steps, cutoff=0,
+                **kwargs):
+    '''
+    Iterates the Henon map for a whole array of (a, b) pairs at once, and
+    streams the results after the cutoff in fixed-size chunks.
+
+    a_ratios and b_ratios are broadcast against each other, so a vector of a
+    with a scalar b sweeps a, and a[numpy.newaxis,:] with b[:,numpy.newaxis]
+    covers the whole (b, a) plane. Every so often the orbits that have
+    escaped are dropped from the ensemble, so they stop costing work.
+
+    Params: as for hmap, except that a_ratios and b_ratios are arrays.
+
+    Keyword arguments:
+        chunk_size  The number of steps per chunk. Defaults to 64.
+        dtype       The type of the chunks, numpy.float64 (the default) or
+                    numpy.float32. The iteration always runs in double
+                    precision.
+        escape      An orbit has escaped once |x| exceeds this, or stops
+                    being finite. Defaults to 1e4.
+        check_every Steps between checks for escaped orbits (default 8).
+        lyapunov    An array shaped like the broadcast parameters with an
+                    extra last axis of length 2, to accumulate both Lyapunov
+                    exponents of every orbit in, over the steps after the
+                    cutoff. Each orbit carries a pair of tangent vectors,
+                    reorthonormalized at every check for escaped orbits. It
+                    holds the estimates so far whenever a chunk is handed
+                    out, and NaN for the orbits that escaped.
+
+    Yields: tuples (xs, ys) of arrays shaped like the broadcast parameters
+            with an extra last axis for the steps in the chunk. The rows of
+            escaped orbits hold NaN from the check before they escaped on.
+            Each chunk is a fresh array that the consumer may keep.
+    '''
+    shape, a_ratios, b_ratios = _parameters(a_ratios, b_ratios)
+    count = len(a_ratios)
+    chunk_size = kwargs.get('chunk_size', HENON_CHUNK_SIZE)
+    dtype = kwargs.get('dtype', numpy.float64)
+    lyapunov = kwargs.get('lyapunov')
+    exponents = (None if lyapunov is None
+                 else numpy.empty((count, 2), dtype=numpy.float64))
+
+    def _shaped(chunk):
+        if lyapunov is not None:
+            lyapunov[...] = exponents.reshape(shape + (2,))
+        # The parameters were flattened in row-major order.
+        fill = chunk.shape[2]
+        return tuple(numpy.moveaxis(chunk[:,k].T.reshape((fill,) + shape),
+                                    0, -1) for k in (0, 1))
+
+    chunk = None
+    col = 0
+    for (live, segment) in _hmap_segments(x_start, y_start, a_ratios,
+                                          b_ratios, steps, cutoff, kwargs,
+                                          exponents):
+        width = segment.shape[2]
+        if live is None and width == chunk_size:
+            yield _shaped(segment)
+            continue
+        if width == 0:
+            continue
+        if chunk is None:
+            chunk = numpy.empty((count, 2, chunk_size), dtype=dtype,
+                                order='F')
+            chunk.fill(numpy.nan)
+        if live is None:
+            chunk[:,:,col:col+width] = segment
+        else:
+            chunk[live,:,col:col+width] = segment
+        col += width
+        if col == chunk_size:
+            yield _shaped(chunk)
+            chunk = None
+            col = 0
+    if col > 0:
+        yield _shaped(chunk[:,:,:col])
+
+def hmap_sweep(x_start, y_start, a_ratios, b_ratios, steps, cutoff=0,
+               **kwargs):
+    '''
+    Iterates the Henon map for a whole array of (a, b) pairs at once.
+
+    Params: as for hmap_chunks.
+
+    Keyword arguments: as for hmap_chunks.
+
+    Returns: a tuple (xs, ys) of arrays shaped like the broadcast parameters
+             with an extra last axis of length steps+1-cutoff. Rows of
+             bounded orbits match hmap, and those of escaped orbits hold
+             NaN once they escape.
+    '''
+    dtype = kwargs.get('dtype', numpy.float64)
+    shape = numpy.broadcast(numpy.asarray(a_ratios),
+                            numpy.asarray(b_ratios)).shape
+    length = max(steps+1-cutoff, 0)
+    xs = numpy.empty(shape + (length,), dtype=dtype)
+    ys = numpy.empty(shape + (length,), dtype=dtype)
+    col = 0
+    for (cx, cy) in hmap_chunks(x_start, y_start, a_ratios, b_ratios, steps,
+                                cutoff=cutoff, **kwargs):
+        xs[...,col:col+cx.shape[-1]] = cx
+        ys[...,col:col+cx.shape[-1]] = cy
+        col += cx.shape[-1]
+    return xs, ys
+
+class Summary(object):
+    '''
+    Per-parameter summary of an ensemble run. Every attribute is an array
+    shaped like the broadcast parameters.
+
+    Attributes:
+        bounded     Whether the orbit stayed bounded.
+        period      The period of the orbit at the end of the run, or 0 if
+                    it has none up to the largest period looked for (chaos,
+                    quasi-periodicity, a slow transient or escape).
+        x_min, x_max, y_min, y_max
+                    Extent of the orbit after the cutoff, the attractor's if
+                    the cutoff is past the transient. NaN for escaped orbits.
+        exponents   Both Lyapunov exponents over the steps after the cutoff,
+                    with an extra last axis of length 2, or None if they
+                    weren't asked for. NaN for escaped orbits.
+    '''
+    def __init__(self, bounded, period, x_min, x_max, y_min, y_max,
+                 exponents=None):
+        self.bounded = bounded
+        self.period = period
+        self.x_min = x_min
+        self.x_max = x_max
+        self.y_min = y_min
+        self.y_max = y_max
+        self.exponents = exponents
+
+def hmap_summary(x_start, y_start, a_ratios, b_ratios, steps, cutoff=0,
+                 **kwargs):
+    '''
+    Iterates the Henon map for a whole array of (a, b) pairs at once, and
+    reduces every orbit to a Summary without keeping its samples.
+
+    Params: as for hmap_chunks. There must be at least 2*max_period steps
+            after the cutoff for the periods to be found.
+
+    Keyword arguments (in addition to escape and check_every):
+        max_period  The longest period looked for (default 32).
+        tol         Distance within which samples count as repeating.
+                    Defaults to constants.EPSILON.
+        lyapunov    Whether to work out the Lyapunov exponents too, as for
+                    hmap_chunks (default False).
+
+    Returns: a Summary.
+    '''
+    max_period = kwargs.pop('max_period', HENON_MAX_PERIOD)
+    tol = kwargs.pop('tol', EPSILON)
+    lyapunov = kwargs.pop('lyapunov', False)
+    shape, a_ratios, b_ratios = _parameters(a_ratios, b_ratios)
+    count = len(a_ratios)
+
+    check_every = kwargs.get('check_every', HENON_CHECK_EVERY)
+    ensemble = _Ensemble(x_start, y_start, a_ratios, b_ratios,
+                         kwargs.get('escape', HENON_ESCAPE),
+                         tangents=lyapunov)
+
+    # Running extents and the last samples of x, of the live orbits only.
+    # They are only set up once they are needed, so that the orbits escaping
+    # during the transient don't have to be dropped from them too.
+    extent = tail = None
+    width = max(min(2*max_period, steps+1-cutoff), 0)
+    for i in xrange(steps+1):
+        if i > 0:
+            ensemble.step()
+        if i >= cutoff:
+            xs, ys = ensemble.xs, ensemble.ys
+            if extent is None:
+                extent = numpy.vstack((xs, xs, ys, ys))
+            numpy.minimum(extent[0], xs, out=extent[0])
+            numpy.maximum(extent[1], xs, out=extent[1])
+            numpy.minimum(extent[2], ys, out=extent[2])
+            numpy.maximum(extent[3], ys, out=extent[3])
+            if i > steps - width:
+                if tail is None:
+                    tail = numpy.empty((width, len(xs)), dtype=numpy.float64)
+                tail[i-steps+width-1] = xs
+        if i == cutoff:
+            _restart(ensemble)
+        if i % check_every == 0 or i == steps:
+            ensemble.orthonormalize()
+            kept = ensemble.drop_escaped()
+            if kept is not None and extent is not None:
+                extent = extent[:,kept]
+                if tail is not None:
+                    tail = tail[:,kept]
+
+    bounded = numpy.zeros(count, dtype=bool)
+    bounded[slice(None) if ensemble.live is None else ensemble.live] = True
+    extents = numpy.empty((4, count), dtype=numpy.float64)
+    extents.fill(numpy.nan)
+    period = numpy.zeros(count, dtype=numpy.int32)
+    exponents = None
+    if lyapunov:
+        exponents = numpy.empty((count, 2), dtype=numpy.float64)
+        ensemble.exponents(exponents, steps - cutoff)
+        exponents = exponents.reshape(shape + (2,))
+    if width > 0:
+        extents[:,bounded] = extent
+        period[bounded] = bifurcation.periods(tail.T, max_period, tol)
+    return Summary(bounded.reshape(shape), period.reshape(shape),
+                   *[e.reshape(shape) for e in extents], exponents=exponents)
+
+def bifurcate(a_start, a_end, a_delta, steps, cutoff, **kwargs):
     '''
     Generates a vs. X data for bifurcation plotting and analysis.
 
+    Every a value is iterated at once by hmap_sweep, with b = 0.3, and keyword
+    arguments are passed on to it.
     '''
     ass = numpy.arange(a_start, a_end, a_delta, dtype=numpy.float64)
-    xs = numpy.array([
-                    hmap(0.1, 0.1, a, 0.3, steps, cutoff=cutoff)[:,0] for a in ass
-                ], dtype=numpy.float64)
+    xs, _ = hmap_sweep(0.1, 0.1, ass, 0.3, steps, cutoff=cutoff, **kwargs)
     return ass, xs
 
+def bifurcate_adaptive(a_start, a_end, steps, cutoff, **kwargs):
+    '''
+    Generates a vs. X data for the Henon map at an adaptive resolution, with
+    b = 0.3.
+
+    Params: as for bifurcate, but without a_delta.
+
+    Keyword arguments: as for bifurcation.adaptive, plus dtype, escape and
+    check_every for hmap_sweep.
+
+    Returns: a tuple (ass, xs) as for bifurcation.adaptive.
+    '''
+    sweep_kwargs, kwargs = split_dict(('dtype', 'escape', 'check_every'),
+                                      kwargs)
+    return bifurcation.adaptive(
+                lambda ass: hmap_sweep(0.1, 0.1, ass, 0.3, steps,
+                                       cutoff=cutoff, **sweep_kwargs)[0],
+                a_start, a_end, **kwargs)
+
+def bifurcate_density(a_start, a_end, a_delta, steps, cutoff, **kwargs):
+    '''
+    Generates a bifurcation diagram of the Henon map, with b = 0.3, as a
+    bifurcation.Density, adding each chunk from hmap_chunks as it comes.
+
+    Keyword arguments:
+        x_range     The range of x to cover (default (-1.5, 1.5)).
+        width, height
+                    As for bifurcation.bifurcate_density.
+        Anything else is passed to hmap_chunks.
+
+    Returns: a bifurcation.Density.
+    '''
+    opts, kwargs = split_dict(('x_range', 'width', 'height'), kwargs)
+    ass = numpy.arange(a_start, a_end, a_delta, dtype=numpy.float64)
+    density = bifurcation.Density((a_start - a_delta/2,
+                                   a_start + (len(ass) - 0.5)*a_delta),
+                                  opts.get('x_range', (-1.5, 1.5)),
+                                  opts.get('width', len(ass)),
+                                  opts.get('height',
+                                           bifurcation.DENSITY_HEIGHT))
+    for (xs, _) in hmap_chunks(0.1, 0.1, ass, 0.3, steps, cutoff=cutoff,
+                               **kwargs):
+        density.add(ass, xs)
+    return density
+
 def plot_bifdiag(ass, xs, **kwargs):
     '''
     Plots a bifurcation diagram of the Henon map.
@@ -101,35 +565,127 @@ def plot_ret1(xs, **kwargs):
     else:
         figure.show()
 
+class TestHenon(chaostest.TestCase):
+    '''
+    Unit tests for the Henon map.
+
+    Running this module starts its main program, so run these with
+    python -m unittest henon.
+    '''
+    def test_sweep(self):
+        '''
+        Tests the ensemble against hmap, including an orbit that escapes.
+
+        '''
+        ass = numpy.array([0.2, 0.9, 1.0, 1.4, 1.5])
+        xs, ys = hmap_sweep(0.1, 0.1, ass, 0.3, 60, cutoff=20, chunk_size=9,
+                            check_every=3)
+        self.assertEqual(xs.shape, (5, 41))
+        for (k, a) in enumerate(ass[:4]):
+            expected = hmap(0.1, 0.1, a, 0.3, 60, cutoff=20)
+            self.assertArrayEqual(xs[k], expected[:,0], places=6)
+            self.assertArrayEqual(ys[k], expected[:,1], places=6)
+        # a = 1.5 is past the boundary crisis, and |x| passes 1e4 at step 14.
+        xs, _ = hmap_sweep(0.1, 0.1, ass[3:], 0.3, 20, chunk_size=4,
+                           check_every=3)
+        self.assertArrayEqual(xs[1,:13], hmap(0.1, 0.1, 1.5, 0.3, 12)[:,0])
+        self.assertTrue(numpy.isnan(xs[1,13:]).all())
+        self.assertTrue(numpy.isfinite(xs[0]).all())
+
+    def test_summary(self):
+        '''
+        Tests the summaries over a small (b, a) plane.
+
+        '''
+        ass = numpy.array([0.2, 0.9, 1.0, 1.4, 1.5])
+        bs = numpy.array([0.3, -0.3])
+        summary = hmap_summary(0.1, 0.1, ass[numpy.newaxis,:],
+                               bs[:,numpy.newaxis], 2000, cutoff=1000,
+                               check_every=5)
+        self.assertEqual(summary.period.shape, (2, 5))
+        self.assertEqual(summary.period[0].tolist(), [1, 2, 4, 0, 0])
+        self.assertEqual(summary.bounded[0].tolist(),
+                         [True, True, True, True, False])
+        self.assertTrue(numpy.isnan(summary.x_max[0,4]))
+        # The attractor of the classic map spans about -1.28 < x < 1.27.
+        self.assertAlmostEqual(summary.x_min[0,3], -1.28, delta=0.01)
+        self.assertAlmostEqual(summary.x_max[0,3], 1.27, delta=0.01)
+        self.assertArrayEqual(summary.y_max[0,:4], 0.3*summary.x_max[0,:4])
+        # A fixed point satisfies a x^2 + (1 - b) x - 1 = 0.
+        a, b = 0.2, -0.3
+        x = (-(1 - b) + numpy.sqrt((1 - b)**2 + 4*a)) / (2*a)
+        self.assertEqual(summary.period[1,0], 1)
+        self.assertAlmostEqual(summary.x_min[1,0], x, places=9)
+
+    def test_lyapunov(self):
+        '''
+        Tests the exponents from the tangent vectors against exact ones.
+
+        '''
+        ass = numpy.array([0.2, 1.4, 1.5])
+        lambdas = numpy.empty((3, 2))
+        hmap_sweep(0.1, 0.1, ass, 0.3, 5000, cutoff=1000, chunk_size=100,
+                   check_every=5, lyapunov=lambdas)
+        # The multipliers of a fixed point solve m^2 + 2 a x m - b = 0.
+        a, b = 0.2, 0.3
+        x = (-(1 - b) + numpy.sqrt((1 - b)**2 + 4*a)) / (2*a)
+        ms = numpy.roots([1.0, 2*a*x, -b])
+        self.assertArrayEqual(lambdas[0], numpy.sort(numpy.log(abs(ms)))[::-1],
+                              places=9)
+        # The classic attractor, whose exponents add up to log|det J|.
+        self.assertAlmostEqual(lambdas[1,0], 0.42, delta=0.01)
+        self.assertAlmostEqual(lambdas[1].sum(), numpy.log(0.3), places=9)
+        self.assertTrue(numpy.isnan(lambdas[2]).all())
+
+        summary = hmap_summary(0.1, 0.1, ass, 0.3, 5000, cutoff=1000,
+                               check_every=5, lyapunov=True)
+        self.assertEqual(summary.exponents.shape, (3, 2))
+        self.assertArrayEqual(summary.exponents[:2].ravel(),
+                              lambdas[:2].ravel())
+        self.assertTrue(hmap_summary(0.1, 0.1, ass, 0.3, 100).exponents
+                        is None)
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
 
     file_prefix = None
+    exponents = False
 
     try:
-        options, args = getopt.getopt(argv[1:], 'f:')
+        options, args = getopt.getopt(argv[1:], 'f:y')
         for opt, arg in options:
             if opt == '-f':
                 file_prefix = arg
+            elif opt == '-y':
+                exponents = True
     except getopt.GetoptError as err:
         print str(err)
         return 2
 
-    ass, xs = bifurcate(0.0, 1.4, 0.001, 2000, 500)
+    ass = numpy.arange(0.0, 1.4, 0.001, dtype=numpy.float64)
+    lambdas = numpy.empty((len(ass), 2))
+    density = bifurcate_density(0.0, 1.4, 0.001, 2000, 500, lyapunov=lambdas)
     zs = hmap(0.0, 0.0, 1.4, 0.3, 10000)
+    title = 'Bifurcation Diagram for the Henon Map'
+    plot_args = dict(log=True, xlabel='a', title=title)
+    if exponents:
+        plot_args['exponents'] = (ass, lambdas[:,0])
 
     if file_prefix is not None:
- #       import pdb; pdb.set_trace()
-        plot_bifdiag(ass, xs, filename='{0}_bifurc.png'.format(file_prefix))
+        bifurcation.plot_density(
+                density,
+                filename='{0}_bifurc.png'.format(file_prefix),
+                **plot_args
+            )
         plot_ret1(
                 zs, 
                 filename='{0}_ret1.png'.format(file_prefix),
                 title='Henon Map, $a=1.4$'
             )
     else:
-        plot_bifdiag(ass, xs)
-        plot_ret1(xs, title='Henon Map, $a=1.4$')
+        bifurcation.plot_density(density, **plot_args)
+        plot_ret1(zs, title='Henon Map, $a=1.4$')
 
     return 0
 
@@ -0,0 +1,326 @@
+###############################################################################
+#
+# CSCI 4446 - Chaotic Dynamics
+#
+# File: kernels.py
+# Author: Ken Sheedlo
+#
+# Compiled stepping loops for the built-in systems.
+#
+###############################################################################
+
+'''
+JIT-compiled integrator kernels.
+
+The system factories (lorenz.lorenz, rossler.rossler, pendulum.pendulum,
+mechanics.twobody, mechanics.threebody and ps7.variational) tag the callables
+they return with a kernel attribute, a tuple (name, params). When numba is
+importable, rungekutta uses that tag to run the whole stepping loop as compiled
+code instead of calling back into Python for every stage. Without numba, or
+for any other derivative function, nothing here is used and the integrators run
+on NumPy as before. A Stats object passed to the integrators gets the counts of
+the compiled run, but a progress callback needs the NumPy path.
+'''
+
+from __future__ import division
+
+import numpy
+import time
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+AVAILABLE = numba is not None
+
+# Steps per block of output from the compiled adaptive loop.
+KERNEL_CHUNK = 4096
+
+def _jit(func):
+    return func if numba is None else numba.njit(func)
+
+@_jit
+def _lorenz(t, x, p, out):
+    a, r, b = p[0], p[1], p[2]
+    out[0] = a * (x[1]-x[0])
+    out[1] = r*x[0] - x[1] - x[0]*x[2]
+    out[2] = x[0]*x[1] - b*x[2]
+
+@_jit
+def _rossler(t, x, p, out):
+    a, b, c = p[0], p[1], p[2]
+    out[0] = -(x[1]+x[2])
+    out[1] = x[0] + a*x[1]
+    out[2] = b + x[2]*(x[0]-c)
+
+@_jit
+def _pendulum(t, x, p, out):
+    mass, length, damping, ampl, freq = p[0], p[1], p[2], p[3], p[4]
+    out[1] = (ampl*numpy.cos(freq*t) - damping*length*x[1] -
+                mass*9.8*numpy.sin(x[0])) / (mass*length)
+    out[0] = x[1]
+
+@_jit
+def _nbody(x, p, out, nbodies):
+    '''
+    Pairwise gravity for the mechanics state layout. p is (G, m1, m2, ...).
+
+    '''
+    gravity = p[0]
+    for i in range(nbodies):
+        for k in range(3):
+            out[6*i+k] = x[6*i+3+k]
+            out[6*i+3+k] = 0.0
+    for i in range(nbodies):
+        for j in range(i+1, nbodies):
+            d0 = x[6*i] - x[6*j]
+            d1 = x[6*i+1] - x[6*j+1]
+            d2 = x[6*i+2] - x[6*j+2]
+            r2 = d0*d0 + d1*d1 + d2*d2
+            scale = gravity / (r2 ** 1.5)
+            mi = p[1+i]
+            mj = p[1+j]
+            out[6*i+3] -= mj*scale*d0
+            out[6*i+4] -= mj*scale*d1
+            out[6*i+5] -= mj*scale*d2
+            out[6*j+3] += mi*scale*d0
+            out[6*j+4] += mi*scale*d1
+            out[6*j+5] += mi*scale*d2
+
+@_jit
+def _twobody(t, x, p, out):
+    _nbody(x, p, out, 2)
+
+@_jit
+def _threebody(t, x, p, out):
+    _nbody(x, p, out, 3)
+
+@_jit
+def _variational(t, x, p, out):
+    a, r, b = p[0], p[1], p[2]
+    out[0] = a*(x[1]-x[0])
+    out[1] = x[0]*(r-x[2]) - x[1]
+    out[2] = x[0]*x[1] - b*x[2]
+    for k in range(3):
+        out[3+k] = a*(x[6+k]-x[3+k])
+        out[6+k] = (r-x[2])*x[3+k] - x[6+k] - x[0]*x[9+k]
+        out[9+k] = x[1]*x[3+k] + x[0]*x[6+k] - b*x[9+k]
+
+SYSTEMS = {
+    'lorenz': _lorenz,
+    'rossler': _rossler,
+    'pendulum': _pendulum,
+    'twobody': _twobody,
+    'threebody': _threebody,
+    'variational': _variational,
+}
+
+def _make_rk4(rhs):
+    '''
+    Compiles a fixed-step RK4 loop around rhs.
+
+    '''
+    @_jit
+    def _rk4(t0, dt, nsteps, p, xs):
+        dim = xs.shape[0]
+        k1 = numpy.empty(dim)
+        k2 = numpy.empty(dim)
+        k3 = numpy.empty(dim)
+        k4 = numpy.empty(dim)
+        xt = numpy.empty(dim)
+        for i in range(1, nsteps+1):
+            tn = t0 + (i-1)*dt
+            rhs(tn, xs[:,i-1], p, k1)
+            for j in range(dim):
+                xt[j] = xs[j,i-1] + k1[j]*dt/2
+            rhs(tn + dt/2, xt, p, k2)
+            for j in range(dim):
+                xt[j] = xs[j,i-1] + k2[j]*dt/2
+            rhs(tn + dt/2, xt, p, k3)
+            for j in range(dim):
+                xt[j] = xs[j,i-1] + k3[j]*dt
+            rhs(tn + dt, xt, p, k4)
+            for j in range(dim):
+                xs[j,i] = xs[j,i-1] + dt*((k1[j] + 2*k2[j] + 2*k3[j] + k4[j]) / 6)
+    return _rk4
+
+def _make_ark4(rhs, safety):
+    '''
+    Compiles the step doubling adaptive RK4 loop of rungekutta.ark4.
+
+    '''
+    @_jit
+    def _step(tn, xn, dt, p, k1, k2, k3, k4, xt, out):
+        dim = xn.shape[0]
+        rhs(tn, xn, p, k1)
+        for j in range(dim):
+            xt[j] = xn[j] + k1[j]*dt/2
+        rhs(tn + dt/2, xt, p, k2)
+        for j in range(dim):
+            xt[j] = xn[j] + k2[j]*dt/2
+        rhs(tn + dt/2, xt, p, k3)
+        for j in range(dim):
+            xt[j] = xn[j] + k3[j]*dt
+        rhs(tn + dt, xt, p, k4)
+        for j in range(dim):
+            out[j] = xn[j] + dt*((k1[j] + 2*k2[j] + 2*k3[j] + k4[j]) / 6)
+
+    @_jit
+    def _ark4(t, x, dt, t_final, tol, p, ts, xs, counts):
+        dim = x.shape[0]
+        k1 = numpy.empty(dim)
+        k2 = numpy.empty(dim)
+        k3 = numpy.empty(dim)
+        k4 = numpy.empty(dim)
+        xt = numpy.empty(dim)
+        x1 = numpy.empty(dim)
+        xh = numpy.empty(dim)
+        x2 = numpy.empty(dim)
+
+        # Steps go into the block ts, xs until it is full or t_final is
+        # reached, continuing from (t, x) with the step size dt. counts adds
+        # up the derivative evaluations and the rejected trial steps.
+        xn = x
+        n = 0
+        while n < ts.shape[0] and t < t_final:
+            # Grow the step until the error estimate is nonzero, at most
+            # 10 times, as _step_until_nonzero_error does.
+            delta = tol
+            for count in range(11):
+                if count == 10:
+                    delta = tol
+                    break
+                _step(t, xn, dt, p, k1, k2, k3, k4, xt, x1)
+                _step(t, xn, dt/2, p, k1, k2, k3, k4, xt, xh)
+                _step(t + dt/2, xh, dt/2, p, k1, k2, k3, k4, xt, x2)
+                counts[0] += 12
+                delta = 0.0
+                for j in range(dim):
+                    delta = max(delta, abs(x1[j]-x2[j]))
+                if delta != 0.0:
+                    break
+                counts[1] += 1
+                dt = 2*dt
+            if tol >= delta:
+                dt = safety * dt * (abs(tol/delta) ** 0.2)
+            else:
+                dt = safety * dt * (abs(tol/delta) ** 0.25)
+            dt = min(dt, t_final - t)
+            _step(t, xn, dt, p, k1, k2, k3, k4, xt, xs[n])
+            counts[0] += 4
+            t = t + dt
+            ts[n] = t
+            xn = xs[n]
+            n += 1
+        return n, dt
+    return _ark4
+
+_compiled = {}
+
+def _kernel(dfunc, kwargs, kind, make):
+    '''
+    Finds or compiles the kind of loop for dfunc, or returns None if the
+    NumPy path should be used.
+
+    '''
+    backend = kwargs.get('backend', 'auto')
+    if backend not in ('auto', 'numpy', 'jit'):
+        raise ValueError('unknown backend: {0}'.format(backend))
+    tag = getattr(dfunc, 'kernel', None)
+    if backend == 'jit':
+        if not AVAILABLE:
+            raise RuntimeError('backend=jit requested but numba is not installed')
+        if tag is None:
+            raise ValueError('backend=jit needs a built-in system function')
+    if backend == 'numpy' or not AVAILABLE or tag is None:
+        return None
+    # Options that only the NumPy loops understand force the NumPy path.
+    for key in ('f_args', 'out_file', 'events', 'progress'):
+        if kwargs.get(key) is not None:
+            return None
+    name, params = tag
+    key = (kind, name)
+    if key not in _compiled:
+        _compiled[key] = make(SYSTEMS[name])
+    return _compiled[key], numpy.asarray(params, dtype=numpy.float64)
+
+def _fill_stats(stats, nfev, rejected, dts, t, start):
+    '''
+    Fills in the rungekutta.Stats of a compiled run, if there is one. The
+    derivative is compiled into the loop, so dfunc_time stays 0.
+
+    '''
+    if stats is None:
+        return
+    stats.nfev += int(nfev)
+    stats.accepted += len(dts)
+    stats.rejected += int(rejected)
+    if len(dts) > 0:
+        stats.min_dt = min(stats.min_dt, dts.min())
+        stats.max_dt = max(stats.max_dt, dts.max())
+    stats.t = t
+    stats.total_time = time.time() - start
+
+def rk4(dfunc, t0, x0, dt, nsteps, kwargs):
+    '''
+    Runs rungekutta.rk4 for a built-in system as compiled code.
+
+    Returns: (ts, xs) as rungekutta.rk4 does, or None if dfunc has no kernel
+             or the requested options need the NumPy path.
+    '''
+    found = _kernel(dfunc, kwargs, 'rk4', _make_rk4)
+    if found is None:
+        return None
+    loop, params = found
+    start = time.time()
+    ts = t0 + (numpy.array(range(nsteps+1), dtype=numpy.float64) * dt)
+    xs = numpy.empty((len(x0), nsteps+1), dtype=numpy.float64)
+    xs[:,0] = x0
+    loop(float(t0), float(dt), nsteps, params, xs)
+    _fill_stats(kwargs.get('stats'), 4*nsteps, 0,
+                numpy.repeat(float(dt), nsteps), ts[-1], start)
+    return ts, xs
+
+def ark4(dfunc, t0, x0, t_final, tol, kwargs, safety):
+    '''
+    Runs rungekutta.ark4 for a built-in system as compiled code.
+
+    The compiled loop fills blocks of KERNEL_CHUNK steps, as
+    rungekutta._ChunkedColumns does, so a long run never copies the steps it
+    has already taken.
+
+    Returns: (ts, xs) as rungekutta.ark4 does, or None as for rk4.
+    '''
+    found = _kernel(dfunc, kwargs, 'ark4', lambda rhs: _make_ark4(rhs, safety))
+    if found is None:
+        return None
+    loop, params = found
+    start = time.time()
+    x = numpy.array(x0, dtype=numpy.float64)
+    t, t_final, tol = float(t0), float(t_final), float(tol)
+    dt = 0.01
+    # Derivative evaluations and rejected trial steps.
+    counts = numpy.zeros(2, dtype=numpy.int64)
+    tblocks, blocks = [], []
+    while t < t_final:
+        tb = numpy.empty(KERNEL_CHUNK, dtype=numpy.float64)
+        xb = numpy.empty((KERNEL_CHUNK, len(x)), dtype=numpy.float64)
+        fill, dt = loop(t, x, dt, t_final, tol, params, tb, xb, counts)
+        tblocks.append(tb[:fill])
+        blocks.append(xb[:fill])
+        t, x = tb[fill-1], xb[fill-1]
+
+    n = 1 + sum(len(tb) for tb in tblocks)
+    ts = numpy.empty(n, dtype=numpy.float64)
+    xs = numpy.empty((len(x), n), dtype=numpy.float64)
+    ts[0] = t0
+    xs[:,0] = x0
+    lo = 1
+    for (tb, xb) in zip(tblocks, blocks):
+        ts[lo:lo+len(tb)] = tb
+        xs[:,lo:lo+len(tb)] = xb.T
+        lo += len(tb)
+    _fill_stats(kwargs.get('stats'), counts[0], counts[1], numpy.diff(ts),
+                ts[-1], start)
+    return ts, xs
@@ -9,6 +9,7 @@
 #
 ###############################################################################
 
+import chaostest
 import getopt
 import matplotlib.pyplot
 import numpy
@@ -43,6 +44,104 @@ def lmap(start, ratio, steps, cutoff=0):
         result[i+1] = ratio * x_i * (1-x_i)
     return result[cutoff:]
 
+SWEEP_CHUNK_SIZE = 64
+LYAPUNOV_EVERY = 16
+
+def lmap_chunks(start, ratios, steps, cutoff=0, **kwargs):
+    '''
+    Iterates the Logistic map for a whole vector of R values at once, and
+    streams the results after the cutoff in fixed-size chunks.
+
+    Every step is a handful of array operations on all the R values, so the
+    cost of the interpreter is paid once per step rather than once per step
+    per R value. The iteration always runs in double precision.
+
+    Params: as for lmap, except that ratios is a vector of R values.
+
+    Keyword arguments:
+        chunk_size  The number of steps per chunk. Defaults to 64.
+        dtype       The type of the chunks, numpy.float64 (the default) or
+                    numpy.float32 to halve the memory they take.
+        lyapunov    A vector (len(ratios)) to accumulate the Lyapunov exponent
+                    of every R value in, as the average of log|f'(x)| over
+                    the steps after the cutoff. It holds the estimates so
+                    far whenever a chunk is handed out. The factors of |f'|
+                    are multiplied up for 16 steps between logarithms, so
+                    orbits that pass through x = 0.5 come out as -inf.
+
+    Yields: arrays (len(ratios) x n) whose rows continue the rows of lmap for
+            the matching R values. Each chunk is a fresh array that the
+            consumer may keep.
+    '''
+    chunk_size = kwargs.get('chunk_size', SWEEP_CHUNK_SIZE)
+    dtype = kwargs.get('dtype', numpy.float64)
+    lyapunov = kwargs.get('lyapunov')
+
+    rs = numpy.asarray(ratios, dtype=numpy.float64)
+    xs = numpy.empty_like(rs)
+    xs.fill(start)
+    rxs = numpy.empty_like(rs)
+
+    if lyapunov is not None:
+        logs = numpy.zeros_like(rs)
+        products = numpy.ones_like(rs)
+        derivs = numpy.empty_like(rs)
+        count = 0
+
+    def _fold():
+        with numpy.errstate(divide='ignore'):
+            logs[:] += numpy.log(numpy.abs(products))
+        products.fill(1.0)
+
+    # Chunks are column-major, so that every step writes a contiguous column.
+    chunk = numpy.empty((len(rs), chunk_size), dtype=dtype, order='F')
+    fill = 0
+    for i in xrange(steps+1):
+        if i > 0:
+            # The same operations in the same order as lmap, so the rows
+            # match it exactly.
+            numpy.multiply(rs, xs, out=rxs)
+            if lyapunov is not None and i > cutoff:
+                # f'(x) = r - 2rx, at the x being mapped.
+                numpy.multiply(rxs, -2, out=derivs)
+                derivs += rs
+                products *= derivs
+                count += 1
+                if count % LYAPUNOV_EVERY == 0:
+                    _fold()
+            numpy.subtract(1, xs, out=xs)
+            xs *= rxs
+        if i < cutoff:
+            continue
+        chunk[:,fill] = xs
+        fill += 1
+        if fill == chunk_size or i == steps:
+            if lyapunov is not None and count > 0:
+                _fold()
+                numpy.divide(logs, count, out=lyapunov)
+            yield chunk[:,:fill]
+            chunk = numpy.empty((len(rs), chunk_size), dtype=dtype, order='F')
+            fill = 0
+
+def lmap_sweep(start, ratios, steps, cutoff=0, **kwargs):
+    '''
+    Iterates the Logistic map for a whole vector of R values at once.
+
+    Params: as for lmap_chunks.
+
+    Keyword arguments: as for lmap_chunks, lyapunov included.
+
+    Returns: an array (len(ratios) x steps+1-cutoff) whose rows are the
+             results of lmap for the matching R values.
+    '''
+    dtype = kwargs.get('dtype', numpy.float64)
+    result = numpy.empty((len(ratios), max(steps+1-cutoff, 0)), dtype=dtype)
+    col = 0
+    for chunk in lmap_chunks(start, ratios, steps, cutoff=cutoff, **kwargs):
+        result[:,col:col+chunk.shape[1]] = chunk
+        col += chunk.shape[1]
+    return result
+
 def plot_time(ts, xs, **kwargs):
     '''
     Plots the specified vector in the time domain.
@@ -123,6 +222,50 @@ def plot_ret2(xs, **kwargs):
     else:
         figure.show()
 
+class TestLogistic(chaostest.TestCase):
+    '''
+    Unit tests for the Logistic map.
+
+    Running this module starts its main program, so run these with
+    python -m unittest logistic.
+    '''
+    def test_sweep(self):
+        '''
+        Tests the vectorized sweep against lmap, one R value at a time.
+
+        '''
+        rs = numpy.linspace(2.8, 4.0, 13)
+        xs = lmap_sweep(0.5, rs, 300, cutoff=100, chunk_size=7)
+        self.assertEqual(xs.shape, (13, 201))
+        for (r, row) in zip(rs, xs):
+            self.assertTrue(numpy.array_equal(row, lmap(0.5, r, 300, cutoff=100)))
+
+        chunks = list(lmap_chunks(0.5, rs, 300, cutoff=100, chunk_size=64,
+                                  dtype=numpy.float32))
+        self.assertEqual([c.shape[1] for c in chunks], [64, 64, 64, 9])
+        self.assertEqual(chunks[0].dtype, numpy.float32)
+        self.assertTrue(numpy.array_equal(numpy.hstack(chunks),
+                                          xs.astype(numpy.float32)))
+        self.assertEqual(lmap_sweep(0.5, rs, 10, cutoff=20).shape, (13, 0))
+
+    def test_lyapunov(self):
+        '''
+        Tests exponents accumulated along a sweep against exact ones.
+
+        '''
+        rs = numpy.array([2.8, 3.2, 1 + numpy.sqrt(5), 4.0])
+        exponents = numpy.empty(4)
+        lmap_sweep(0.3, rs, 20000, cutoff=1000, chunk_size=100,
+                   lyapunov=exponents)
+        # The fixed point 1 - 1/r has multiplier 2 - r, and the 2-cycle
+        # has 4 + 2r - r^2, which is 0 at r = 1 + sqrt(5), a superstable
+        # cycle.
+        self.assertAlmostEqual(exponents[0], numpy.log(0.8), places=12)
+        self.assertAlmostEqual(exponents[1], numpy.log(0.16)/2, places=12)
+        self.assertTrue(exponents[2] < -10)
+        # Chaos, with the exponent of the full shift.
+        self.assertAlmostEqual(exponents[3], numpy.log(2), delta=0.01)
+
 def main(argv=None):
     '''
     Main program function.
@@ -27,16 +27,31 @@ def lorenz(a, r, b):
 
     Params: a, r, b for the new Lorenz system.
 
-    Returns: a callable F(t, x) where
+    Returns: a callable F(t, x, out=None) where
         t   is not used in the Lorenz system, but included for compatibility
             with ODE integrators.
-        x   the current state vector of the system.
+        x   the current state vector of the system, or a (3 x n) block of
+            states (one per column) for rungekutta.rk4_ensemble.
+        out optionally, an array shaped like x to write the derivative into.
+    F carries a jacobian(t, x) attribute for rungekutta.rosenbrock.
     '''
-    return lambda _, x: numpy.array([
-                                    a * (x[1]-x[0]),
-                                    r*x[0] - x[1] - x[0]*x[2],
-                                    x[0]*x[1] - b*x[2]
-                                ], dtype=numpy.float64)
+    def _lorenz(_, x, out=None):
+        if out is None:
+            out = numpy.empty(numpy.shape(x), dtype=numpy.float64)
+        out[0] = a * (x[1]-x[0])
+        out[1] = r*x[0] - x[1] - x[0]*x[2]
+        out[2] = x[0]*x[1] - b*x[2]
+        return out
+    def _jacobian(_, x):
+        return numpy.array([
+                    [-a, a, 0.0],
+                    [r - x[2], -1.0, -x[0]],
+                    [x[1], x[0], -b]
+                ], dtype=numpy.float64)
+    _lorenz.inplace = True
+    _lorenz.kernel = ('lorenz', (a, r, b))
+    _lorenz.jacobian = _jacobian
+    return _lorenz
 
 def plot_dtol(tstep, **kwargs):
     '''
@@ -60,6 +75,8 @@ def main(argv=None):
         argv=sys.argv        
 
     file_prefix = None
+    out_file = None
+    verbose = False
     a = 16.0
     r = 45.0
     b = 4.0
@@ -67,7 +84,7 @@ def main(argv=None):
     suffixed = lambda s, suf: None if s is None else '{0}{1}'.format(s, suf)
 
     try:
-        options, args = getopt.getopt(argv[1:], 'a:r:b:f:')
+        options, args = getopt.getopt(argv[1:], 'a:r:b:f:o:v')
         for opt, arg in options:
             if opt == '-a':
                 a = float(arg)
@@ -77,13 +94,22 @@ def main(argv=None):
                 b = float(arg)
             elif opt == '-f':
                 file_prefix = arg
+            elif opt == '-o':
+                out_file = arg
+            elif opt == '-v':
+                verbose = True
     except getopt.GetoptError as err:
         print str(err)
         return 2
 
     x0 = numpy.array([-13, -12, 52], dtype=numpy.float64)
     lfunc = lorenz(a, r, b)
-    ts, xs = rungekutta.ark4(lfunc, 0.0, x0, 20000.0, 0.00001)
+    def _report(stats):
+        sys.stderr.write('{0}\n'.format(stats))
+    ts, xs = rungekutta.dopri5(lfunc, 0.0, x0, 20000.0, 0.00001,
+                               out_file=out_file,
+                               progress=_report if verbose else None,
+                               progress_every=100000)
     plot.render3d(
                 xs[0,:], xs[1,:], xs[2,:], 'b.',
                 xlabel='x', 
@@ -0,0 +1,207 @@
+###############################################################################
+#
+# CSCI 4446 - Chaotic Dynamics
+#
+# File: lyapunov.py
+# Author: Ken Sheedlo
+#
+# Lyapunov spectra from the variational equations.
+#
+###############################################################################
+
+'''
+Lyapunov spectrum engine.
+
+Integrates a variational system, such as ps7.variational, whose state is the
+n-vector x followed by the (n x n) matrix of variations, row by row, so that
+the columns of the matrix are the tangent vectors. Every so often the tangent
+vectors are reorthonormalized by a QR decomposition, and the logarithms of the
+diagonal of R are added up. Their time averages converge to the Lyapunov
+exponents. Without the reorthonormalization, every tangent vector collapses
+onto the most expanding direction and eventually overflows.
+
+Systems without a hand-written variational system can use dual.variational.
+'''
+
+from __future__ import division
+
+import chaostest
+import numpy
+import rungekutta
+import unittest
+
+class Spectrum(object):
+    '''
+    Result of a spectrum run.
+
+    Attributes:
+        exponents   The final estimates, in decreasing order.
+        ts          Time of each reorthonormalization, after the transient.
+        history     The running estimates at those times (len(ts) x n).
+        converged   Whether the run stopped because the estimates settled.
+    '''
+    def __init__(self, exponents, ts, history, converged):
+        self.exponents = exponents
+        self.ts = ts
+        self.history = history
+        self.converged = converged
+
+def spectrum(vfunc, x0, n, dt, t_final, **kwargs):
+    '''
+    Computes the Lyapunov spectrum of a system from its variational equations.
+
+    Params:
+        vfunc   The variational system, as a derivative function for rk4.
+        x0      Initial point of the underlying system, an n-vector. The
+                tangent vectors start out as the identity.
+        n       Dimension of the underlying system.
+        dt      Integration time step.
+        t_final Longest time to average over, after the transient.
+
+    Keyword arguments:
+        renorm_every
+                RK4 steps between reorthonormalizations (default 50). This
+                only has to be short enough that the tangent vectors neither
+                overflow nor collapse onto each other in between; the sums of
+                log|diag R| don't depend on it otherwise.
+        t_transient
+                Time to integrate before averaging starts, so that the
+                trajectory settles on the attractor and the tangent vectors
+                line up with the Lyapunov directions (default 0).
+        tol     Stop early once no exponent has moved by more than tol over
+                the last window reorthonormalizations. Defaults to 0, which
+                never stops early.
+        window  See tol (default 200).
+        callback
+                A callable callback(t, estimates) run after every window
+                reorthonormalizations. If it returns True, the run stops.
+        Anything else is passed to rungekutta.rk4, e.g. backend.
+
+    Returns: a Spectrum.
+    '''
+    every = kwargs.pop('renorm_every', 50)
+    t_transient = kwargs.pop('t_transient', 0.0)
+    tol = kwargs.pop('tol', 0.0)
+    window = kwargs.pop('window', 200)
+    callback = kwargs.pop('callback', None)
+
+    state = numpy.empty(n + n*n, dtype=numpy.float64)
+    state[:n] = x0
+    state[n:] = numpy.eye(n).ravel()
+    span = every*dt
+
+    def _advance(t):
+        '''
+        Integrates over one span, reorthonormalizes, and returns log|diag R|.
+
+        '''
+        _, xs = rungekutta.rk4(vfunc, t, state, dt, every, **kwargs)
+        state[:] = xs[:,-1]
+        q, r = numpy.linalg.qr(state[n:].reshape((n, n)))
+        # Fold the signs into Q so that the diagonal of R is positive.
+        signs = numpy.sign(numpy.diag(r))
+        signs[signs == 0] = 1.0
+        state[n:] = (q*signs).ravel()
+        return numpy.log(numpy.abs(numpy.diag(r)))
+
+    t = 0.0
+    for _ in xrange(int(round(t_transient/span))):
+        _advance(t)
+        t += span
+    t_start = t
+
+    count = int(round(t_final/span))
+    ts = t_start + span*numpy.arange(1, count+1, dtype=numpy.float64)
+    history = numpy.empty((count, n), dtype=numpy.float64)
+    sums = numpy.zeros(n, dtype=numpy.float64)
+    converged = False
+    for k in xrange(count):
+        sums += _advance(t)
+        t = ts[k]
+        history[k] = sums / (t - t_start)
+        if (k+1) % window == 0:
+            converged = tol > 0 and k >= window and \
+                    numpy.abs(history[k] - history[k-window]).max() < tol
+            cancelled = callback is not None and callback(t, history[k])
+            if converged or cancelled:
+                count = k+1
+                break
+
+    ts, history = ts[:count], history[:count]
+    return Spectrum(numpy.sort(history[-1])[::-1], ts, history, converged)
+
+def lorenz(a, r, b, x0, dt=0.001, t_final=1000.0, **kwargs):
+    '''
+    Lyapunov spectrum of the Lorenz system, using ps7.variational.
+
+    Keyword arguments are those of spectrum. The transient defaults to 10
+    time units.
+    '''
+    import ps7
+    kwargs.setdefault('t_transient', 10.0)
+    return spectrum(ps7.variational(a, r, b), x0, 3, dt, t_final, **kwargs)
+
+def kaplan_yorke(exponents):
+    '''
+    Kaplan-Yorke (Lyapunov) dimension from a spectrum.
+
+    '''
+    exponents = numpy.sort(numpy.asarray(exponents))[::-1]
+    sums = numpy.cumsum(exponents)
+    k = numpy.searchsorted(-sums, 0.0, side='right')
+    if k == 0:
+        return 0.0
+    if k == len(exponents):
+        return float(len(exponents))
+    return k + sums[k-1] / abs(exponents[k])
+
+def _linear(rates):
+    '''
+    Variational system of x' = diag(rates) x, for testing.
+
+    '''
+    n = len(rates)
+    rates = numpy.asarray(rates, dtype=numpy.float64)
+    def _dfunc(_, xs):
+        ds = numpy.empty_like(xs)
+        ds[:n] = rates*xs[:n]
+        ds[n:] = (rates[:,numpy.newaxis]*xs[n:].reshape((n, n))).ravel()
+        return ds
+    return _dfunc
+
+class TestLyapunov(chaostest.TestCase):
+    '''
+    Unit tests for the Lyapunov spectrum engine.
+
+    '''
+    def test_linear(self):
+        '''
+        Tests a linear system, whose exponents are its rates.
+
+        '''
+        # Without reorthonormalization e^(30 t) would overflow by t = 24.
+        spec = spectrum(_linear((30.0, -2.0, 0.5)), numpy.zeros(3), 3, 0.001,
+                        50.0, renorm_every=100)
+        self.assertArrayEqual(spec.exponents, [30.0, 0.5, -2.0], places=5)
+        self.assertEqual(spec.history.shape, (500, 3))
+        self.assertFalse(spec.converged)
+
+    def test_lorenz(self):
+        '''
+        Tests the classic Lorenz parameters against the known spectrum.
+
+        '''
+        x0 = numpy.array([1.0, 1.0, 20.0])
+        spec = lorenz(10.0, 28.0, 8/3, x0, dt=0.005, t_final=1000.0,
+                      tol=2e-3, window=400)
+        self.assertTrue(spec.converged)
+        self.assertTrue(spec.ts[-1] < 1000.0)
+        self.assertAlmostEqual(spec.exponents[0], 0.906, delta=0.05)
+        self.assertAlmostEqual(spec.exponents[1], 0.0, delta=0.05)
+        # The exponents add up to the trace of the Jacobian.
+        self.assertAlmostEqual(sum(spec.exponents), -(10.0 + 1.0 + 8/3),
+                               places=3)
+        self.assertAlmostEqual(kaplan_yorke(spec.exponents), 2.06, delta=0.01)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,7 +11,41 @@
 
 from __future__ import division
 
+import chaostest
 import numpy
+import unittest
+
+def _sqnorm(rdisp):
+    '''
+    Squared length of a displacement, or of each column of a block of them.
+
+    '''
+    return (rdisp*rdisp).sum(axis=0)
+
+def _jacobian(gravity, masses, softening=0.0):
+    '''
+    Builds the Jacobian jac(t, st) of the n-body system with these masses.
+
+    '''
+    nbodies = len(masses)
+    eye = numpy.eye(3)
+    def _jac(_, st):
+        pos = _bodies(st, nbodies)[:,0]
+        jac = numpy.zeros((6*nbodies, 6*nbodies), dtype=numpy.float64)
+        for i in xrange(nbodies):
+            jac[6*i:6*i+3, 6*i+3:6*i+6] = eye
+            for j in xrange(i+1, nbodies):
+                rdisp = pos[i] - pos[j]
+                sqnorm = _sqnorm(rdisp) + softening*softening
+                # Derivative of G*rdisp/|rdisp|^3 with respect to rdisp.
+                tidal = gravity*(eye - 3*numpy.outer(rdisp, rdisp)/sqnorm) / \
+                        (sqnorm ** (3/2))
+                for (a, b, mb) in ((i, j, masses[j]), (j, i, masses[i])):
+                    rows = slice(6*a+3, 6*a+6)
+                    jac[rows, 6*a:6*a+3] -= mb*tidal
+                    jac[rows, 6*b:6*b+3] += mb*tidal
+        return jac
+    return _jac
 
 def twobody(gravity, m1, m2):
     '''
@@ -21,25 +55,39 @@ def twobody(gravity, m1, m2):
     position and velocity of the first body respectively, followed by the 
     position and velocity of the second body likewise. All positions and 
     velocities are considered to be vectors in 3-space, for a total of 12 
-    coordinates.
+    coordinates. x may also be a (12 x n) block of states, one per column, for
+    use with rungekutta.rk4_ensemble.
 
     Parameters:
         gravity The gravitational constant G.
         m1      Mass of the first body.
         m2      Mass of the second body.
 
-    Returns: a callable df(t, x) that returns the value of the derivative of
-                the system at time t and state x. Note that the system is 
-                autonomous, therefore t is always discarded. It is included for 
-                compatibility with ODE solvers.
+    Returns: a callable df(t, x, out=None) that returns the value of the 
+                derivative of the system at time t and state x. Note that the 
+                system is autonomous, therefore t is always discarded. It is 
+                included for compatibility with ODE solvers. If out is given 
+                the derivative is written into it. The callable also carries
+                gravity and masses attributes, for use with conserved and the
+                symplectic integrators, and a jacobian(t, x) attribute for
+                rungekutta.rosenbrock.
     '''
-    def _twobody(_, st):
+    def _twobody(_, st, out=None):
+        if out is None:
+            out = numpy.empty(numpy.shape(st), dtype=numpy.float64)
         rdisp = st[:3] - st[6:9]
         # Performance optimization: Factor equations as much as possible
-        common = gravity*rdisp/(rdisp.dot(rdisp) ** (3/2))
-        dv1 = -m2*common
-        dv2 = m1*common
-        return numpy.concatenate((st[3:6], dv1, st[9:], dv2))
+        common = gravity*rdisp/(_sqnorm(rdisp) ** (3/2))
+        out[:3] = st[3:6]
+        out[3:6] = -m2*common
+        out[6:9] = st[9:]
+        out[9:] = m1*common
+        return out
+    _twobody.inplace = True
+    _twobody.kernel = ('twobody', (gravity, m1, m2))
+    _twobody.gravity = gravity
+    _twobody.masses = (m1, m2)
+    _twobody.jacobian = _jacobian(gravity, _twobody.masses)
     return _twobody
 
 def threebody(gravity, m1, m2, m3):
@@ -48,7 +96,7 @@ def threebody(gravity, m1, m2, m3):
 
     The state of the system should be specified as a 18-vector x with the 
     position and velocity of each body. The order agrees with the format defined
-    in the two-body equation. 
+    in the two-body equation. Blocks of states (18 x n) are accepted as well.
 
     Parameters:
         gravity The gravitational constant G.
@@ -56,20 +104,380 @@ def threebody(gravity, m1, m2, m3):
         m2      Mass of the second body.
         m3      Mass of the third body.
 
-    Returns: a callable df(t, x) that returns the value of the derivative of the 
-                system at time t and state x. The time parameter t is included 
-                for compatibility with ODE solvers, although the system is 
-                autonomous.
+    Returns: a callable df(t, x, out=None) that returns the value of the 
+                derivative of the system at time t and state x. The time 
+                parameter t is included for compatibility with ODE solvers, 
+                although the system is autonomous. If out is given the 
+                derivative is written into it. gravity, masses and
+                jacobian are attached as for twobody.
     """
-    def _threebody(_, st):
+    def _threebody(_, st, out=None):
+        if out is None:
+            out = numpy.empty(numpy.shape(st), dtype=numpy.float64)
         rdisp12 = st[:3] - st[6:9]
         rdisp13 = st[:3] - st[12:15]
         rdisp23 = st[6:9] - st[12:15]
-        common12 = gravity*rdisp12/(rdisp12.dot(rdisp12) ** (3/2))
-        common13 = gravity*rdisp13/(rdisp13.dot(rdisp13) ** (3/2))
-        common23 = gravity*rdisp23/(rdisp23.dot(rdisp23) ** (3/2))
-        dv1 = -m2*common12 - m3*common13
-        dv2 = m1*common12 - m3*common23 
-        dv3 = m1*common13 + m2*common23 
-        return numpy.concatenate((st[3:6], dv1, st[9:12], dv2, st[15:], dv3))
+        common12 = gravity*rdisp12/(_sqnorm(rdisp12) ** (3/2))
+        common13 = gravity*rdisp13/(_sqnorm(rdisp13) ** (3/2))
+        common23 = gravity*rdisp23/(_sqnorm(rdisp23) ** (3/2))
+        out[:3] = st[3:6]
+        out[3:6] = -m2*common12 - m3*common13
+        out[6:9] = st[9:12]
+        out[9:12] = m1*common12 - m3*common23 
+        out[12:15] = st[15:]
+        out[15:] = m1*common13 + m2*common23 
+        return out
+    _threebody.inplace = True
+    _threebody.kernel = ('threebody', (gravity, m1, m2, m3))
+    _threebody.gravity = gravity
+    _threebody.masses = (m1, m2, m3)
+    _threebody.jacobian = _jacobian(gravity, _threebody.masses)
     return _threebody
+
+# Bodies from which nbody switches to the Barnes-Hut tree by default, and the
+# depth at which the tree stops subdividing.
+TREE_MIN_BODIES = 1000
+TREE_MAX_DEPTH = 16
+
+def nbody(gravity, masses, softening=0.0, opening=0.5, tree_min=None):
+    '''
+    Constructs the gravitational N-body problem.
+
+    The state is laid out as for twobody and threebody: the position and then
+    the velocity of each body, 6N coordinates in all, or a (6N x n) block of
+    states. Accelerations are computed from all N^2 pairs at once by
+    broadcasting. From tree_min bodies up they are approximated with a
+    Barnes-Hut octree instead, which costs O(N log N).
+
+    Parameters:
+        gravity     The gravitational constant G.
+        masses      The masses of the bodies.
+        softening   Plummer softening length. Pairs interact through
+                    1/(r^2 + softening^2) instead of 1/r^2, which keeps close
+                    encounters from blowing up the step size (default 0).
+        opening     Barnes-Hut opening angle. A tree cell of side s at
+                    distance d stands in for its bodies when s/d < opening.
+                    Smaller is more accurate; 0 visits every body.
+        tree_min    Number of bodies from which the tree is used (default
+                    TREE_MIN_BODIES).
+
+    Returns: a callable df(t, x, out=None) as for twobody, carrying gravity,
+             masses and softening attributes, and jacobian for the direct
+             summation.
+    '''
+    masses = numpy.asarray(masses, dtype=numpy.float64)
+    nbodies = len(masses)
+    tree_min = TREE_MIN_BODIES if tree_min is None else tree_min
+    eps2 = softening*softening
+
+    def _direct(pos, acc):
+        # rdisp[i,j] = r_j - r_i, for every pair at once.
+        rdisp = pos[numpy.newaxis] - pos[:,numpy.newaxis]
+        sqnorm = (rdisp*rdisp).sum(axis=2) + eps2
+        diag = numpy.arange(nbodies)
+        sqnorm[diag, diag] = numpy.inf
+        weights = masses.reshape((1, nbodies) + (1,)*(pos.ndim-2)) * \
+                    sqnorm ** -1.5
+        acc[...] = gravity*(weights[:,:,numpy.newaxis]*rdisp).sum(axis=1)
+
+    def _tree(pos, acc):
+        if pos.ndim > 2:
+            for k in xrange(pos.shape[2]):
+                acc[...,k] = _barnes_hut(pos[...,k], masses, gravity, eps2,
+                                         opening)
+        else:
+            acc[...] = _barnes_hut(pos, masses, gravity, eps2, opening)
+
+    forces = _tree if nbodies >= tree_min else _direct
+
+    def _nbody(_, st, out=None):
+        if out is None:
+            out = numpy.empty(numpy.shape(st), dtype=numpy.float64)
+        bodies = _bodies(st, nbodies)
+        derivs = _bodies(out, nbodies)
+        derivs[:,0] = bodies[:,1]
+        forces(bodies[:,0], derivs[:,1])
+        return out
+    _nbody.inplace = True
+    _nbody.gravity = gravity
+    _nbody.masses = tuple(masses)
+    _nbody.softening = softening
+    if forces is _direct:
+        _nbody.jacobian = _jacobian(gravity, masses, softening)
+    return _nbody
+
+def _octree(pos, masses):
+    '''
+    Builds a Barnes-Hut octree over the positions (N x 3).
+
+    Cells are found level by level from the Morton keys of the bodies, so that
+    the bodies of every cell are contiguous in key order and its mass and
+    center of mass come from a single reduceat. A cell holding one body, or
+    lying at TREE_MAX_DEPTH, is a leaf.
+
+    Returns: a dict of per-cell arrays (mass, com, size, level, prefix, leaf,
+             first and count of the children) plus the body keys and the
+             shift that turns a key into its prefix at each level.
+    '''
+    lo = pos.min(axis=0)
+    size = max((pos.max(axis=0) - lo).max(), 1e-300) * (1 + 1e-12)
+    depth = TREE_MAX_DEPTH
+    cells = numpy.minimum(((pos - lo) / size * (1 << depth)).astype(numpy.int64),
+                          (1 << depth) - 1)
+    keys = numpy.zeros(len(pos), dtype=numpy.int64)
+    for bit in xrange(depth):
+        for axis in xrange(3):
+            keys |= ((cells[:,axis] >> bit) & 1) << (3*bit + axis)
+    order = numpy.argsort(keys, kind='mergesort')
+    skeys = keys[order]
+    # A zero row at the end, so that a cell can end at N in reduceat.
+    smass = numpy.append(masses[order], 0.0)
+    mpos = numpy.vstack((smass[:-1,numpy.newaxis] * pos[order], numpy.zeros(3)))
+
+    levels = []
+    # Bodies are split further only where a cell holds more than one.
+    active = numpy.ones(len(pos), dtype=bool)
+    for level in xrange(depth+1):
+        shift = 3*(depth - level)
+        prefix = skeys >> shift
+        bounds = numpy.flatnonzero(numpy.concatenate(
+                    ([True], prefix[1:] != prefix[:-1], [True])))
+        starts = bounds[:-1][active[bounds[:-1]]]
+        ends = bounds[numpy.searchsorted(bounds, starts, side='right')]
+        # Bodies of cells that aren't split any more lie between the cells,
+        # so each sum has to stop at its own end.
+        cuts = numpy.column_stack((starts, ends)).ravel()
+        mass = numpy.add.reduceat(smass, cuts)[::2]
+        com = numpy.add.reduceat(mpos, cuts, axis=0)[::2] / \
+                mass[:,numpy.newaxis]
+        leaf = (ends - starts == 1) | (level == depth)
+        levels.append((level, prefix[starts], mass, com, leaf, starts, ends))
+        split = ~leaf
+        if not split.any():
+            break
+        mark = numpy.zeros(len(pos) + 1, dtype=numpy.int64)
+        numpy.add.at(mark, starts[split], 1)
+        numpy.add.at(mark, ends[split], -1)
+        active = numpy.cumsum(mark[:-1]) > 0
+
+    offsets = numpy.cumsum([0] + [len(lv[1]) for lv in levels])
+    tree = {
+        'level': numpy.concatenate([numpy.repeat(lv[0], len(lv[1]))
+                                    for lv in levels]),
+        'prefix': numpy.concatenate([lv[1] for lv in levels]),
+        'mass': numpy.concatenate([lv[2] for lv in levels]),
+        'com': numpy.concatenate([lv[3] for lv in levels]),
+        'leaf': numpy.concatenate([lv[4] for lv in levels]),
+    }
+    tree['size'] = size / (1 << tree['level']).astype(numpy.float64)
+    first = numpy.zeros(offsets[-1], dtype=numpy.int64)
+    nchild = numpy.zeros(offsets[-1], dtype=numpy.int64)
+    for k in xrange(len(levels) - 1):
+        _, _, _, _, leaf, starts, ends = levels[k]
+        children = levels[k+1][5]
+        # Children are contiguous, in the order of their parents.
+        lo_idx = numpy.searchsorted(children, starts)
+        hi_idx = numpy.searchsorted(children, ends)
+        split = ~leaf
+        first[offsets[k]:offsets[k+1]] = numpy.where(
+                                        split, offsets[k+1] + lo_idx, 0)
+        nchild[offsets[k]:offsets[k+1]] = numpy.where(split, hi_idx - lo_idx, 0)
+    tree['first'] = first
+    tree['nchild'] = nchild
+    tree['keys'] = keys
+    tree['shift'] = 3*(depth - tree['level'])
+    return tree
+
+def _barnes_hut(pos, masses, gravity, eps2, opening):
+    '''
+    Barnes-Hut accelerations of the bodies at pos (N x 3).
+
+    Every body walks the tree at the same time: the walk keeps a list of
+    (body, cell) pairs, accepts those whose cell is a leaf or looks small
+    enough from the body, and replaces the rest by the children of the cell.
+    A body never feels its own mass, even inside an accepted cell.
+
+    Returns: the accelerations (N x 3).
+    '''
+    tree = _octree(pos, masses)
+    acc = numpy.zeros_like(pos)
+    bodies = numpy.arange(len(pos))
+    cells = numpy.zeros(len(pos), dtype=numpy.int64)
+    theta2 = opening*opening
+    while len(bodies):
+        rdisp = tree['com'][cells] - pos[bodies]
+        sqdist = (rdisp*rdisp).sum(axis=1)
+        accept = tree['leaf'][cells] | \
+                    (tree['size'][cells] ** 2 < theta2*sqdist)
+
+        b, c, rdisp = bodies[accept], cells[accept], rdisp[accept]
+        mass = tree['mass'][c]
+        inside = (tree['keys'][b] >> tree['shift'][c]) == tree['prefix'][c]
+        if inside.any():
+            # Take the body out of its own cell.
+            mb = masses[b[inside]]
+            rest = mass[inside] - mb
+            moment = mass[inside, numpy.newaxis]*rdisp[inside]
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                rdisp[inside] = moment / rest[:,numpy.newaxis]
+            mass[inside] = rest
+        keep = mass > 0
+        b, mass, rdisp = b[keep], mass[keep], rdisp[keep]
+        sqnorm = (rdisp*rdisp).sum(axis=1) + eps2
+        pull = gravity*mass*sqnorm ** -1.5
+        for axis in xrange(3):
+            acc[:,axis] += numpy.bincount(b, weights=pull*rdisp[:,axis],
+                                          minlength=len(pos))
+
+        opened = ~accept
+        parents = cells[opened]
+        nchild = tree['nchild'][parents]
+        bodies = numpy.repeat(bodies[opened], nchild)
+        # The children of each opened cell are first, first+1, ...
+        starts = numpy.repeat(tree['first'][parents], nchild)
+        runs = numpy.repeat(numpy.cumsum(nchild) - nchild, nchild)
+        cells = starts + numpy.arange(len(bodies)) - runs
+    return acc
+
+def _bodies(st, nbodies):
+    '''
+    Views a state (or block of states) as (nbodies x 2 x 3 [x n]), so that
+    [:,0] are the positions and [:,1] the velocities.
+
+    '''
+    if not hasattr(st, 'reshape'):
+        st = numpy.asarray(st, dtype=numpy.float64)
+    return st.reshape((nbodies, 2, 3) + st.shape[1:])
+
+def energy(gravity, masses, st, softening=0.0):
+    '''
+    Total energy of the n-body state st, or of each column of a block, with
+    the potential softened as in nbody.
+
+    '''
+    return kinetic(masses, st) + potential(gravity, masses, st, softening)
+
+def kinetic(masses, st):
+    '''
+    Kinetic energy of an n-body state or block of states.
+
+    '''
+    bodies = _bodies(st, len(masses))
+    return sum(mi*_sqnorm(bodies[i,1])/2 for (i, mi) in enumerate(masses))
+
+def potential(gravity, masses, st, softening=0.0):
+    '''
+    Potential energy (negative) of an n-body state or block of states.
+
+    '''
+    bodies = _bodies(st, len(masses))
+    total = 0.0
+    for (i, mi) in enumerate(masses):
+        for j in xrange(i+1, len(masses)):
+            rdisp = bodies[i,0] - bodies[j,0]
+            total = total - gravity*mi*masses[j]/numpy.sqrt(
+                                    _sqnorm(rdisp) + softening*softening)
+    return total
+
+def encounter_time(gravity, masses, st):
+    '''
+    Shortest two-body timescale of an n-body state, or of each column of a
+    block: over all pairs, the lesser of the time to cover their separation
+    at their relative speed and the free-fall time sqrt(r^3 / G(mi + mj)).
+    Steps much shorter than this resolve every close encounter.
+
+    '''
+    masses = numpy.asarray(masses, dtype=numpy.float64)
+    bodies = _bodies(st, len(masses))
+    i, j = numpy.triu_indices(len(masses), 1)
+    rdisp = bodies[i,0] - bodies[j,0]
+    vdisp = bodies[i,1] - bodies[j,1]
+    sqdist = (rdisp*rdisp).sum(axis=1)
+    sqspeed = (vdisp*vdisp).sum(axis=1)
+    mu = (gravity*(masses[i] + masses[j])).reshape(
+                                    (len(i),) + (1,)*(sqdist.ndim - 1))
+    with numpy.errstate(divide='ignore'):
+        flight = numpy.sqrt(sqdist / sqspeed)
+    fall = numpy.sqrt(sqdist ** 1.5 / mu)
+    return numpy.minimum(flight, fall).min(axis=0)
+
+def momentum(masses, st):
+    '''
+    Total linear momentum (3-vector, or 3 x n for a block).
+
+    '''
+    bodies = _bodies(st, len(masses))
+    return sum(mi*bodies[i,1] for (i, mi) in enumerate(masses))
+
+def angular_momentum(masses, st):
+    '''
+    Total angular momentum about the origin (3-vector, or 3 x n for a block).
+
+    '''
+    bodies = _bodies(st, len(masses))
+    return sum(mi*numpy.cross(bodies[i,0], bodies[i,1], axis=0)
+                for (i, mi) in enumerate(masses))
+
+def conserved(dfunc, st):
+    '''
+    The conserved quantities of an n-body state or block of states.
+
+    Params:
+        dfunc   A system from twobody, threebody or nbody, which carries the
+                gravity and masses it was built with.
+        st      A state, or a (6N x n) block of them such as the xs of an
+                integrator.
+
+    Returns: a dict with the energy, momentum and angular_momentum.
+    '''
+    return {
+        'energy': energy(dfunc.gravity, dfunc.masses, st,
+                         getattr(dfunc, 'softening', 0.0)),
+        'momentum': momentum(dfunc.masses, st),
+        'angular_momentum': angular_momentum(dfunc.masses, st),
+    }
+
+class TestMechanics(chaostest.TestCase):
+    '''
+    Unit tests for the n-body systems.
+
+    '''
+    def setUp(self):
+        self.rand = numpy.random.RandomState(0)
+
+    def test_nbody(self):
+        '''
+        Tests the general system against threebody, and its Jacobian.
+
+        '''
+        import dual
+        masses = (0.5, 0.3, 0.2)
+        df = nbody(1.0, masses)
+        st = self.rand.randn(18, 4)
+        self.assertArrayEqual((df(0.0, st) - threebody(1.0, *masses)(0.0, st))
+                              .ravel(), numpy.zeros(72), places=12)
+        soft = nbody(1.0, masses, softening=0.1)
+        self.assertArrayEqual(soft.jacobian(0.0, st[:,0]).ravel(),
+                              dual.jacobian(soft, 0.0, st[:,0]).ravel(),
+                              places=10)
+
+    def test_tree(self):
+        '''
+        Tests the Barnes-Hut accelerations against direct summation.
+
+        '''
+        masses = self.rand.uniform(0.5, 1.5, 300)
+        st = self.rand.randn(1800)
+        direct = _bodies(nbody(1.0, masses, 0.01)(0.0, st), 300)[:,1]
+        exact = nbody(1.0, masses, 0.01, opening=0.0, tree_min=1)
+        self.assertArrayEqual(
+                (_bodies(exact(0.0, st), 300)[:,1] - direct).ravel(),
+                numpy.zeros(900), places=9)
+        tree = _bodies(nbody(1.0, masses, 0.01, tree_min=1)(0.0, st), 300)
+        errs = numpy.sqrt(_sqnorm((tree[:,1] - direct).T) /
+                          _sqnorm(direct.T))
+        self.assertLess(numpy.median(errs), 0.01)
+        self.assertLess(errs.max(), 0.1)
+
+if __name__ == "__main__":
+    unittest.main()
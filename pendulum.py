@@ -11,13 +11,14 @@
 
 from __future__ import division
 
+import chaostest
 import getopt
 import matplotlib.pyplot
 import numpy
 import rungekutta
 import sys
 
-from utils import split_dict, ufunc
+from utils import mod2pi, split_dict, ufunc
 
 PHASE_POINTS = (
         (3.0, 0.1),
@@ -42,24 +43,180 @@ def pendulum(mass, length, damping, ampl=0.0, freq=0.0):
         ampl        The drive amplitude (defaults to 0.0).
         freq        The drive frequency.
 
-    Returns: a callable pfunc(t, x) that returns the value of the derivative at 
-             t, x.
+    Returns: a callable pfunc(t, x, out=None) that returns the value of the 
+             derivative at t, x. x may also be a (2 x n) block of states, one 
+             per column, for use with rungekutta.rk4_ensemble. If out is given
+             the derivative is written into it. The callable carries a
+             jacobian(t, x) attribute for rungekutta.rosenbrock.
     '''
-    def _pendulum(t, xvec):
+    def _pendulum(t, xvec, out=None):
         '''
         Pendulum callable function.
 
         '''
+        if out is None:
+            out = numpy.empty(numpy.shape(xvec), dtype=numpy.float64)
         theta = xvec[0]
         omega = xvec[1]
-        omega_dot = (ampl*numpy.cos(freq*t) - damping*length*omega -
+        out[1] = (ampl*numpy.cos(freq*t) - damping*length*omega -
                     mass*9.8*numpy.sin(theta)) / (mass*length)
-        return numpy.array([omega, omega_dot], dtype=numpy.float64)
+        out[0] = omega
+        return out
+    def _jacobian(_, xvec):
+        return numpy.array([
+                    [0.0, 1.0],
+                    [-9.8*numpy.cos(xvec[0])/length, -damping/mass]
+                ], dtype=numpy.float64)
+    _pendulum.inplace = True
+    _pendulum.kernel = ('pendulum', (mass, length, damping, ampl, freq))
+    _pendulum.jacobian = _jacobian
     return _pendulum
 
-def mod2pi(theta):
-    modulus = int(numpy.floor(theta / (2*numpy.pi)))
-    return theta - (modulus*2*numpy.pi)
+# Defaults for basins.
+BASIN_STEPS_PER_PERIOD = 100
+BASIN_TRANSIENT = 10
+BASIN_MAX_PERIODS = 300
+BASIN_MAX_CYCLE = 4
+BASIN_TOL = 1e-5
+BASIN_MATCH_TOL = 1e-2
+BASIN_CHUNK_SIZE = 50000
+
+def basins(pfunc, thetas, omegas, freq, **kwargs):
+    '''
+    Maps the basins of attraction of a driven pendulum.
+
+    Every point of the (theta, omega) grid is integrated at once, as a block
+    of states, and sampled once per drive period. A point has settled when its
+    stroboscopic samples repeat with some period p, and is then labeled with
+    the attractor, that is the p-cycle of samples, that it settled on. Settled
+    points are dropped from the block, so the integration speeds up as the
+    grid is resolved, and the grid is worked through in chunks so that memory
+    doesn't grow with its size.
+
+    Params:
+        pfunc   A pendulum function that accepts (2 x n) blocks of states.
+        thetas  Initial angles, the columns of the map.
+        omegas  Initial angular velocities, the rows of the map.
+        freq    The drive frequency. Samples are taken every 2*pi/freq.
+
+    Keyword arguments:
+        steps_per_period
+                RK4 steps per drive period (default 100).
+        transient
+                Drive periods before points may be called settled (default
+                10).
+        max_periods
+                Drive periods after which points that haven't settled are
+                given up on, e.g. because they are chaotic (default 300).
+        max_cycle
+                Longest stroboscopic cycle that is recognized (default 4).
+        tol     Distance within which a sample counts as a repeat (default
+                1e-5).
+        match_tol
+                Distance within which a settled point lies on a known
+                attractor (default 1e-2).
+        chunk_size
+                Points integrated at once (default 50000).
+        inplace As for rungekutta.rk4.
+
+    Returns: a tuple (labels, attractors) where
+        labels      An integer image (len(omegas) x len(thetas)) of attractor
+                    numbers, with -1 where a point never settled.
+        attractors  For each attractor number, its cycle of stroboscopic
+                    samples (p x 2), theta in [0, 2*pi).
+    '''
+    chunk_size = kwargs.get('chunk_size', BASIN_CHUNK_SIZE)
+    grid = numpy.meshgrid(thetas, omegas)
+    x0s = numpy.array([grid[0].ravel(), grid[1].ravel()], dtype=numpy.float64)
+    labels = numpy.empty(x0s.shape[1], dtype=numpy.int64)
+    attractors = []
+    for start in xrange(0, x0s.shape[1], chunk_size):
+        stop = min(start + chunk_size, x0s.shape[1])
+        labels[start:stop] = _basin_chunk(pfunc, x0s[:,start:stop], freq,
+                                          attractors, kwargs)
+    return labels.reshape(grid[0].shape), attractors
+
+def _circle_dist(xs, ys):
+    '''
+    Distances between the columns of two blocks of (theta, omega) states,
+    with theta taken modulo 2*pi.
+
+    '''
+    dtheta = numpy.mod(xs[0] - ys[0] + numpy.pi, 2*numpy.pi) - numpy.pi
+    return numpy.hypot(dtheta, xs[1] - ys[1])
+
+def _basin_chunk(pfunc, x0s, freq, attractors, kwargs):
+    '''
+    Labels one chunk of basins, adding any new attractors to attractors.
+
+    '''
+    steps = kwargs.get('steps_per_period', BASIN_STEPS_PER_PERIOD)
+    transient = kwargs.get('transient', BASIN_TRANSIENT)
+    max_periods = kwargs.get('max_periods', BASIN_MAX_PERIODS)
+    max_cycle = kwargs.get('max_cycle', BASIN_MAX_CYCLE)
+    tol = kwargs.get('tol', BASIN_TOL)
+    period = 2*numpy.pi/freq
+    dt = period/steps
+
+    labels = numpy.empty(x0s.shape[1], dtype=numpy.int64)
+    labels.fill(-1)
+    xs = numpy.array(x0s, dtype=numpy.float64)
+    index = numpy.arange(x0s.shape[1])
+    # Ring of the last max_cycle samples; sample k lives in slot k % max_cycle.
+    history = numpy.empty((max_cycle,) + xs.shape, dtype=numpy.float64)
+    step = rungekutta._stepper(pfunc, xs.shape, kwargs, tuple())
+    for k in xrange(1, max_periods+1):
+        t0 = (k-1)*period
+        for i in xrange(steps):
+            step(xs, t0 + i*dt, dt, xs)
+        mod2pi(xs[0], out=xs[0])
+
+        if k > max(transient, max_cycle):
+            cycle = numpy.zeros(xs.shape[1], dtype=numpy.int64)
+            for p in xrange(max_cycle, 0, -1):
+                repeats = _circle_dist(xs, history[(k-p) % max_cycle]) < tol
+                cycle[repeats] = p
+            settled = cycle > 0
+            if settled.any():
+                labels[index[settled]] = _classify(
+                            xs[:,settled], cycle[settled],
+                            history[:,:,settled], k, attractors, kwargs)
+                keep = ~settled
+                xs, index = xs[:,keep], index[keep]
+                history = history[:,:,keep]
+                if not len(index):
+                    break
+                step = rungekutta._stepper(pfunc, xs.shape, kwargs, tuple())
+        history[k % max_cycle] = xs
+    return labels
+
+def _classify(xs, cycle, history, k, attractors, kwargs):
+    '''
+    Finds the attractor of each settled point, from its latest sample xs,
+    its cycle length and its sample history, and returns their numbers.
+    Points that match no known attractor start new ones.
+
+    '''
+    match_tol = kwargs.get('match_tol', BASIN_MATCH_TOL)
+    max_cycle = history.shape[0]
+    labels = numpy.empty(xs.shape[1], dtype=numpy.int64)
+    labels.fill(-1)
+    for (number, points) in enumerate(attractors):
+        dists = numpy.min([_circle_dist(xs, pt[:,numpy.newaxis])
+                           for pt in points], axis=0)
+        labels[(labels < 0) & (dists < match_tol)] = number
+    for j in numpy.flatnonzero(labels < 0):
+        if labels[j] >= 0:
+            continue
+        # The newest sample and the p-1 before it make up the cycle.
+        p = cycle[j]
+        points = numpy.array([xs[:,j]] + [history[(k-i) % max_cycle,:,j]
+                                           for i in xrange(1, p)])
+        attractors.append(points)
+        dists = numpy.min([_circle_dist(xs, pt[:,numpy.newaxis])
+                           for pt in points], axis=0)
+        labels[(labels < 0) & (dists < match_tol)] = len(attractors) - 1
+    return labels
 
 def render_plot(ts, xs, *args, **kwargs):
     '''
@@ -113,14 +270,14 @@ def make_phase_portrait(pfunc, *args, **kwargs):
     file_prefix = opts.get('file_prefix')
     title = opts.get('title')
 
-    for (theta, omega) in PHASE_POINTS:
-        _, xs = rungekutta.rk4(
-                                pfunc, 
-                                0.0, 
-                                numpy.array([theta, omega], dtype=numpy.float64),
-                                0.005,
-                                2000
-                            )
+    _, xss = rungekutta.rk4_ensemble(
+                            pfunc,
+                            0.0,
+                            numpy.array(PHASE_POINTS, dtype=numpy.float64),
+                            0.005,
+                            2000
+                        )
+    for xs in xss:
         axes.plot(xs[0,:], xs[1,:], *args, **plot_args)
 
     axes.set_xlabel(r'$\theta$')
@@ -162,17 +319,15 @@ def make_phase_portrait_mod2pi(pfunc, *args, **kwargs):
     file_prefix = opts.get('file_prefix')
     title = opts.get('title')
 
-    for (theta, omega) in PHASE_POINTS:
-        _, xs = rungekutta.rk4(
-                                pfunc, 
-                                0.0, 
-                                numpy.array([theta, omega], dtype=numpy.float64),
-                                0.005,
-                                2000
-                            )
-        xs[0,:] = numpy.array([
-                            mod2pi(theta) for theta in xs[0,:]
-                        ], dtype=numpy.float64)
+    _, xss = rungekutta.rk4_ensemble(
+                            pfunc,
+                            0.0,
+                            numpy.array(PHASE_POINTS, dtype=numpy.float64),
+                            0.005,
+                            2000,
+                            periodic_dims=(0,)
+                        )
+    for xs in xss:
         axes.plot(xs[0,:], xs[1,:], *args, **plot_args)
 
     axes.set_xlabel(r'$\theta$')
@@ -199,6 +354,31 @@ def make_phase_portrait_mod2pi(pfunc, *args, **kwargs):
     else:
         figure.savefig('{0}.png'.format(file_prefix), dpi=220)
 
+def render_basins(labels, thetas, omegas, **kwargs):
+    '''
+    Renders a basin map from basins as an image, one color per attractor and
+    white where points never settled.
+
+    '''
+    figure = matplotlib.pyplot.figure()
+    axes = figure.gca()
+    opts, plot_args = split_dict(('title', 'file_prefix'), kwargs)
+    file_prefix = opts.get('file_prefix')
+
+    image = numpy.ma.masked_less(labels, 0)
+    plot_args.setdefault('cmap', 'viridis')
+    axes.imshow(image, origin='lower', aspect='auto', interpolation='nearest',
+                extent=(thetas[0], thetas[-1], omegas[0], omegas[-1]),
+                **plot_args)
+    axes.set_xlabel(r'$\theta$')
+    axes.set_ylabel(r'$\omega$')
+    axes.set_title(opts.get('title', 'Basins of Attraction'))
+
+    if file_prefix is None:
+        figure.show()
+    else:
+        figure.savefig('{0}.png'.format(file_prefix), dpi=220)
+
 def plot_pfunc(pfunc, *args, **kwargs):
     '''
     Convenience function for experimenting with pendulum functions.
@@ -214,12 +394,9 @@ def plot_pfunc(pfunc, *args, **kwargs):
                         0.0, 
                         numpy.array([theta0, omega0], dtype=numpy.float64),
                         tstep, 
-                        nsteps
+                        nsteps,
+                        periodic_dims=(0,) if kwargs.get('mod2pi') else None
                     )
-    fix_domain = lambda x: mod2pi(x) if kwargs.get('mod2pi', False) else x
-    xs[0,:] = numpy.array([
-                        fix_domain(theta) for theta in xs[0,:]
-                    ], dtype=numpy.float64)
     render_plot(xs[0,:], xs[1,:], *args, **plot_args)
 
 def main(argv=None):
@@ -227,12 +404,15 @@ def main(argv=None):
         argv = sys.argv
 
     file_prefix = None
+    basin_map = False
 
     try:
-        options, args = getopt.getopt(argv[1:], 'f:')
+        options, args = getopt.getopt(argv[1:], 'f:b')
         for opt, arg in options:
             if opt == '-f':
                 file_prefix = arg
+            elif opt == '-b':
+                basin_map = True
     except getopt.GetoptError as err:
         print str(err)
         return 2
@@ -293,7 +473,72 @@ def main(argv=None):
             markersize=0.6
         )
 
+    if basin_map:
+        drive_freq = 7.4246
+        thetas = numpy.linspace(-numpy.pi, numpy.pi, 400)
+        omegas = numpy.linspace(-20.0, 20.0, 400)
+        labels, attractors = basins(
+                pendulum(0.1, 0.1, 0.25, ampl=0.7, freq=drive_freq),
+                thetas, omegas, drive_freq
+            )
+        render_basins(labels, thetas, omegas,
+                title=r'Basins of Attraction ($A=0.7, \alpha=7.4246$)',
+                file_prefix=suffixed(file_prefix, '_6')
+            )
+
     return 0
 
+def _two_wells(_, xvec, out=None):
+    '''
+    A damped system with stable equilibria at theta = 0 and pi, for testing.
+
+    '''
+    if out is None:
+        out = numpy.empty(numpy.shape(xvec), dtype=numpy.float64)
+    out[1] = -2.0*xvec[1] - numpy.sin(2*xvec[0])
+    out[0] = xvec[1]
+    return out
+_two_wells.inplace = True
+
+class TestPendulum(chaostest.TestCase):
+    '''
+    Unit tests for the basin mapper.
+
+    Running this module starts its main program, so run these with
+    python -m unittest pendulum.
+    '''
+    def test_basins(self):
+        '''
+        Tests the two basins, split by the unstable equilibria at pi/2 and
+        3*pi/2, and that chunking doesn't change the labels.
+
+        '''
+        thetas = numpy.linspace(0.05, 2*numpy.pi - 0.05, 40)
+        omegas = numpy.linspace(-0.2, 0.2, 5)
+        labels, attractors = basins(_two_wells, thetas, omegas, 2.0)
+        self.assertEqual(labels.shape, (5, 40))
+        self.assertEqual(len(attractors), 2)
+        rest = [attractors[label][0,0] for label in labels[2]]
+        expected = numpy.where(
+                        (thetas > numpy.pi/2) & (thetas < 3*numpy.pi/2),
+                        numpy.pi, 0.0)
+        self.assertArrayEqual(numpy.sin(rest), numpy.zeros(40), places=4)
+        self.assertArrayEqual(numpy.cos(rest), numpy.cos(expected), places=4)
+        chunked, _ = basins(_two_wells, thetas, omegas, 2.0, chunk_size=7)
+        self.assertArrayEqual(chunked.ravel(), labels.ravel())
+
+    def test_periodic(self):
+        '''
+        Tests a driven pendulum with a period-3 and a period-1 attractor.
+
+        '''
+        freq = 7.4246
+        pfunc = pendulum(0.1, 0.1, 0.25, ampl=0.7, freq=freq)
+        labels, attractors = basins(pfunc, numpy.linspace(-3.0, 3.0, 12),
+                                    numpy.linspace(-20.0, 20.0, 12), freq,
+                                    max_periods=150)
+        self.assertEqual(sorted(len(a) for a in attractors), [1, 3])
+        self.assertTrue((labels >= 0).mean() > 0.9)
+
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
@@ -137,12 +137,8 @@ def embedded(vs, xdim, ydim, *args, **kwargs):
     Renders a delay coordinate embedded data set.
 
     '''
-    xs = numpy.array([
-                utils.mod2pi(v) for v in vs[:,xdim]
-            ], dtype=numpy.float64)
-    ys = numpy.array([
-                utils.mod2pi(v) for v in vs[:,ydim]
-            ], dtype=numpy.float64)
+    xs = utils.mod2pi(vs[:,xdim])
+    ys = utils.mod2pi(vs[:,ydim])
     rfunc = render if 'xbound' in kwargs else mod2pi
     plot_args = (xs, ys) + tuple(args)
     rfunc(*plot_args, **kwargs)
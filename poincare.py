@@ -23,10 +23,27 @@ def section(ts, xs, interval=1.0, t_start=0.0):
     '''
     Simple, stupid Poincare section routine.
 
+    '''
+    return _section(ts, xs, _strobe_times(ts, interval, t_start))
+
+def linear(ts, xs, interval=1.0, t_start=0.0):
+    '''
+    Slightly smarter section routine, that linear interpolate frobs.
+
+    '''
+    return _linear(ts, xs, _strobe_times(ts, interval, t_start))
+
+def _strobe_times(ts, interval, t_start, first=0):
+    '''
+    Strobe times from the first-th one up to just past the end of ts.
+
     '''
     t_final = ts[-1]
     p_ct = int((t_final+interval - t_start) / interval)
-    ps = t_start + numpy.array(range(p_ct+1), dtype=numpy.float64) * interval
+    return t_start + numpy.array(range(first, p_ct+1), dtype=numpy.float64) * interval
+
+def _section(ts, xs, ps):
+    p_ct = len(ps) - 1
     i = 0
     j = 0
     points = numpy.empty((len(xs), xs[0].size), dtype=numpy.float64)
@@ -40,14 +57,8 @@ def section(ts, xs, interval=1.0, t_start=0.0):
             j += 1
     return points[:j]    
 
-def linear(ts, xs, interval=1.0, t_start=0.0):
-    '''
-    Slightly smarter section routine, that linear interpolate frobs.
-
-    '''
-    t_final = ts[-1]
-    p_ct = int((t_final+interval - t_start) / interval)
-    ps = t_start + numpy.array(range(p_ct+1), dtype=numpy.float64) * interval
+def _linear(ts, xs, ps):
+    p_ct = len(ps) - 1
     i = 0
     j = 0
     points = numpy.empty((len(xs), xs[0].size), dtype=numpy.float64)
@@ -62,6 +73,80 @@ def linear(ts, xs, interval=1.0, t_start=0.0):
             j += 1
     return points[:j]
 
+def stream(chunks, interval=1.0, t_start=0.0, interpolate=False):
+    '''
+    Section routine for trajectories streamed in chunks.
+
+    Consumes (ts, xs) chunks, as produced by rungekutta.rk4_chunks, and gives
+    the same points as section (or linear, if interpolate is set) would for the
+    whole trajectory, while only one chunk is held in memory at a time.
+
+    Returns: the section points as an (n x dim) array.
+    '''
+    take = _linear if interpolate else _section
+    found = []
+    t_prev = None
+    x_prev = None
+    for (ts, xs) in chunks:
+        points = xs.T
+        if t_prev is not None:
+            # Carry the last sample over so crossings between chunks count.
+            ts = numpy.concatenate(([t_prev], ts))
+            points = numpy.vstack((x_prev, points))
+        if len(ts) > 1:
+            # Skip the strobe times before this chunk, but generate the rest
+            # exactly as section would so boundary cases come out the same.
+            k0 = max(0, int(numpy.floor((ts[0] - t_start) / interval)) - 1)
+            found.append(take(ts, points, _strobe_times(ts, interval, t_start, k0)))
+        t_prev = ts[-1]
+        x_prev = points[-1]
+    if not found:
+        return numpy.empty((0, 0 if x_prev is None else len(x_prev)),
+                            dtype=numpy.float64)
+    return numpy.vstack(found)
+
+def strobe(traj, interval=1.0, t_start=0.0):
+    '''
+    Exact section routine for continuous trajectories.
+
+    Evaluates a dense-output trajectory (see rungekutta.dopri5) at every strobe
+    time, so no fixed-step samples need to be stored or interpolated.
+
+    Params:
+        traj        A callable trajectory, e.g. a rungekutta.Trajectory.
+        interval    The strobe period.
+        t_start     The first strobe time.
+
+    Returns: the section points as an (n x dim) array, like section and linear.
+    '''
+    t_final = traj.ts[-1]
+    p_ct = int(numpy.floor((t_final - t_start) / interval))
+    ps = t_start + numpy.arange(p_ct+1, dtype=numpy.float64) * interval
+    ps = ps[(ps >= traj.ts[0]) & (ps <= t_final)]
+    return traj(ps).T
+
+def plane(index, value, direction=1):
+    '''
+    Event function for the plane x[index] = value, for rungekutta.rk4/ark4.
+
+    '''
+    return rungekutta.event(lambda t, x: x[index] - value, direction=direction)
+
+def surface(dfunc, t0, x0, t_final, tol, index, value, direction=1, **kwargs):
+    '''
+    Surface of section for an autonomous flow, e.g. z = r-1 for Lorenz.
+
+    Integrates with rungekutta.ark4 and keeps only the crossings of the plane
+    x[index] = value, located by root finding, so the trajectory itself is
+    never stored. Extra keyword arguments go to ark4.
+
+    Returns: the section points as an (n x dim) array, like section and linear.
+    '''
+    _, _, [(_, ps)] = rungekutta.ark4(dfunc, t0, x0, t_final, tol,
+                                      events=[plane(index, value, direction)],
+                                      events_only=True, **kwargs)
+    return ps.T
+
 class TestPoincare(chaostest.TestCase):
     '''
     Unit tests for Poincare section routines.
@@ -88,5 +173,46 @@ class TestPoincare(chaostest.TestCase):
         expected = numpy.array([1.5, 70.5, 680.0], dtype=numpy.float64)
         self.assertArrayEqual(ps, expected)
 
+    def test_stream(self):
+        '''
+        Tests that streamed sections match sections of the whole trajectory.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        ts, xs = rungekutta.rk4(df, 0.0, x0, 0.01, 5000)
+        for interp in (False, True):
+            take = linear if interp else section
+            expected = take(ts, xs.T, interval=0.7, t_start=0.2)
+            chunks = rungekutta.rk4_chunks(df, 0.0, x0, 0.01, 5000, chunk_size=97)
+            ps = stream(chunks, interval=0.7, t_start=0.2, interpolate=interp)
+            self.assertEqual(ps.shape, expected.shape)
+            self.assertArrayEqual(ps[:,0], expected[:,0], places=10)
+
+    def test_strobe(self):
+        '''
+        Tests the dense section routine on a harmonic oscillator.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        traj = rungekutta.dopri5(df, 0.0, x0, 20.0, 1e-9, dense=True)
+        ps = strobe(traj, interval=2*numpy.pi, t_start=numpy.pi/2)
+        self.assertEqual(ps.shape, (3, 2))
+        self.assertArrayEqual(ps[:,0], numpy.zeros(3), places=6)
+        self.assertArrayEqual(ps[:,1], -numpy.ones(3), places=6)
+
+    def test_surface(self):
+        '''
+        Tests the surface of section on a harmonic oscillator.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        ps = surface(df, 0.0, x0, 20.0, 1e-8, 1, 0.0, direction=1)
+        self.assertEqual(ps.shape, (3, 2))
+        self.assertArrayEqual(ps[:,0], -numpy.ones(3), places=5)
+        self.assertArrayEqual(ps[:,1], numpy.zeros(3), places=8)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
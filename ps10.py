@@ -80,22 +80,27 @@ def pr2a(file_prefix=None):
 
 def pr2b(file_prefix=None):
     lfunc = lorenz.lorenz(16, 45, 4)
-    ts, xxs = rungekutta.rk4(
+    chunks = rungekutta.rk4_chunks(
                             lfunc,
                             0.0,
                             numpy.array([-13.0, -12.0, 52.0], dtype=numpy.float64),
                             0.0001,
-                            1000000
+                            1000000,
+                            discard_transient=100000
                         )
-    xs = xxs.transpose()
+    xs = numpy.hstack([xxs for (_, xxs) in chunks]).transpose()
     x0 = numpy.array([-30, -40, 4], dtype=numpy.float64)
-    d_cap = find_loglog_slope(xs[100000:400000,:], x0, file_prefix=suffixed(file_prefix, '_2b'))
+    d_cap = find_loglog_slope(xs[:300000,:], x0, file_prefix=suffixed(file_prefix, '_2b'))
     print 'Lorenz\tshort\td_cap = {0:.6f}'.format(d_cap)
     return xs 
 
 def pr2c(xs, file_prefix=None):
+    '''
+    Takes the post-transient trajectory returned by pr2b.
+
+    '''
     x0 = numpy.array([-30, -40, 4], dtype=numpy.float64)
-    d_cap = find_loglog_slope(xs[100000:,:], x0, file_prefix=suffixed(file_prefix, '_2c'))
+    d_cap = find_loglog_slope(xs, x0, file_prefix=suffixed(file_prefix, '_2c'))
     print 'Lorenz\tlong\td_cap = {0:.6f}'.format(d_cap)
 
 def extrema():
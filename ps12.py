@@ -14,19 +14,43 @@ import getopt
 import numpy
 import plot
 import rungekutta
+import symplectic
 import sys
 
-from mechanics import twobody
+from mechanics import energy, twobody
+from utils import suffixed
+
+def energy_drift(df, x0, file_prefix):
+    '''
+    Plots the energy error of RK4 against the symplectic integrators.
+
+    '''
+    e0 = energy(df.gravity, df.masses, x0)
+    ts, xs = rungekutta.rk4(df, 0, x0, 0.02, 20000)
+    _, _, leap = symplectic.leapfrog(df, 0, x0, 0.02, 20000, conserved=True)
+    _, _, fr = symplectic.forest_ruth(df, 0, x0, 0.02, 20000, conserved=True)
+    plot.render(ts, numpy.abs(energy(df.gravity, df.masses, xs) - e0), 'k',
+            ts, numpy.abs(leap['energy'] - e0), 'b',
+            ts, numpy.abs(fr['energy'] - e0), 'r',
+            xlabel='t',
+            ylabel='|E - E0|',
+            title='2-body Energy Error (dt = 0.02)',
+            legend=('RK4', 'Leapfrog', 'Forest-Ruth'),
+            file_prefix=suffixed(file_prefix, '_energy')
+        )
 
 def main(argv=None):
     argv = argv or sys.argv
     file_prefix = None
+    drift = False
 
     try:
-        options, args = getopt.getopt(argv[1:], 'f:')
+        options, args = getopt.getopt(argv[1:], 'f:e')
         for opt, arg in options:
             if opt == '-f':
                 file_prefix = arg 
+            if opt == '-e':
+                drift = True
     except getopt.GetoptError as err:
         print str(err)
         return 2
@@ -52,6 +76,9 @@ def main(argv=None):
             file_prefix=file_prefix
         )
 
+    if drift:
+        energy_drift(df, x0, file_prefix)
+
     return 0
 
 if __name__ == "__main__":
@@ -15,6 +15,7 @@ import multiprocessing
 import numpy
 import plot
 import rungekutta
+import symplectic
 import sys
 
 from mechanics import threebody
@@ -61,9 +62,11 @@ def pr2(file_prefix):
                 0, 20, 0,
                 0, -0.15, 0
             ], dtype=numpy.float64)
-    ts, xs = rungekutta.rk4(df, 0, x0, 0.005, 50000)
+    # The close encounters need far shorter steps than the rest of the run.
+    ts, xs = symplectic.adaptive(df, 0, x0, 250.0, 0.02, regularize=True)
     xs = xs.transpose()
-    plot.render(xs[:5500,0], xs[:5500,1], 'b', xs[:5500,6], xs[:5500,7], 'r', xs[:5500,12], xs[:5500,13], 'g',
+    early = ts <= 27.5
+    plot.render(xs[early,0], xs[early,1], 'b', xs[early,6], xs[early,7], 'r', xs[early,12], xs[early,13], 'g',
             xlabel='x (normalized AU)',
             ylabel='y (normalized AU)',
             title='3-body Orbital Interaction',
@@ -89,7 +92,8 @@ def pr3(file_prefix):
                     ], dtype=numpy.float64)
     df = threebody(1.0, 0.5, 0.5, 0.5)
     for i in xrange(8):
-        ts, xs = rungekutta.rk4(df, 0, ic(0.3*i + 20.0), 0.005, 8000)
+        ts, xs = symplectic.adaptive(df, 0, ic(0.3*i + 20.0), 40.0, 0.02,
+                                     regularize=True)
         xs = xs.transpose()
         plot.render(xs[:,0], xs[:,1], 'b', xs[:,6], xs[:,7], 'r', xs[:,12], xs[:,13], 'g',
                 xlabel='x (normalized AU)',
@@ -65,19 +65,15 @@ def pr1b(file_prefix, ts, points):
 def pr1c(file_prefix):
     drive_freq = 7.4246
     pfunc2 = pendulum.pendulum(0.1, 0.1, 0.25, ampl=1, freq=drive_freq)
-    ts2, xs2 = rungekutta.rk4(
+    chunks = rungekutta.rk4_chunks(
                             pfunc2, 
                             0.0, 
                             numpy.array([3.0, 0.1], dtype=numpy.float64), 
                             0.005, 
-                            1000000
+                            1000000,
+                            periodic_dims=(0,)
                         )
-    xs2[0,:] = numpy.array(
-                        [pendulum.mod2pi(x) for x in xs2[0,:]], 
-                        dtype=numpy.float64
-                    )
-    points2 = xs2.transpose()
-    ps3 = poincare.section(ts2, points2, interval=2*numpy.pi/drive_freq)
+    ps3 = poincare.stream(chunks, interval=2*numpy.pi/drive_freq)
     plot.mod2pi(
             ps3[:,0],
             ps3[:,1],
@@ -97,12 +93,9 @@ def pr1d(file_prefix):
                             0.0, 
                             numpy.array([3.0, 0.1], dtype=numpy.float64),
                             0.02,
-                            250000
+                            250000,
+                            periodic_dims=(0,)
                         )
-    xs3[0,:] = numpy.array(
-                        [pendulum.mod2pi(x) for x in xs3[0,:]], 
-                        dtype=numpy.float64
-                    )
     points3 = xs3.transpose()
     ps4 = poincare.section(ts3, points3, interval=2*numpy.pi/drive_freq)
     plot.mod2pi(
@@ -130,12 +123,9 @@ def pr2x(file_prefix, step, nsteps, title, suffix):
                             0.0,
                             numpy.array([3.0, 0.1], dtype=numpy.float64),
                             step,
-                            nsteps
+                            nsteps,
+                            periodic_dims=(0,)
                         )
-    xs[0,:] = numpy.array(
-                        [pendulum.mod2pi(x) for x in xs[0,:]],
-                        dtype=numpy.float64
-                    )
     points = xs.transpose()
     ps = poincare.linear(ts, points, interval=2*numpy.pi/drive_freq)
     plot.mod2pi(
@@ -149,6 +139,30 @@ def pr2x(file_prefix, step, nsteps, title, suffix):
             file_prefix=_suffixed(file_prefix, suffix)
         )
 
+def pr2c(file_prefix):
+    drive_freq = 7.4246
+    pfunc = pendulum.pendulum(0.1, 0.1, 0.25, ampl=1.0, freq=drive_freq)
+    traj = rungekutta.dopri5(
+                            pfunc,
+                            0.0,
+                            numpy.array([3.0, 0.1], dtype=numpy.float64),
+                            5000.0,
+                            1e-8,
+                            dense=True,
+                            periodic_dims=(0,)
+                        )
+    ps = poincare.strobe(traj, interval=2*numpy.pi/drive_freq)
+    plot.mod2pi(
+            ps[:,0],
+            ps[:,1],
+            'k.',
+            xlabel=r'$\theta$', 
+            ylabel=r'$\omega$', 
+            markersize=0.6,
+            title='Poincare section, dense output',
+            file_prefix=_suffixed(file_prefix, '_2c')
+        )
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -165,7 +179,8 @@ def main(argv=None):
             ('c', pr1c),
             ('d', pr1d),
             ('e', pr2a),
-            ('f', pr2b)
+            ('f', pr2b),
+            ('g', pr2c)
         )
     ops = 'bcdef'
 
@@ -18,22 +18,25 @@ def variational(a, r, b):
     '''
     Parameterizes the Lorenz variational equation.
 
-    Returns: a callable dfunc(t, xs) representing the Lorenz variational system.
-    Of course, the system is autonomous but t is included for compatibility with
-    ODE integrators.
+    Returns: a callable dfunc(t, xs, out=None) representing the Lorenz 
+    variational system. Of course, the system is autonomous but t is included 
+    for compatibility with ODE integrators. If out is given the derivative is 
+    written into it.
     '''
-    def _dfunc(_, xs):
-        ds = numpy.empty(12, dtype=numpy.float64)
-        vs = numpy.reshape(xs[3:], (3,3))
+    def _dfunc(_, xs, out=None):
+        ds = numpy.empty(12, dtype=numpy.float64) if out is None else out
         ds[0] = a*(xs[1]-xs[0])
         ds[1] = xs[0]*(r-xs[2]) - xs[1]
         ds[2] = xs[0]*xs[1] - b*xs[2]
-        ds[3:] = numpy.reshape(numpy.array([
-                            [-a, a, 0],
-                            [r, -1, -xs[0]],
-                            [xs[1], xs[0], -b]
-                        ], dtype=numpy.float64).dot(vs), (9,))
+
+        # Rows of the Jacobian times the matrix of variations, written out so
+        # that no 3x3 matrix has to be built on every call.
+        ds[3:6] = a*(xs[6:9]-xs[3:6])
+        ds[6:9] = (r-xs[2])*xs[3:6] - xs[6:9] - xs[0]*xs[9:12]
+        ds[9:12] = xs[1]*xs[3:6] + xs[0]*xs[6:9] - b*xs[9:12]
         return ds
+    _dfunc.inplace = True
+    _dfunc.kernel = ('variational', (a, r, b))
     return _dfunc
 
 def ic(x, y, z):
@@ -13,13 +13,12 @@ from __future__ import division
 import embed
 import getopt
 import numpy
-import pendulum
 import plot
 import re
 import sys
 
 from differentiation import ndiff, ddiff
-from utils import suffixed
+from utils import mod2pi, suffixed
 
 def construct_angular_velocity(ts, xs):
     '''
@@ -46,9 +45,7 @@ def construct_angular_velocity(ts, xs):
 def pr1(file_prefix=None):
     data = numpy.loadtxt('data/ps8/data1', dtype=numpy.float64)
     points = construct_angular_velocity(data[::30,1], data[::30,0])
-    thetas = numpy.array([
-                    pendulum.mod2pi(theta) for theta in points[:,1]
-                ], dtype=numpy.float64)
+    thetas = mod2pi(points[:,1])
     plot.render(
             thetas, 
             points[:,2], 
@@ -12,6 +12,7 @@ from __future__ import division
 
 import getopt
 import lorenz
+import lyapunov
 import numpy
 import plot
 import re
@@ -19,8 +20,6 @@ import rungekutta
 import sys
 import tispy
 
-from numpy.linalg import eig
-from ps7 import variational, ic, integrate
 from utils import suffixed
 
 def first_min(ms):
@@ -230,12 +229,9 @@ def pr6x1(tau, file_prefix=None):
         )    
 
 def pr6x2():
-    vfunc = variational(16, 45, 4)
-    x0 = ic(-13.0, -12.0, 52.0)
-    ts, xs = rungekutta.rk4(vfunc, 0.0, x0, 0.001, 30000)
-    ms = numpy.reshape(xs[3:,-1], (3,3))
-    ws, vs = eig(ms)
-    return [numpy.log(numpy.abs(w))/30000 for w in ws]
+    x0 = numpy.array([-13.0, -12.0, 52.0], dtype=numpy.float64)
+    spec = lyapunov.lorenz(16, 45, 4, x0, dt=0.001, t_final=1000.0, tol=1e-3)
+    return list(spec.exponents)
 
 def main(argv=None):
     if argv is None:
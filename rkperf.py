@@ -12,10 +12,21 @@ from __future__ import division
 
 import cProfile
 import getopt
+import json
+import kernels
 import lorenz
+import mechanics
+import multiprocessing
 import numpy
+import pendulum
+import platform
+import ps7
+import resource
+import rossler
 import rungekutta
+import symplectic
 import sys
+import time
 
 def runit():
     lfunc = lorenz.lorenz(16, 45, 4)
@@ -24,28 +35,310 @@ def runit():
                             0.0, 
                             numpy.array([-13.0, -12.0, 52.0], dtype=numpy.float64),
                             0.0001,
-                            100000
+                            100000,
+                            backend='numpy'
                         )
 
+BACKEND_SYSTEMS = (
+    ('lorenz', lambda: lorenz.lorenz(16, 45, 4), 
+        numpy.array([-13.0, -12.0, 52.0], dtype=numpy.float64)),
+    ('rossler', lambda: rossler.rossler(0.398, 2.0, 4.0),
+        numpy.array([0.1, 0.1, 0.1], dtype=numpy.float64)),
+    ('pendulum', lambda: pendulum.pendulum(0.1, 0.1, 0.25, ampl=1.0, freq=7.4246),
+        numpy.array([3.0, 0.1], dtype=numpy.float64)),
+    ('twobody', lambda: mechanics.twobody(1.0, 0.5, 0.5),
+        numpy.array([0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0], dtype=numpy.float64)),
+    ('threebody', lambda: mechanics.threebody(1.0, 0.5, 0.5, 0.5),
+        numpy.array([0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 20, 0, 0, -0.15, 0],
+                    dtype=numpy.float64)),
+    ('variational', lambda: ps7.variational(16, 45, 4), ps7.ic(-13.0, -12.0, 52.0)),
+)
+
+def compare_backends(nsteps=100000, dt=0.0001):
+    '''
+    Times rk4 on each built-in system with every available backend.
+
+    '''
+    backends = ('numpy', 'jit') if kernels.AVAILABLE else ('numpy',)
+    print '{0:<12}{1:>12}{2:>12}{3:>10}'.format('system', 'numpy (s)', 'jit (s)', 'speedup')
+    for (name, make, x0) in BACKEND_SYSTEMS:
+        dfunc = make()
+        times = {}
+        for backend in backends:
+            # Warm up first so compilation isn't counted.
+            rungekutta.rk4(dfunc, 0.0, x0, dt, 10, backend=backend)
+            start = time.time()
+            rungekutta.rk4(dfunc, 0.0, x0, dt, nsteps, backend=backend)
+            times[backend] = time.time() - start
+        if 'jit' in times:
+            print '{0:<12}{1:>12.3f}{2:>12.3f}{3:>9.1f}x'.format(
+                    name, times['numpy'], times['jit'], times['numpy']/times['jit'])
+        else:
+            print '{0:<12}{1:>12.3f}{2:>12}{3:>10}'.format(
+                    name, times['numpy'], 'n/a', 'n/a')
+
+# Benchmark spans for each of BACKEND_SYSTEMS: (t_final, step sizes,
+# tolerances). Step sizes go to the fixed-step integrators and tolerances to
+# the adaptive ones, over the same span of time. symplectic.adaptive takes
+# BENCH_ETAS, its steps as fractions of the encounter time, instead.
+BENCH_SPANS = {
+    'lorenz': (10.0, (0.005, 0.0005), (1e-4, 1e-8)),
+    'rossler': (50.0, (0.02, 0.002), (1e-4, 1e-8)),
+    'pendulum': (20.0, (0.01, 0.001), (1e-4, 1e-8)),
+    'twobody': (20.0, (0.01, 0.001), (1e-4, 1e-8)),
+    'threebody': (20.0, (0.01, 0.001), (1e-4, 1e-8)),
+    # The tangent vectors grow exponentially, and ark4 controls the absolute
+    # error, so this span has to stay short.
+    'variational': (1.0, (0.001, 0.0001), (1e-4, 1e-8)),
+}
+NBODY_SYSTEMS = ('twobody', 'threebody')
+BENCH_ETAS = (0.05, 0.005)
+
+def _fixed(integrator, **kwargs):
+    def _run(dfunc, x0, t_final, dt, **extra):
+        return integrator(dfunc, 0.0, x0, dt, int(round(t_final/dt)),
+                          **dict(kwargs, **extra))
+    return _run
+
+def _adaptive(integrator, **kwargs):
+    def _run(dfunc, x0, t_final, tol, **extra):
+        return integrator(dfunc, 0.0, x0, t_final, tol, **dict(kwargs, **extra))
+    return _run
+
+# Benchmark integrators: (name, 'dt', 'tol' or 'eta', runner, n-body only).
+BENCH_INTEGRATORS = (
+    ('rk4', 'dt', _fixed(rungekutta.rk4, backend='numpy'), False),
+    ('ark4', 'tol', _adaptive(rungekutta.ark4, backend='numpy'), False),
+    ('dopri5', 'tol', _adaptive(rungekutta.dopri5), False),
+    ('rosenbrock', 'tol', _adaptive(rungekutta.rosenbrock), False),
+    ('leapfrog', 'dt', _fixed(symplectic.leapfrog), True),
+    ('forest_ruth', 'dt', _fixed(symplectic.forest_ruth), True),
+    ('yoshida6', 'dt', _fixed(symplectic.yoshida6), True),
+    ('adaptive', 'eta', _adaptive(symplectic.adaptive), True),
+) + ((
+    ('rk4/jit', 'dt', _fixed(rungekutta.rk4, backend='jit'), False),
+    ('ark4/jit', 'tol', _adaptive(rungekutta.ark4, backend='jit'), False),
+) if kernels.AVAILABLE else ())
+
+BENCH_REPEAT = 5
+BENCH_MIN_TIME = 1.0
+
+# Differences in wall time below this many seconds are never regressions.
+BENCH_NOISE = 0.002
+
+def _counted(dfunc):
+    '''
+    Wraps dfunc to count its calls, keeping the attributes the integrators
+    look at. The wrapper has no kernel tag, so it always runs on NumPy.
+
+    '''
+    calls = [0]
+    def _dfunc(t, x, *args, **kwargs):
+        calls[0] += 1
+        return dfunc(t, x, *args, **kwargs)
+    for attr in ('inplace', 'gravity', 'masses', 'softening', 'jacobian'):
+        if hasattr(dfunc, attr):
+            setattr(_dfunc, attr, getattr(dfunc, attr))
+    return _dfunc, calls
+
+def _bench_case(case):
+    '''
+    Runs one benchmark case. Meant to run in a fresh worker process, so that
+    the peak resident memory it reports belongs to this case alone. Compiled
+    cases report no peak memory, since compiling their kernel takes far more
+    than running it.
+
+    '''
+    system, integrator, param, value = case
+    (_, make, x0) = [s for s in BACKEND_SYSTEMS if s[0] == system][0]
+    t_final = BENCH_SPANS[system][0]
+    run = [i for i in BENCH_INTEGRATORS if i[0] == integrator][0][2]
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Derivative evaluations of the NumPy cases are counted on a separate
+    # pass, which takes the same steps as the timed one and doubles as a
+    # warm up. The compiled loops can't be wrapped, and take slightly
+    # different adaptive steps, so they count their own in the timed runs.
+    compiled = integrator.endswith('/jit')
+    if not compiled:
+        counted, calls = _counted(make())
+        run(counted, x0, t_final, value, backend='numpy')
+    dfunc = make()
+    run(dfunc, x0, t_final/100, value)
+
+    # Fast cases are repeated, keeping the best time, so that they aren't
+    # swamped by timer noise.
+    wall = None
+    spent = 0.0
+    for _ in xrange(BENCH_REPEAT):
+        extra = {}
+        if compiled:
+            extra['stats'] = rungekutta.Stats()
+        start = time.time()
+        result = run(dfunc, x0, t_final, value, **extra)
+        elapsed = time.time() - start
+        wall = elapsed if wall is None else min(wall, elapsed)
+        spent += elapsed
+        if spent > BENCH_MIN_TIME:
+            break
+    steps = len(result[0]) - 1
+    nfev = extra['stats'].nfev if compiled else calls[0]
+    return {
+        'system': system,
+        'integrator': integrator,
+        'param': param,
+        'value': value,
+        'steps': steps,
+        'nfev': nfev,
+        'wall': wall,
+        'steps_per_sec': steps/wall,
+        'nfev_per_sec': nfev/wall,
+        'peak_mb': None if compiled else
+                (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0)/1024,
+    }
+
+def bench_cases(systems=None, integrators=None):
+    '''
+    Every (system, integrator, 'dt', 'tol' or 'eta', value) combination to
+    run.
+
+    '''
+    cases = []
+    for (name, _, _) in BACKEND_SYSTEMS:
+        (_, dts, tols) = BENCH_SPANS[name]
+        if systems and name not in systems:
+            continue
+        for (iname, param, _, nbody_only) in BENCH_INTEGRATORS:
+            if integrators and iname not in integrators:
+                continue
+            if nbody_only and name not in NBODY_SYSTEMS:
+                continue
+            values = {'dt': dts, 'tol': tols, 'eta': BENCH_ETAS}[param]
+            for value in values:
+                cases.append((name, iname, param, value))
+    return cases
+
+def bench(systems=None, integrators=None):
+    '''
+    Runs the benchmark suite, each case in its own worker process.
+
+    Returns: a dict with the run's environment under meta and one record per
+             case under results.
+    '''
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = [pool.apply(_bench_case, (case,))
+                    for case in bench_cases(systems, integrators)]
+    finally:
+        pool.close()
+        pool.join()
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'numba': kernels.numba.__version__ if kernels.AVAILABLE else None,
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+def _case_key(record):
+    return '{0}/{1}/{2}={3:g}'.format(record['system'], record['integrator'],
+                                      record['param'], record['value'])
+
+def compare(report, baseline, threshold=0.2):
+    '''
+    Compares wall times against a baseline report.
+
+    Returns: the keys of the cases that got slower by more than threshold.
+    '''
+    before = dict((_case_key(r), r) for r in baseline['results'])
+    regressions = []
+    for record in report['results']:
+        key = _case_key(record)
+        if key not in before:
+            continue
+        ratio = record['wall']/before[key]['wall']
+        record['baseline_ratio'] = ratio
+        if ratio > 1 + threshold and record['wall'] - before[key]['wall'] > BENCH_NOISE:
+            regressions.append(key)
+    return regressions
+
+def print_report(report):
+    print '{0:<40}{1:>9}{2:>10}{3:>12}{4:>12}{5:>9}{6:>8}'.format(
+            'case', 'steps', 'wall (s)', 'steps/s', 'nfev/s', 'peak MB', 'vs base')
+    for record in report['results']:
+        ratio = record.get('baseline_ratio')
+        peak = record['peak_mb']
+        print '{0:<40}{1:>9}{2:>10.3f}{3:>12.0f}{4:>12.0f}{5:>9}{6:>8}'.format(
+                _case_key(record),
+                record['steps'],
+                record['wall'],
+                record['steps_per_sec'],
+                record['nfev_per_sec'],
+                'n/a' if peak is None else '{0:.1f}'.format(peak),
+                '' if ratio is None else '{0:.2f}x'.format(ratio)
+            )
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
 
     filename = None
     sort = None
+    backends = False
+    suite = False
+    json_file = None
+    baseline_file = None
+    threshold = 0.2
+    systems = None
+    integrators = None
 
     try:
-        options, args = getopt.getopt(argv[1:], 'o:s:')
+        options, args = getopt.getopt(argv[1:], 'o:s:brj:c:t:S:I:')
         for opt, arg in options:
             if opt == '-o':
                 filename = arg 
             if opt == '-s':
                 sort = arg
+            if opt == '-b':
+                backends = True
+            if opt == '-r':
+                suite = True
+            if opt == '-j':
+                json_file = arg
+            if opt == '-c':
+                baseline_file = arg
+            if opt == '-t':
+                threshold = float(arg)
+            if opt == '-S':
+                systems = arg.split(',')
+            if opt == '-I':
+                integrators = arg.split(',')
     except getopt.GetoptError as err:
         print str(err)
         return 2
 
-    if sort is None:
+    if suite or json_file or baseline_file:
+        report = bench(systems, integrators)
+        regressions = []
+        if baseline_file is not None:
+            with open(baseline_file) as fp:
+                regressions = compare(report, json.load(fp), threshold)
+        print_report(report)
+        if json_file is not None:
+            with open(json_file, 'w') as fp:
+                json.dump(report, fp, indent=2, sort_keys=True)
+        if regressions:
+            print '{0} case(s) slower than the baseline by more than {1:.0%}:'.format(
+                    len(regressions), threshold)
+            for key in regressions:
+                print '    ' + key
+            return 1
+    elif backends:
+        compare_backends()
+    elif sort is None:
         cProfile.run(runit.func_code, filename)
     else:
         cProfile.run(runit.func_code, filename, sort)
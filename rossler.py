@@ -23,16 +23,31 @@ def rossler(a, b, c):
 
     Params: a, b, c for the new Rossler system.
 
-    Returns: a callable F(t, x) where 
+    Returns: a callable F(t, x, out=None) where 
         t   is not used in the Rossler system, but included for compatibility 
             with ODE integrators.
-        x   the current state vector of the system.
+        x   the current state vector of the system, or a (3 x n) block of
+            states (one per column) for rungekutta.rk4_ensemble.
+        out optionally, an array shaped like x to write the derivative into.
+    F carries a jacobian(t, x) attribute for rungekutta.rosenbrock.
     '''
-    return lambda _, x: numpy.array([
-                                    -(x[1]+x[2]),
-                                    x[0] + a*x[1],
-                                    b + x[2]*(x[0]-c)
-                                ], dtype=numpy.float64)
+    def _rossler(_, x, out=None):
+        if out is None:
+            out = numpy.empty(numpy.shape(x), dtype=numpy.float64)
+        out[0] = -(x[1]+x[2])
+        out[1] = x[0] + a*x[1]
+        out[2] = b + x[2]*(x[0]-c)
+        return out
+    def _jacobian(_, x):
+        return numpy.array([
+                    [0.0, -1.0, -1.0],
+                    [1.0, a, 0.0],
+                    [x[2], 0.0, x[0] - c]
+                ], dtype=numpy.float64)
+    _rossler.inplace = True
+    _rossler.kernel = ('rossler', (a, b, c))
+    _rossler.jacobian = _jacobian
+    return _rossler
 
 def main(argv=None):
     if argv is None:
@@ -70,7 +85,7 @@ def main(argv=None):
 
     rfunc = rossler(a, b, c)
     x0 = numpy.array([x, y, z], numpy.float64)
-    _, xs = rungekutta.ark4(rfunc, 0.0, x0, 20000.0, 0.00001)
+    _, xs = rungekutta.dopri5(rfunc, 0.0, x0, 20000.0, 0.00001)
     plot.render3d(xs[0,:], xs[1,:], xs[2,:], 'r.', 
                 xlabel='x',
                 ylabel='y',
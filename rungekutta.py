@@ -12,10 +12,15 @@
 from __future__ import division
 
 import chaostest
+import kernels
 import numpy
+import os
+import shutil
+import struct
+import tempfile
+import time
 import unittest
-
-from numpy.linalg import norm
+import utils
 
 def rk4(dfunc, t0, x0, dt, nsteps, **kwargs):
     '''
@@ -30,20 +35,224 @@ def rk4(dfunc, t0, x0, dt, nsteps, **kwargs):
         dt      Time step.
         nsteps  Number of steps to run the integrator.
 
+    Keyword arguments:
+        f_args  Extra positional arguments for dfunc.
+        inplace If True, dfunc is called as dfunc(t, x, *f_args, out=buf) and
+                must write the derivative into buf. Stage buffers are then
+                allocated once and reused, so steps allocate no arrays.
+                Defaults to dfunc.inplace, which the system factories set.
+        backend 'auto' (the default) runs the built-in systems as compiled
+                code when numba is installed, and everything else on NumPy.
+                'numpy' always uses NumPy, and 'jit' insists on compiled code.
+                See kernels.
+        events  A list of event functions g(t, x) returning a scalar. Each time
+                one of them changes sign the crossing is located by root
+                finding inside the step, and (t, x) there is recorded. See
+                event for the direction and terminal flags.
+        event_tol
+                Tolerance in t for locating events. Defaults to 1e-12.
+        events_only
+                If True, the trajectory isn't stored, and ts, xs hold only the
+                final state.
+        stats   A Stats object to fill in with counters for the run.
+        progress
+                A callable progress(stats) run every progress_every accepted
+                steps (default 1000). If it returns True, the run stops there
+                and the trajectory so far is returned. stats.cancelled records
+                whether that happened.
+        periodic_dims
+                Components that are periodic, such as the angle of a
+                pendulum, as for utils.periodic_dims. They are wrapped into
+                [0, period) in the results. rk4 and rk4_ensemble integrate
+                the unwrapped state and wrap the trajectory once at the end,
+                except with events, where the state is wrapped between steps
+                as in the adaptive integrators. dfunc must be periodic in
+                them then.
+
     Returns: a tuple (ts, xs) where
         ts      A vector (1 x nsteps) of time values.
         xs      The results (len(x0) x nsteps). 
+
+    If events are given, returns (ts, xs, found), where found holds a tuple
+    (t_events, x_events) for each event function, x_events laid out as xs.
     '''
+    monitor = _monitor(kwargs, t0, t0 + nsteps*dt)
+    if monitor is not None:
+        dfunc = monitor.wrap(dfunc)
+    if kwargs.get('events'):
+        return _rk4_events(dfunc, t0, x0, dt, nsteps, kwargs, monitor)
+
+    # The whole trajectory is at hand, so it is wrapped in one go at the end.
+    periodic = kwargs.get('periodic_dims')
+    compiled = kernels.rk4(dfunc, t0, x0, dt, nsteps, kwargs)
+    if compiled is not None:
+        utils.wrap(compiled[1], periodic)
+        return compiled
+
     ts = t0 + (numpy.array(range(nsteps+1), dtype=numpy.float64) * dt)
     xs = numpy.empty((len(x0), nsteps+1), dtype=numpy.float64)
     xs[:,0] = x0
     f_args = kwargs.get('f_args', tuple())
+    step = _stepper(dfunc, xs[:,0].shape, kwargs, f_args)
+
+    if monitor is None:
+        for i in xrange(1, nsteps+1):
+            step(xs[:,i-1], ts[i-1], dt, xs[:,i])
+        return ts, utils.wrap(xs, periodic)
+
+    for i in xrange(1, nsteps+1):
+        step(xs[:,i-1], ts[i-1], dt, xs[:,i])
+        if monitor.accept(ts[i], dt):
+            break
+    monitor.finish()
+    return ts[:i+1], utils.wrap(xs[:,:i+1], periodic)
+
+def _rk4_events(dfunc, t0, x0, dt, nsteps, kwargs, monitor):
+    '''
+    rk4 with event detection. Stores through a sink rather than preallocating
+    xs, since a terminal event may stop the run early.
+
+    '''
+    f_args = kwargs.get('f_args', tuple())
+    periodic = kwargs.get('periodic_dims')
+    xn = utils.wrap(numpy.array(x0, dtype=numpy.float64), periodic)
+    xnext = numpy.empty_like(xn)
+    step = _stepper(dfunc, xn.shape, kwargs, f_args)
+    detector = _Events(kwargs['events'], step, t0, xn, kwargs)
+    out = _sink(len(xn), kwargs)
+    out.append(t0, xn)
+
+    for i in xrange(1, nsteps+1):
+        tn = t0 + (i-1)*dt
+        tnext = t0 + i*dt
+        step(xn, tn, dt, xnext)
+        # Events see the step before it is wrapped, so that nothing appears
+        # to jump across the period.
+        hit = detector.check(tn, xn, tnext, xnext)
+        if hit is not None:
+            out.append(*hit)
+            break
+        xn, xnext = utils.wrap(xnext, periodic), xn
+        if periodic is not None:
+            detector.restart(tnext, xn)
+        out.append(tnext, xn)
+        if monitor is not None and monitor.accept(tnext, dt):
+            break
+
+    if monitor is not None:
+        monitor.finish()
+    ts, xs = out.arrays()
+    return ts, xs, detector.results()
+
+def rk4_ensemble(dfunc, t0, x0s, dt, nsteps, **kwargs):
+    '''
+    Runge-Kutta ODE integrator for an ensemble of initial conditions.
+
+    All trajectories are advanced together, so each stage costs one call to
+    dfunc no matter how many initial conditions there are.
+
+    Params:
+        dfunc   The batched derivative function, passed as a callable
+                dfunc(t, xs, *f_args). xs is a (dim x n_traj) block with one
+                state per column, and the result must have the same shape.
+                The system factories in lorenz, rossler, pendulum and mechanics
+                all accept blocks like this.
+        t0      Initial t-value for the integrator.
+        x0s     Initial x-values, as an (n_traj x dim) array.
+        dt      Time step.
+        nsteps  Number of steps to run the integrator.
+
+    Accepts the same keyword arguments as rk4.
+
+    Returns: a tuple (ts, xs) where
+        ts      A vector (1 x nsteps) of time values.
+        xs      The results (n_traj x dim x nsteps). xs[i] is the trajectory
+                that rk4 would return for x0s[i].
+    '''
+    x0s = numpy.asarray(x0s, dtype=numpy.float64)
+    n_traj, dim = x0s.shape
+    ts = t0 + (numpy.array(range(nsteps+1), dtype=numpy.float64) * dt)
+    xs = numpy.empty((n_traj, dim, nsteps+1), dtype=numpy.float64)
+    xs[:,:,0] = x0s
+    f_args = kwargs.get('f_args', tuple())
 
+    # Carry the state as (dim x n_traj) so that x[0], x[1], ... are rows and
+    # the scalar system definitions broadcast over the whole ensemble.
+    xn = numpy.array(x0s.T)
+    xnext = numpy.empty_like(xn)
+    step = _stepper(dfunc, xn.shape, kwargs, f_args)
     for i in xrange(1, nsteps+1):
-        xs[:,i] = _rk4_step(dfunc, xs[:,i-1], ts[i-1], dt, *f_args)
+        step(xn, ts[i-1], dt, xnext)
+        xn, xnext = xnext, xn
+        xs[:,:,i] = xn.T
 
+    utils.wrap(xs.transpose((1, 0, 2)), kwargs.get('periodic_dims'))
     return ts, xs
 
+def rk4_chunks(dfunc, t0, x0, dt, nsteps, **kwargs):
+    '''
+    Runge-Kutta ODE integrator that streams its results in fixed-size chunks.
+
+    Produces the same samples as rk4 without ever holding the whole trajectory,
+    so long runs can be consumed in bounded memory.
+
+    Params: as for rk4.
+
+    Keyword arguments (in addition to those of rk4):
+        chunk_size          The number of samples per chunk. Defaults to 4096.
+        discard_transient   Number of initial steps to integrate but not
+                            output. Defaults to 0.
+        keep_every          Only output every keep_every-th step after the
+                            transient. Defaults to 1.
+        final_only          If True, output only the final state.
+
+    periodic_dims wraps each chunk as it is handed out.
+
+    Yields: tuples (ts, xs) where ts is a vector of time values and xs holds
+            the matching states (len(x0) x len(ts)). Each chunk is a fresh
+            array that the consumer may keep.
+    '''
+    chunk_size = kwargs.get('chunk_size', 4096)
+    discard = kwargs.get('discard_transient', 0)
+    keep_every = kwargs.get('keep_every', 1)
+    final_only = kwargs.get('final_only', False)
+    f_args = kwargs.get('f_args', tuple())
+    periodic = kwargs.get('periodic_dims')
+
+    xn = numpy.array(x0, dtype=numpy.float64)
+    xnext = numpy.empty_like(xn)
+    step = _stepper(dfunc, xn.shape, kwargs, f_args)
+
+    if final_only:
+        for i in xrange(1, nsteps+1):
+            step(xn, t0 + (i-1)*dt, dt, xnext)
+            xn, xnext = xnext, xn
+        yield (numpy.array([t0 + nsteps*dt], dtype=numpy.float64),
+                utils.wrap(numpy.reshape(xn, (len(xn), 1)), periodic))
+        return
+
+    def _new_chunk():
+        return (numpy.empty(chunk_size, dtype=numpy.float64),
+                numpy.empty((len(xn), chunk_size), dtype=numpy.float64))
+
+    ts, xs = _new_chunk()
+    fill = 0
+    for i in xrange(nsteps+1):
+        if i > 0:
+            step(xn, t0 + (i-1)*dt, dt, xnext)
+            xn, xnext = xnext, xn
+        if i < discard or (i-discard) % keep_every != 0:
+            continue
+        ts[fill] = t0 + i*dt
+        xs[:,fill] = xn
+        fill += 1
+        if fill == chunk_size:
+            yield ts, utils.wrap(xs, periodic)
+            ts, xs = _new_chunk()
+            fill = 0
+    if fill > 0:
+        yield ts[:fill], utils.wrap(xs[:,:fill], periodic)
+
 def _rk4_step(dfunc, xn, tn, dt, *args):
     '''
     Runs one step of Runge-Kutta 4th order and returns the result.
@@ -55,36 +264,104 @@ def _rk4_step(dfunc, xn, tn, dt, *args):
     k4 = dfunc(tn + dt, xn + k3*dt, *args)
     return xn + dt*((k1 + 2*k2 + 2*k3 + k4) / 6)
 
+def _rk4_buffers(shape):
+    '''
+    Allocates the stage buffers used by _rk4_step_inplace.
+
+    '''
+    return tuple(numpy.empty(shape, dtype=numpy.float64) for _ in xrange(5))
+
+def _rk4_step_inplace(dfunc, xn, tn, dt, bufs, out, *args):
+    '''
+    Runs one step of Runge-Kutta 4th order without allocating any arrays.
+
+    dfunc must support the out= protocol. bufs comes from _rk4_buffers, and the
+    result is written to out, which may be the same array as xn.
+    '''
+    k1, k2, k3, k4, xt = bufs
+    dfunc(tn, xn, *args, out=k1)
+    numpy.multiply(k1, dt/2, out=xt)
+    xt += xn
+    dfunc(tn + (dt/2), xt, *args, out=k2)
+    numpy.multiply(k2, dt/2, out=xt)
+    xt += xn
+    dfunc(tn + (dt/2), xt, *args, out=k3)
+    numpy.multiply(k3, dt, out=xt)
+    xt += xn
+    dfunc(tn + dt, xt, *args, out=k4)
+
+    # Fold k1 + 2*k2 + 2*k3 + k4 into k2 so nothing new is needed.
+    k2 += k3
+    k2 *= 2
+    k2 += k1
+    k2 += k4
+    k2 *= dt/6
+    numpy.add(xn, k2, out=out)
+    return out
+
+def _stepper(dfunc, shape, kwargs, f_args):
+    '''
+    Builds a step(xn, tn, dt, out) callable for the fixed-step integrators.
+
+    Uses the allocation-free path when the inplace keyword (or dfunc.inplace)
+    says dfunc supports the out= protocol.
+    '''
+    if kwargs.get('inplace', getattr(dfunc, 'inplace', False)):
+        bufs = _rk4_buffers(shape)
+        def _step(xn, tn, dt, out):
+            return _rk4_step_inplace(dfunc, xn, tn, dt, bufs, out, *f_args)
+    else:
+        def _step(xn, tn, dt, out):
+            out[...] = _rk4_step(dfunc, xn, tn, dt, *f_args)
+            return out
+    return _step
+
 ARK4_SAFETY_SCALE_FACTOR = numpy.float64(0.98)
 
 def ark4(dfunc, t0, x0, t_final, tol, **kwargs):
     '''
     Adaptive 4th-order Runge-Kutta ODE integrator.
 
+    Accepts the f_args, inplace, backend, events, stats, progress and
+    periodic_dims keyword arguments of rk4, and out_file as for dopri5. With
+    events, returns (ts, xs, found) as rk4 does. In stats, rejected counts the
+    trial steps retried with a doubled step size because their error estimate
+    was zero.
     '''
+    events = kwargs.get('events')
+    monitor = _monitor(kwargs, t0, t_final)
+    if monitor is not None:
+        dfunc = monitor.wrap(dfunc)
+    periodic = kwargs.get('periodic_dims')
+    compiled = kernels.ark4(dfunc, t0, x0, t_final, tol, kwargs,
+                            ARK4_SAFETY_SCALE_FACTOR)
+    if compiled is not None:
+        utils.wrap(compiled[1], periodic)
+        return compiled
+
     dt = numpy.float64(0.01)
     f_args = kwargs.get('f_args', tuple())
+    step = _stepper(dfunc, (len(x0),), kwargs, f_args)
+
+    # Scratch space for the step doubling error estimate, reused every step.
+    x_full, x_half, x_dbl, x_err = _rk4_buffers((len(x0),))[:4]
 
-    # Take a guess at the number of data points we'll need, and reshape data
-    # arrays as necessary.
-    npoints = int(150*(t_final-t0))
-    xs = numpy.empty((npoints, len(x0)), dtype=numpy.float64)
-    ts = numpy.empty(npoints, dtype=numpy.float64)
-    xs[0,:] = x0
-    ts[0] = t0
+    xn = utils.wrap(numpy.array(x0, dtype=numpy.float64), periodic)
+    xnext = numpy.empty_like(xn)
+    tn = t0
+    out = _sink(len(x0), kwargs)
+    out.append(tn, xn)
+    detector = _Events(events, step, tn, xn, kwargs) if events else None
 
     def _step_until_nonzero_error(xn, tn, hn, count):
         if count == 10:
             return (hn, tol)
-        x1 = _rk4_step(dfunc, xn, tn, hn, *f_args)
-        x2 = _rk4_step(
-                    dfunc, 
-                    _rk4_step(dfunc, xn, tn, hn/2, *f_args), 
-                    tn + (hn/2), 
-                    hn/2, 
-                    *f_args
-                )
-        delta = norm(x1-x2, ord=numpy.inf) 
+        x1 = step(xn, tn, hn, x_full)
+        x2 = step(step(xn, tn, hn/2, x_half), tn + (hn/2), hn/2, x_dbl)
+        numpy.subtract(x1, x2, out=x_err)
+        delta = numpy.abs(x_err, out=x_err).max()
+        if delta == 0.0 and monitor is not None:
+            monitor.reject()
         return (hn, delta) if delta != 0.0 else _step_until_nonzero_error(
                                                                     xn, 
                                                                     tn, 
@@ -92,26 +369,901 @@ def ark4(dfunc, t0, x0, t_final, tol, **kwargs):
                                                                     count+1
                                                                 )
 
-    p_i = 0
-    while ts[p_i] < t_final:
-        (dt, delta) = _step_until_nonzero_error(xs[p_i,:], ts[p_i], dt, 0)
+    while tn < t_final:
+        (dt, delta) = _step_until_nonzero_error(xn, tn, dt, 0)
         dt = ARK4_SAFETY_SCALE_FACTOR * dt * (
                     abs(tol/delta) ** (0.2 if tol >=delta else 0.25)
                 ) 
 
-        dt = min(dt, t_final - ts[p_i])
-        p_i = p_i + 1
+        dt = min(dt, t_final - tn)
+        step(xn, tn, dt, xnext)
+        if detector is not None:
+            hit = detector.check(tn, xn, tn + dt, xnext)
+            if hit is not None:
+                out.append(*hit)
+                break
+        xn, xnext = utils.wrap(xnext, periodic), xn
+        tn = tn + dt
+        if detector is not None and periodic is not None:
+            detector.restart(tn, xn)
+        out.append(tn, xn)
+        if monitor is not None and monitor.accept(tn, dt):
+            break
+
+    if monitor is not None:
+        monitor.finish()
+    if detector is not None:
+        return out.arrays() + (detector.results(),)
+    return out.arrays()
+
+def event(func, direction=0, terminal=False):
+    '''
+    Marks func(t, x) as an event function for rk4 and ark4.
+
+    Params:
+        func        Scalar function of the state whose zeros are the events.
+        direction   0 records every crossing, 1 only those where func goes
+                    from negative to positive, and -1 only the opposite.
+        terminal    If True, integration stops at the first recorded crossing,
+                    which then becomes the last point of the trajectory.
+
+    Returns: func, with the direction and terminal attributes set.
+    '''
+    func.direction = direction
+    func.terminal = terminal
+    return func
+
+# Iteration cap for the event root finder. Illinois converges superlinearly,
+# so this is only a guard against pathological event functions.
+EVENT_MAX_ITER = 100
+
+class _Events(object):
+    '''
+    Watches a list of event functions for sign changes across each step.
+
+    A crossing is located by the Illinois variant of regula falsi on the step
+    size h in (0, dt], evaluating the event function on a fresh step of size h
+    from the start of the step, so event states are as accurate as the
+    integrator itself.
+    '''
+    def __init__(self, events, step, t0, x0, kwargs):
+        self.events = list(events)
+        self.step = step
+        self.tol = kwargs.get('event_tol', 1e-12)
+        self.g = [g(t0, x0) for g in self.events]
+        self.found = [_ChunkedColumns(len(x0), chunk=256) for _ in self.events]
+        self.xh = numpy.empty_like(x0)
+
+    def _crossed(self, g, glo, ghi):
+        direction = getattr(g, 'direction', 0)
+        if direction >= 0 and glo < 0 <= ghi:
+            return True
+        if direction <= 0 and glo > 0 >= ghi:
+            return True
+        return False
+
+    def _refine(self, g, tn, xn, dt, glo, ghi):
+        '''
+        Returns the step size h at which g crosses zero, to within self.tol.
+
+        '''
+        lo, hi = 0.0, dt
+        side = 0
+        for _ in xrange(EVENT_MAX_ITER):
+            if hi - lo <= self.tol:
+                break
+            h = hi - ghi*(hi - lo)/(ghi - glo)
+            if not lo < h < hi:
+                h = (lo + hi)/2
+            gh = g(tn + h, self.step(xn, tn, h, self.xh))
+            if gh == 0:
+                return h
+            if (gh < 0) == (ghi < 0):
+                hi, ghi = h, gh
+                if side == 1:
+                    glo /= 2
+                side = 1
+            else:
+                lo, glo = h, gh
+                if side == -1:
+                    ghi /= 2
+                side = -1
+        return hi
+
+    def check(self, tn, xn, tnext, xnext):
+        '''
+        Records the events between (tn, xn) and (tnext, xnext).
+
+        Returns: (t, x) of a terminal event, or None to keep going.
+        '''
+        gnext = [g(tnext, xnext) for g in self.events]
+        hits = []
+        for (i, g) in enumerate(self.events):
+            if self._crossed(g, self.g[i], gnext[i]):
+                h = self._refine(g, tn, xn, tnext - tn, self.g[i], gnext[i])
+                hits.append((h, i))
+        self.g = gnext
+        for (h, i) in sorted(hits):
+            x = self.step(xn, tn, h, self.xh).copy()
+            self.found[i].append(tn + h, x)
+            if getattr(self.events[i], 'terminal', False):
+                return (tn + h, x)
+        return None
+
+    def restart(self, t, x):
+        '''
+        Evaluates the event functions afresh at (t, x), where the next step
+        starts from. Called after the state is wrapped, so that the jump
+        across the period doesn't look like a crossing.
+
+        '''
+        self.g = [g(t, x) for g in self.events]
+
+    def results(self):
+        return [found.arrays() for found in self.found]
+
+class Stats(object):
+    '''
+    Counters for one integrator run.
+
+    Pass an instance as the stats keyword argument of rk4, ark4, dopri5 or
+    rosenbrock, and read it while the run is going (from a progress callback)
+    or afterwards.
+
+    Attributes:
+        nfev        Derivative evaluations.
+        accepted    Accepted steps.
+        rejected    Trial steps that were thrown away.
+        min_dt      Smallest accepted step size.
+        max_dt      Largest accepted step size.
+        dfunc_time  Seconds spent in the derivative function, always 0 for
+                    the compiled loops of kernels.
+        total_time  Seconds spent in the integrator, dfunc included.
+        t           Time reached so far, out of [t0, t_final].
+        cancelled   Whether a progress callback stopped the run.
+        njev        Jacobian evaluations (rosenbrock only).
+        nlu         Factorizations of the iteration matrix (rosenbrock only).
+    '''
+    def __init__(self):
+        self.nfev = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.min_dt = numpy.inf
+        self.max_dt = 0.0
+        self.dfunc_time = 0.0
+        self.total_time = 0.0
+        self.t0 = None
+        self.t = None
+        self.t_final = None
+        self.cancelled = False
+        self.njev = 0
+        self.nlu = 0
+
+    @property
+    def overhead(self):
+        '''
+        Seconds spent in the integrator itself rather than in dfunc.
+
+        '''
+        return self.total_time - self.dfunc_time
+
+    @property
+    def fraction(self):
+        '''
+        Fraction of [t0, t_final] covered so far.
+
+        '''
+        if self.t_final == self.t0:
+            return 1.0
+        return (self.t - self.t0) / (self.t_final - self.t0)
+
+    @property
+    def steps_per_sec(self):
+        return self.accepted / self.total_time if self.total_time else 0.0
+
+    @property
+    def nfev_per_sec(self):
+        return self.nfev / self.total_time if self.total_time else 0.0
+
+    def __str__(self):
+        return ('t={0:g} ({1:.1%}) steps={2} rejected={3} nfev={4} '
+                'dt=[{5:g}, {6:g}] {7:.0f} steps/s, {8:.0f} nfev/s, '
+                '{9:.2f}s in dfunc, {10:.2f}s overhead').format(
+                    self.t, self.fraction, self.accepted, self.rejected,
+                    self.nfev, self.min_dt, self.max_dt, self.steps_per_sec,
+                    self.nfev_per_sec, self.dfunc_time, self.overhead)
+
+class _Monitor(object):
+    '''
+    Fills in a Stats object for a run and calls its progress callback.
+
+    '''
+    def __init__(self, stats, progress, every, t0, t_final):
+        self.stats = stats
+        self.progress = progress
+        self.every = every
+        stats.t0 = stats.t = t0
+        stats.t_final = t_final
+        self.start = time.time()
+
+    def wrap(self, dfunc):
+        '''
+        Wraps dfunc to count and time its calls.
+
+        '''
+        stats = self.stats
+        clock = time.time
+        def _dfunc(*args, **kwargs):
+            start = clock()
+            result = dfunc(*args, **kwargs)
+            stats.dfunc_time += clock() - start
+            stats.nfev += 1
+            return result
+        # The compiled loops never call dfunc, and fill in stats themselves.
+        for attr in ('inplace', 'kernel'):
+            if hasattr(dfunc, attr):
+                setattr(_dfunc, attr, getattr(dfunc, attr))
+        return _dfunc
+
+    def accept(self, t, dt):
+        '''
+        Records an accepted step. Returns True if the run should stop.
+
+        '''
+        stats = self.stats
+        stats.accepted += 1
+        stats.t = t
+        stats.min_dt = min(stats.min_dt, dt)
+        stats.max_dt = max(stats.max_dt, dt)
+        if self.progress is not None and stats.accepted % self.every == 0:
+            stats.total_time = time.time() - self.start
+            if self.progress(stats):
+                stats.cancelled = True
+                return True
+        return False
+
+    def reject(self):
+        self.stats.rejected += 1
+
+    def finish(self):
+        self.stats.total_time = time.time() - self.start
+
+def _monitor(kwargs, t0, t_final):
+    '''
+    Builds a _Monitor if stats or progress were requested, or returns None.
+
+    '''
+    stats = kwargs.get('stats')
+    progress = kwargs.get('progress')
+    if stats is None and progress is None:
+        return None
+    return _Monitor(stats if stats is not None else Stats(), progress,
+                    kwargs.get('progress_every', 1000), t0, t_final)
+
+# Dormand-Prince 5(4) tableau. DOPRI_B is the 5th order solution, which is also
+# the last row of DOPRI_A (first same as last), and DOPRI_E is the difference
+# between the 5th and embedded 4th order weights.
+DOPRI_C = numpy.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1], dtype=numpy.float64)
+DOPRI_A = numpy.array([
+            [0, 0, 0, 0, 0, 0, 0],
+            [1/5, 0, 0, 0, 0, 0, 0],
+            [3/40, 9/40, 0, 0, 0, 0, 0],
+            [44/45, -56/15, 32/9, 0, 0, 0, 0],
+            [19372/6561, -25360/2187, 64448/6561, -212/729, 0, 0, 0],
+            [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656, 0, 0],
+            [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0],
+        ], dtype=numpy.float64)
+DOPRI_B = DOPRI_A[6]
+DOPRI_E = numpy.array([
+            71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40
+        ], dtype=numpy.float64)
+
+# Weights for the 4th order continuous extension of Dormand-Prince, from
+# Hairer's DOPRI5 code.
+DOPRI_D = numpy.array([
+            -12715105075/11282082432, 0, 87487479700/32700410799,
+            -10690763975/1880347072, 701980252875/199316789632,
+            -1453857185/822651844, 69997945/29380423
+        ], dtype=numpy.float64)
+
+# Step size controller parameters (Hairer, Norsett & Wanner, section II.4).
+DOPRI_SAFETY_FACTOR = 0.9
+DOPRI_MIN_SCALE = 0.2
+DOPRI_MAX_SCALE = 10.0
+DOPRI_PI_BETA = 0.04
+
+def dopri5(dfunc, t0, x0, t_final, tol, **kwargs):
+    '''
+    Adaptive Dormand-Prince 5(4) ODE integrator.
+
+    A drop-in replacement for ark4. The embedded 4th order solution gives the
+    error estimate for free, and the last stage of each step is reused as the
+    first stage of the next, so an accepted step costs 6 derivative
+    evaluations. Step sizes come from a PI controller.
+
+    Params:
+        dfunc   The derivative function to integrate, as for rk4.
+        t0      Initial t-value for the integrator.
+        x0      Initial x-value.
+        t_final Final t-value.
+        tol     Default for both the absolute and relative error tolerance.
+
+    Keyword arguments:
+        atol    Absolute tolerance, a scalar or one value per component.
+        rtol    Relative tolerance, a scalar or one value per component.
+        dt      Initial step size. Estimated from dfunc if not given.
+        dt_max  Upper bound on the step size.
+        f_args  Extra positional arguments for dfunc.
+        inplace Whether dfunc supports the out= protocol, as for rk4.
+        dense   If True, return a Trajectory that can be evaluated at any time
+                in [t0, t_final] instead of only at the accepted steps.
+        out_file
+                If given, the states are appended to this .npy file as they
+                are computed, and xs is returned as a read-only memmap of it.
+                Memory use then does not grow with the length of the run.
+        stats, progress
+                As for rk4. rejected counts the steps that failed the error
+                test.
+        periodic_dims
+                As for rk4. Each accepted state is wrapped, and so are the
+                states a dense Trajectory returns.
+
+    Returns: a tuple (ts, xs) where
+        ts      A vector (1 x n) of the accepted time values.
+        xs      The results (len(x0) x n).
+    or a Trajectory if dense output was requested.
+    '''
+    f_args = kwargs.get('f_args', tuple())
+    atol = numpy.asarray(kwargs.get('atol', tol), dtype=numpy.float64)
+    rtol = numpy.asarray(kwargs.get('rtol', tol), dtype=numpy.float64)
+    dt_max = kwargs.get('dt_max', abs(t_final - t0))
+    periodic = kwargs.get('periodic_dims')
+    monitor = _monitor(kwargs, t0, t_final)
+    if monitor is not None:
+        dfunc = monitor.wrap(dfunc)
+    deriv = _deriv(dfunc, kwargs, f_args)
+
+    dim = len(x0)
+    ks = numpy.empty((7, dim), dtype=numpy.float64)
+    xn = utils.wrap(numpy.array(x0, dtype=numpy.float64), periodic)
+    x1 = numpy.empty(dim, dtype=numpy.float64)
+    xt = numpy.empty(dim, dtype=numpy.float64)
+    xa = numpy.empty(dim, dtype=numpy.float64)
+    sc = numpy.empty(dim, dtype=numpy.float64)
+
+    tn = t0
+    deriv(tn, xn, ks[0])
+    dt = kwargs.get('dt')
+    if dt is None:
+        dt = _dopri_initial_step(deriv, tn, xn, ks[0], atol, rtol, ks[1], xt)
+    dt = min(dt, dt_max)
+
+    out = _sink(dim, kwargs)
+    out.append(tn, xn)
+    dense = kwargs.get('dense', False)
+    if dense:
+        coeffs = _ChunkedColumns(5*dim)
+        rcont = numpy.empty((5, dim), dtype=numpy.float64)
+
+    expo = 0.2 - 0.75*DOPRI_PI_BETA
+    err_old = 1e-4
+    rejected = False
+    while tn < t_final:
+        dt = min(dt, t_final - tn)
+        if tn + dt == tn:
+            raise RuntimeError('dopri5: step size underflow at t={0}'.format(tn))
+
+        # The last stage is evaluated at the 5th order solution itself, and is
+        # reused as the first stage of the next step (FSAL).
+        for i in xrange(1, 7):
+            numpy.dot(DOPRI_A[i,:i], ks[:i], out=xt)
+            xt *= dt
+            xt += xn
+            deriv(tn + DOPRI_C[i]*dt, xt, ks[i])
+        x1[:] = xt
+
+        numpy.dot(DOPRI_E, ks, out=xt)
+        xt *= dt
+        numpy.abs(xn, out=sc)
+        numpy.maximum(sc, numpy.abs(x1, out=xa), out=sc)
+        sc *= rtol
+        sc += atol
+        xt /= sc
+        err = numpy.sqrt(xt.dot(xt) / dim)
+
+        scale = (err ** expo) if err > 0.0 else 0.0
+        if err <= 1.0:
+            # Accept, and take the next step size from the PI controller.
+            scale = scale / (err_old ** DOPRI_PI_BETA) / DOPRI_SAFETY_FACTOR
+            scale = max(1/DOPRI_MAX_SCALE, min(1/DOPRI_MIN_SCALE, scale))
+            err_old = max(err, 1e-4)
+            if dense:
+                _dopri_dense_coeffs(xn, x1, ks, dt, rcont)
+                coeffs.append(tn, rcont.ravel())
+            tn = tn + dt
+            xn, x1 = utils.wrap(x1, periodic), xn
+            ks[0] = ks[6]
+            out.append(tn, xn)
+            if monitor is not None and monitor.accept(tn, dt):
+                break
+            dt_new = dt / scale
+            if rejected:
+                dt_new = min(dt_new, dt)
+            rejected = False
+        else:
+            dt_new = dt / min(1/DOPRI_MIN_SCALE, scale/DOPRI_SAFETY_FACTOR)
+            rejected = True
+            if monitor is not None:
+                monitor.reject()
+        dt = min(dt_new, dt_max)
+
+    if monitor is not None:
+        monitor.finish()
+
+    if dense:
+        ts, xs = out.arrays()
+        _, cs = coeffs.arrays()
+        return Trajectory(ts, xs, numpy.reshape(cs.T, (len(ts)-1, 5, dim)),
+                          periodic)
+    return out.arrays()
+
+def _dopri_dense_coeffs(x0, x1, ks, dt, rcont):
+    '''
+    Fills rcont with the interpolation coefficients for one accepted step.
+
+    Source: Hairer, Norsett and Wanner. Solving Ordinary Differential Equations
+            I, 2nd edition. Section II.6, "Dense Output".
+    '''
+    rcont[0] = x0
+    numpy.subtract(x1, x0, out=rcont[1])
+    numpy.multiply(ks[0], dt, out=rcont[2])
+    rcont[2] -= rcont[1]
+    numpy.multiply(ks[6], -dt, out=rcont[3])
+    rcont[3] += rcont[1]
+    rcont[3] -= rcont[2]
+    numpy.dot(DOPRI_D, ks, out=rcont[4])
+    rcont[4] *= dt
+
+class Trajectory(object):
+    '''
+    A continuous solution from dopri5, built from per-step interpolants.
+
+    Call it with a time or an array of times to get the interpolated states.
+    The accepted steps are still available as ts and xs, and unpacking a
+    Trajectory gives (ts, xs) just like the non-dense integrators.
+    '''
+    def __init__(self, ts, xs, coeffs, periodic_dims=None):
+        '''
+        Params:
+            ts      The accepted time values (1 x n+1).
+            xs      The states at the accepted times (dim x n+1).
+            coeffs  Interpolation coefficients for each step (n x 5 x dim).
+            periodic_dims
+                    Components to wrap in the interpolated states, as for
+                    utils.periodic_dims.
+        '''
+        self.ts = ts
+        self.xs = xs
+        self.coeffs = coeffs
+        self.periodic_dims = periodic_dims
+
+    def __iter__(self):
+        return iter((self.ts, self.xs))
+
+    def __call__(self, t):
+        '''
+        Evaluates the trajectory.
+
+        Params:
+            t   A time or an array of m times in [ts[0], ts[-1]].
+
+        Returns: the state (dim,) for a scalar t, or the states (dim x m).
+                 A run with t_final == t0 has no steps to interpolate, and
+                 gives its only state.
+        '''
+        tq = numpy.asarray(t, dtype=numpy.float64)
+        scalar = tq.ndim == 0
+        tq = numpy.atleast_1d(tq)
+        if len(self.ts) == 1:
+            xq = numpy.repeat(self.xs[:,:1], len(tq), axis=1)
+            return xq[:,0] if scalar else xq
+        idx = numpy.searchsorted(self.ts, tq, side='right') - 1
+        idx = numpy.clip(idx, 0, len(self.ts)-2)
+        hs = self.ts[idx+1] - self.ts[idx]
+        theta = ((tq - self.ts[idx]) / hs)[:,numpy.newaxis]
+        theta1 = 1 - theta
+        cs = self.coeffs[idx]
+        xq = cs[:,0] + theta*(cs[:,1] + theta1*(cs[:,2] + theta*(cs[:,3] + 
+                                                           theta1*cs[:,4])))
+        # Each step starts wrapped but may run past the period.
+        xq = utils.wrap(xq.T, self.periodic_dims)
+        return xq[:,0] if scalar else xq
+
+    def resample(self, dt, t_start=None):
+        '''
+        Evaluates the trajectory on an evenly spaced grid.
+
+        Returns: a tuple (ts, xs) laid out as rk4 returns them.
+        '''
+        t_start = self.ts[0] if t_start is None else t_start
+        count = int(numpy.floor((self.ts[-1] - t_start) / dt)) + 1
+        ts = t_start + numpy.arange(count, dtype=numpy.float64) * dt
+        return ts, self(ts)
+
+def _dopri_initial_step(deriv, t0, x0, f0, atol, rtol, f1, x1):
+    '''
+    Guesses an initial step size for dopri5 from two derivative evaluations.
+
+    Source: Hairer, Norsett and Wanner. Solving Ordinary Differential Equations
+            I, 2nd edition. Section II.4, "Starting Step Size".
+    '''
+    sc = atol + rtol*numpy.abs(x0)
+    d0 = numpy.sqrt(numpy.mean((x0/sc) ** 2))
+    d1 = numpy.sqrt(numpy.mean((f0/sc) ** 2))
+    h0 = 0.01*d0/d1 if d0 > 1e-5 and d1 > 1e-5 else 1e-6
+    x1[:] = x0 + h0*f0
+    deriv(t0 + h0, x1, f1)
+    d2 = numpy.sqrt(numpy.mean(((f1-f0)/sc) ** 2)) / h0
+    if max(d1, d2) <= 1e-15:
+        h1 = max(1e-6, h0*1e-3)
+    else:
+        h1 = (0.01/max(d1, d2)) ** 0.2
+    return min(100*h0, h1)
+
+# Rosenbrock 2(3) pair of Shampine and Reichelt, the formula behind MATLAB's
+# ode23s. ROS_D is the diagonal coefficient of W = I - ROS_D*dt*J.
+ROS_D = 1/(2 + numpy.sqrt(2))
+ROS_E32 = 6 + numpy.sqrt(2)
+ROS_SAFETY_FACTOR = 0.9
+ROS_MIN_SCALE = 0.2
+ROS_MAX_SCALE = 5.0
+
+# An accepted step whose controller wants to grow dt by less than ROS_HOLD
+# keeps its step size, so that W can be reused if J is kept as well.
+ROS_HOLD = 1.2
+ROS_JAC_EVERY = 1
+
+# Relative perturbation for finite-difference Jacobians, about sqrt(eps).
+FD_STEP = 1.5e-8
+
+def rosenbrock(dfunc, t0, x0, t_final, tol, **kwargs):
+    '''
+    Adaptive linearly-implicit Rosenbrock 2(3) integrator for stiff systems.
+
+    Each step solves three linear systems with the same matrix
+    W = I - d*dt*J, where J is the Jacobian of dfunc, so the step size is
+    limited by accuracy rather than stability, and stiff stretches that force
+    ark4 or dopri5 into thousands of tiny steps are covered in tens. An
+    accepted step costs two derivative evaluations, the third being reused as
+    the first of the next step, plus the Jacobian and one factorization of W.
+
+    The formula needs an accurate J, so by default it is evaluated at every
+    step. Systems whose Jacobian is constant or varies slowly can keep it for
+    several steps with jac_every; W is then only factored again when dt
+    changes, and dt is held while the controller would only grow it a little.
+
+    Params:
+        dfunc   The derivative function to integrate, as for rk4.
+        t0      Initial t-value for the integrator.
+        x0      Initial x-value.
+        t_final Final t-value.
+        tol     Default for both the absolute and relative error tolerance.
+
+    Keyword arguments:
+        jacobian
+                Where J comes from. A callable jac(t, x, *f_args) returning the
+                (dim x dim) matrix, 'fd' for finite differences or 'dual' for
+                dual.jacobian. Defaults to the jacobian attribute of dfunc,
+                which the system factories provide, and to 'fd' without one.
+                Finite differences take one call of dfunc on a (dim x dim)
+                block of perturbed states, so dfunc must accept blocks.
+        jac_every
+                Accepted steps between Jacobian evaluations (default 1). A
+                kept J is evaluated again after any rejected step.
+        atol, rtol, dt, dt_max, f_args, inplace, out_file, stats, progress,
+        periodic_dims
+                As for dopri5. stats also counts the Jacobian evaluations
+                (njev) and factorizations of W (nlu).
+
+    Returns: a tuple (ts, xs) as dopri5 does.
+    '''
+    f_args = kwargs.get('f_args', tuple())
+    atol = numpy.asarray(kwargs.get('atol', tol), dtype=numpy.float64)
+    rtol = numpy.asarray(kwargs.get('rtol', tol), dtype=numpy.float64)
+    dt_max = kwargs.get('dt_max', abs(t_final - t0))
+    jac_every = kwargs.get('jac_every', ROS_JAC_EVERY)
+    source = kwargs.get('jacobian', getattr(dfunc, 'jacobian', 'fd'))
+    monitor = _monitor(kwargs, t0, t_final)
+    if monitor is not None:
+        dfunc = monitor.wrap(dfunc)
+    deriv = _deriv(dfunc, kwargs, f_args)
+
+    dim = len(x0)
+    jacobian = _jacobian(source, dfunc, deriv, dim, kwargs, f_args)
+    periodic = kwargs.get('periodic_dims')
+    xn = utils.wrap(numpy.array(x0, dtype=numpy.float64), periodic)
+    x1 = numpy.empty(dim, dtype=numpy.float64)
+    xt = numpy.empty(dim, dtype=numpy.float64)
+    f0 = numpy.empty(dim, dtype=numpy.float64)
+    f1 = numpy.empty(dim, dtype=numpy.float64)
+    f2 = numpy.empty(dim, dtype=numpy.float64)
+    ks = numpy.empty((3, dim), dtype=numpy.float64)
+    ft = numpy.empty(dim, dtype=numpy.float64)
+    sc = numpy.empty(dim, dtype=numpy.float64)
+    eye = numpy.eye(dim)
+
+    tn = t0
+    deriv(tn, xn, f0)
+    dt = kwargs.get('dt')
+    if dt is None:
+        dt = _dopri_initial_step(deriv, tn, xn, f0, atol, rtol, f1, xt)
+    dt = min(dt, dt_max)
+
+    out = _sink(dim, kwargs)
+    out.append(tn, xn)
+
+    jac = None
+    jac_age = 0
+    w_dt = None
+    expo = 1/3
+    while tn < t_final:
+        dt = min(dt, t_final - tn)
+        if tn + dt == tn:
+            raise RuntimeError('rosenbrock: step size underflow at '
+                               't={0}'.format(tn))
+        if jac is None:
+            # The time derivative of dfunc enters the stages like J does.
+            jac = jacobian(tn, xn, f0)
+            t_step = FD_STEP*max(abs(tn), 1.0)
+            deriv(tn + t_step, xn, ft)
+            ft -= f0
+            ft /= t_step
+            jac_age = 0
+            w_dt = None
+            if monitor is not None:
+                monitor.stats.njev += 1
+        if dt != w_dt:
+            # numpy has no separate LU solve, so W is factored once into its
+            # inverse and every stage is a product with that.
+            winv = numpy.linalg.inv(eye - (ROS_D*dt)*jac)
+            w_dt = dt
+            if monitor is not None:
+                monitor.stats.nlu += 1
+
+        hdt = ROS_D*dt
+        numpy.dot(winv, f0 + hdt*ft, out=ks[0])
+        numpy.multiply(ks[0], dt/2, out=xt)
+        xt += xn
+        deriv(tn + dt/2, xt, f1)
+        numpy.dot(winv, f1 - ks[0], out=ks[1])
+        ks[1] += ks[0]
+        numpy.multiply(ks[1], dt, out=x1)
+        x1 += xn
+        deriv(tn + dt, x1, f2)
+        numpy.dot(winv, f2 - ROS_E32*(ks[1] - f1) - 2*(ks[0] - f0) + hdt*ft,
+                  out=ks[2])
 
-        # Check p_i against the size of data arrays. Resize if necessary
-        if p_i >= npoints:
-            npoints *= 2
-            xs = numpy.resize(xs, (npoints, len(x0)))
-            ts = numpy.resize(ts, (npoints,))
+        numpy.dot((1.0, -2.0, 1.0), ks, out=xt)
+        xt *= dt/6
+        numpy.abs(xn, out=sc)
+        numpy.maximum(sc, numpy.abs(x1, out=f1), out=sc)
+        sc *= rtol
+        sc += atol
+        xt /= sc
+        err = numpy.sqrt(xt.dot(xt) / dim)
 
-        xs[p_i,:] = _rk4_step(dfunc, xs[p_i-1,:], ts[p_i-1], dt, *f_args)
-        ts[p_i] = ts[p_i-1] + dt
+        if err <= 1.0:
+            tn = tn + dt
+            xn, x1 = utils.wrap(x1, periodic), xn
+            f0, f2 = f2, f0
+            out.append(tn, xn)
+            if monitor is not None and monitor.accept(tn, dt):
+                break
+            jac_age += 1
+            if jac_age >= jac_every:
+                jac = None
+            scale = (ROS_SAFETY_FACTOR / err**expo if err > 0.0
+                     else ROS_MAX_SCALE)
+            scale = min(ROS_MAX_SCALE, scale)
+            # W is factored again anyway once J is, so there's no point
+            # holding dt then.
+            if jac is None or scale < 1.0 or scale > ROS_HOLD:
+                dt = dt*scale
+        else:
+            if monitor is not None:
+                monitor.reject()
+            if jac_age > 0:
+                jac = None
+            dt = dt*max(ROS_MIN_SCALE, ROS_SAFETY_FACTOR / err**expo)
+        dt = min(dt, dt_max)
 
-    return ts[:p_i+1], numpy.transpose(xs[:p_i+1])
+    if monitor is not None:
+        monitor.finish()
+    return out.arrays()
+
+def _jacobian(source, dfunc, deriv, dim, kwargs, f_args):
+    '''
+    Builds a jac(t, x, fx) callable returning the (dim x dim) Jacobian of dfunc
+    at x, where fx is dfunc(t, x), for rosenbrock.
+
+    '''
+    if callable(source):
+        return lambda t, x, _: source(t, x, *f_args)
+    if source == 'dual':
+        import dual
+        return lambda t, x, _: dual.jacobian(dfunc, t, x, **kwargs)
+    if source != 'fd':
+        raise ValueError('unknown jacobian source {0!r}'.format(source))
+
+    block = numpy.empty((dim, dim), dtype=numpy.float64)
+    fs = numpy.empty((dim, dim), dtype=numpy.float64)
+    diag = numpy.arange(dim)
+    def _fd(t, x, fx):
+        # Column j of the block is x with component j perturbed, so the whole
+        # Jacobian takes a single evaluation of dfunc.
+        block[:] = x[:,numpy.newaxis]
+        block[diag, diag] += FD_STEP*numpy.maximum(numpy.abs(x), 1.0)
+        steps = block[diag, diag] - x
+        deriv(t, block, fs)
+        numpy.subtract(fs, fx[:,numpy.newaxis], out=fs)
+        return numpy.divide(fs, steps, out=fs)
+    return _fd
+
+def _deriv(dfunc, kwargs, f_args):
+    '''
+    Builds a deriv(t, x, out) callable that writes dfunc(t, x) into out.
+
+    '''
+    if kwargs.get('inplace', getattr(dfunc, 'inplace', False)):
+        def _eval(t, x, out):
+            return dfunc(t, x, *f_args, out=out)
+    else:
+        def _eval(t, x, out):
+            out[...] = dfunc(t, x, *f_args)
+            return out
+    return _eval
+
+class _ChunkedColumns(object):
+    '''
+    Accumulates (t, x) samples in fixed-size blocks, so that growing the
+    trajectory never copies what has already been stored.
+
+    '''
+    def __init__(self, dim, chunk=4096):
+        self.dim = dim
+        self.chunk = chunk
+        self.blocks = []
+        self.tblocks = []
+        self.fill = chunk
+
+    def append(self, t, x):
+        if self.fill == self.chunk:
+            self.blocks.append(
+                    numpy.empty((self.chunk, self.dim), dtype=numpy.float64))
+            self.tblocks.append(numpy.empty(self.chunk, dtype=numpy.float64))
+            self.fill = 0
+        self.blocks[-1][self.fill] = x
+        self.tblocks[-1][self.fill] = t
+        self.fill += 1
+
+    def arrays(self):
+        '''
+        Returns (ts, xs) with xs laid out (dim x n), as the integrators do.
+
+        '''
+        n = (len(self.blocks)-1)*self.chunk + self.fill
+        ts = numpy.empty(n, dtype=numpy.float64)
+        xs = numpy.empty((self.dim, n), dtype=numpy.float64)
+        for (i, (tb, xb)) in enumerate(zip(self.tblocks, self.blocks)):
+            lo = i*self.chunk
+            hi = min(n, lo + self.chunk)
+            ts[lo:hi] = tb[:hi-lo]
+            xs[:,lo:hi] = xb[:hi-lo].T
+        return ts, xs
+
+class _LastColumn(object):
+    '''
+    Keeps only the most recent (t, x) sample.
+
+    '''
+    def __init__(self, dim):
+        self.t = numpy.empty(1, dtype=numpy.float64)
+        self.x = numpy.empty((dim, 1), dtype=numpy.float64)
+
+    def append(self, t, x):
+        self.t[0] = t
+        self.x[:,0] = x
+
+    def arrays(self):
+        return self.t, self.x
+
+# Room reserved for the .npy header of memmapped output, so that the final
+# shape can be written in place once the number of steps is known.
+NPY_HEADER_SIZE = 128
+
+class _MemmapColumns(object):
+    '''
+    Accumulates (t, x) samples straight into a .npy file laid out (dim x n).
+
+    The file is stored column-major, so each sample is one contiguous column.
+    Only the chunk currently being filled is mapped, and growing the file never
+    touches what has already been written. Times are kept in memory.
+    '''
+    def __init__(self, dim, filename, chunk=65536):
+        self.dim = dim
+        self.filename = filename
+        self.chunk = chunk
+        self.tblocks = []
+        self.block = None
+        self.base = 0
+        self.n = 0
+        with open(filename, 'wb') as fp:
+            _write_npy_header(fp, (dim, 0))
+
+    def _grow(self):
+        if self.block is not None:
+            self.block.flush()
+        self.base = self.n
+        self.block = numpy.memmap(
+                        self.filename,
+                        dtype=numpy.float64,
+                        mode='r+',
+                        offset=NPY_HEADER_SIZE + self.base*self.dim*8,
+                        shape=(self.chunk, self.dim)
+                    )
+        self.tblocks.append(numpy.empty(self.chunk, dtype=numpy.float64))
+
+    def append(self, t, x):
+        i = self.n - self.base
+        if self.block is None or i == self.chunk:
+            self._grow()
+            i = 0
+        self.block[i] = x
+        self.tblocks[-1][i] = t
+        self.n += 1
+
+    def arrays(self):
+        '''
+        Finalizes the file and returns (ts, xs), where xs is a memmap of it.
+
+        '''
+        if self.block is not None:
+            self.block.flush()
+            self.block = None
+        with open(self.filename, 'r+b') as fp:
+            _write_npy_header(fp, (self.dim, self.n))
+            fp.truncate(NPY_HEADER_SIZE + self.n*self.dim*8)
+        ts = numpy.concatenate(self.tblocks)[:self.n] if self.tblocks else \
+                numpy.empty(0, dtype=numpy.float64)
+        return ts, numpy.load(self.filename, mmap_mode='r')
+
+def _write_npy_header(fp, shape):
+    '''
+    Writes a version 1.0 .npy header for a Fortran-ordered float64 array,
+    padded to exactly NPY_HEADER_SIZE bytes.
+
+    '''
+    header = "{{'descr': '{0}', 'fortran_order': True, 'shape': ({1}, {2}), }}".format(
+                numpy.lib.format.dtype_to_descr(numpy.dtype(numpy.float64)),
+                shape[0],
+                shape[1]
+            )
+    header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+    fp.seek(0)
+    fp.write(numpy.lib.format.MAGIC_PREFIX + b'\x01\x00' + 
+                struct.pack('<H', len(header)) + header.encode('latin1'))
+
+def _sink(dim, kwargs):
+    '''
+    Picks where an adaptive integrator stores its accepted steps.
+
+    '''
+    filename = kwargs.get('out_file')
+    if kwargs.get('events_only'):
+        return _LastColumn(dim)
+    if filename is None:
+        return _ChunkedColumns(dim)
+    return _MemmapColumns(dim, filename)
 
 class TestRungeKutta(chaostest.TestCase):
     '''
@@ -173,5 +1325,350 @@ class TestRungeKutta(chaostest.TestCase):
         ts2, xs2 = ark4(pfunc, t0, x0, 10.0, 0.001)
         self.assertAlmostEqual(xs1[0,-1], xs2[0,-1], delta=0.01)
 
+    def test_backends(self):
+        '''
+        Tests that compiled kernels agree with the NumPy path.
+
+        '''
+        if not kernels.AVAILABLE:
+            self.skipTest('numba is not installed')
+        import lorenz
+        lfunc = lorenz.lorenz(16.0, 45.0, 4.0)
+        x0 = numpy.array([-13.0, -12.0, 52.0], dtype=numpy.float64)
+        _, xs1 = rk4(lfunc, 0.0, x0, 0.001, 1000, backend='numpy')
+        _, xs2 = rk4(lfunc, 0.0, x0, 0.001, 1000, backend='jit')
+        self.assertArrayEqual(xs1[2], xs2[2], places=8)
+        ts1, xs1 = ark4(lfunc, 0.0, x0, 1.0, 1e-4, backend='numpy')
+        ts2, xs2 = ark4(lfunc, 0.0, x0, 1.0, 1e-4, backend='jit')
+        self.assertEqual(len(ts1), len(ts2))
+        self.assertArrayEqual(xs1[2], xs2[2], places=6)
+        # Small blocks give the same steps as one big one.
+        chunk = kernels.KERNEL_CHUNK
+        kernels.KERNEL_CHUNK = 7
+        try:
+            ts3, xs3 = ark4(lfunc, 0.0, x0, 1.0, 1e-4, backend='jit')
+        finally:
+            kernels.KERNEL_CHUNK = chunk
+        self.assertTrue(numpy.array_equal(ts2, ts3))
+        self.assertTrue(numpy.array_equal(xs2, xs3))
+        # Counted by the compiled loop, as in the NumPy one.
+        stats1, stats2 = Stats(), Stats()
+        ark4(lfunc, 0.0, x0, 1.0, 1e-4, backend='numpy', stats=stats1)
+        ark4(lfunc, 0.0, x0, 1.0, 1e-4, backend='jit', stats=stats2)
+        self.assertEqual(stats2.accepted, len(ts2) - 1)
+        self.assertEqual(stats2.nfev, 16*stats2.accepted)
+        self.assertEqual((stats1.nfev, stats1.accepted),
+                         (stats2.nfev, stats2.accepted))
+        self.assertEqual(stats2.dfunc_time, 0.0)
+        stats = Stats()
+        rk4(lfunc, 0.0, x0, 0.001, 1000, backend='jit', stats=stats)
+        self.assertEqual((stats.nfev, stats.accepted), (4000, 1000))
+
+    def test_ensemble(self):
+        '''
+        Tests that the ensemble integrator agrees with single runs of RK4.
+
+        '''
+        pfunc = lambda t, x: numpy.array([
+                                        x[1],
+                                        numpy.cos(7.4246*t) - 0.025*x[1] -
+                                        0.98*numpy.sin(x[0]),
+                                    ], dtype=numpy.float64)
+        x0s = numpy.array([[3.0, 0.1], [0.2, 0.0], [-1.0, 2.0]])
+        ts, xs = rk4_ensemble(pfunc, 0.0, x0s, 0.01, 500)
+        self.assertEqual(xs.shape, (3, 2, 501))
+        for (x0, ens) in zip(x0s, xs):
+            ts1, xs1 = rk4(pfunc, 0.0, x0, 0.01, 500)
+            self.assertArrayEqual(ts, ts1)
+            self.assertArrayEqual(ens[0,:], xs1[0,:], places=10)
+            self.assertArrayEqual(ens[1,:], xs1[1,:], places=10)
+
+    def test_inplace(self):
+        '''
+        Tests that the out= stepping path agrees with the allocating path.
+
+        '''
+        def pfunc(t, x, out=None):
+            if out is None:
+                out = numpy.empty(2, dtype=numpy.float64)
+            out[0] = x[1]
+            out[1] = numpy.cos(7.4246*t) - 0.025*x[1] - 0.98*numpy.sin(x[0])
+            return out
+        x0 = numpy.array([3.0, 0.1], dtype=numpy.float64)
+        _, xs1 = rk4(pfunc, 0.0, x0, 0.01, 1000, inplace=False)
+        _, xs2 = rk4(pfunc, 0.0, x0, 0.01, 1000, inplace=True)
+        self.assertArrayEqual(xs1[0,:], xs2[0,:], places=10)
+        ts1, xs1 = ark4(pfunc, 0.0, x0, 10.0, 0.001, inplace=False)
+        ts2, xs2 = ark4(pfunc, 0.0, x0, 10.0, 0.001, inplace=True)
+        self.assertEqual(len(ts1), len(ts2))
+        self.assertArrayEqual(xs1[0,:], xs2[0,:], places=8)
+
+    def test_chunks(self):
+        '''
+        Tests that streamed chunks reproduce the full rk4 trajectory.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        ts, xs = rk4(df, 0.0, x0, 0.01, 1000)
+        chunks = list(rk4_chunks(df, 0.0, x0, 0.01, 1000, chunk_size=64,
+                                    discard_transient=100, keep_every=3))
+        self.assertEqual(len(chunks[0][0]), 64)
+        cts = numpy.concatenate([c[0] for c in chunks])
+        cxs = numpy.hstack([c[1] for c in chunks])
+        self.assertArrayEqual(cts, ts[100::3])
+        self.assertArrayEqual(cxs[0], xs[0,100::3], places=10)
+        [(tf, xf)] = list(rk4_chunks(df, 0.0, x0, 0.01, 1000, final_only=True))
+        self.assertAlmostEqual(tf[0], ts[-1])
+        self.assertArrayEqual(xf[:,0], xs[:,-1], places=10)
+
+    def test_dopri5_exp(self):
+        '''
+        Tests Dormand-Prince against the exponential function.
+
+        '''
+        df = lambda t, x: x
+        ts, xs = dopri5(df, 0.0, numpy.array([1], dtype=numpy.float64), 4.0, 1e-8)
+        self.assertEqual(ts[-1], 4.0)
+        self.assertAlmostEqual(xs[0,-1] / numpy.exp(4), 1.0, delta=1e-6)
+
+    def test_dopri5_cost(self):
+        '''
+        Tests that Dormand-Prince needs fewer evaluations than step doubling.
+
+        '''
+        counts = [0]
+        def pfunc(t, x):
+            counts[0] += 1
+            return numpy.array([
+                            x[1],
+                            numpy.cos(7.4246*t) - 0.025*x[1] - 0.98*numpy.sin(x[0])
+                        ], dtype=numpy.float64)
+        x0 = numpy.array([3.0, 0.1], dtype=numpy.float64)
+        _, xs1 = ark4(pfunc, 0.0, x0, 10.0, 1e-6)
+        ark4_count, counts[0] = counts[0], 0
+        _, xs2 = dopri5(pfunc, 0.0, x0, 10.0, 1e-6)
+        self.assertLess(3*counts[0], ark4_count)
+        self.assertAlmostEqual(xs1[0,-1], xs2[0,-1], delta=1e-3)
+
+    def test_dopri5_component_tolerances(self):
+        '''
+        Tests per-component absolute tolerances.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        atol = numpy.array([1e-10, 1e-10], dtype=numpy.float64)
+        ts, xs = dopri5(df, 0.0, x0, 10.0, 1e-3, atol=atol, rtol=1e-10)
+        self.assertAlmostEqual(xs[0,-1], numpy.cos(10.0), places=7)
+        self.assertAlmostEqual(xs[1,-1], -numpy.sin(10.0), places=7)
+
+    def test_out_file(self):
+        '''
+        Tests that memmapped output matches in-memory output.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for integrator in (ark4, dopri5):
+                filename = os.path.join(tmpdir, 'traj.npy')
+                ts1, xs1 = integrator(df, 0.0, x0, 100.0, 1e-6)
+                ts2, xs2 = integrator(df, 0.0, x0, 100.0, 1e-6, out_file=filename)
+                self.assertTrue(isinstance(xs2, numpy.memmap))
+                self.assertEqual(xs2.shape, xs1.shape)
+                self.assertArrayEqual(ts1, ts2)
+                self.assertArrayEqual(xs1[0], xs2[0])
+                self.assertArrayEqual(numpy.load(filename)[1], xs1[1])
+                del xs2
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_dopri5_dense(self):
+        '''
+        Tests dense output between the accepted steps.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        traj = dopri5(df, 0.0, x0, 10.0, 1e-9, dense=True)
+        ts, xs = traj
+        self.assertEqual(xs.shape, (2, len(ts)))
+        tq = numpy.linspace(0.0, 10.0, 1001)
+        xq = traj(tq)
+        self.assertEqual(xq.shape, (2, 1001))
+        self.assertArrayEqual(xq[0], numpy.cos(tq), places=6)
+        self.assertArrayEqual(xq[1], -numpy.sin(tq), places=6)
+        self.assertArrayEqual(traj(ts[5]), xs[:,5], places=12)
+        # A run without steps still evaluates at its one point.
+        traj = dopri5(df, 0.0, x0, 0.0, 1e-9, dense=True)
+        self.assertArrayEqual(traj(0.0), x0)
+        self.assertEqual(traj([0.0, 0.0]).shape, (2, 2))
+
+    def test_events(self):
+        '''
+        Tests event location, direction and terminal flags.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        # x = cos(t) crosses zero at pi/2 + k*pi, downwards on even k.
+        down = event(lambda t, x: x[0], direction=-1)
+        both = lambda t, x: x[0]
+        ts, xs, found = rk4(df, 0.0, x0, 0.01, 2000, events=[down, both])
+        (td, xd), (tb, xb) = found
+        self.assertArrayEqual(td, numpy.pi/2 + 2*numpy.pi*numpy.arange(3), places=7)
+        self.assertArrayEqual(tb, numpy.pi/2 + numpy.pi*numpy.arange(6), places=7)
+        self.assertEqual(xd.shape, (2, 3))
+        self.assertArrayEqual(xd[1], -numpy.ones(3), places=7)
+        self.assertEqual(xs.shape, (2, 2001))
+
+        stop = event(lambda t, x: x[1] - 0.5, terminal=True)
+        for result in (rk4(df, 0.0, x0, 0.01, 2000, events=[stop]),
+                       ark4(df, 0.0, x0, 20.0, 1e-8, events=[stop])):
+            ts, xs, [(te, xe)] = result
+            t_stop = 7*numpy.pi/6
+            self.assertEqual(len(te), 1)
+            self.assertAlmostEqual(te[0], t_stop, places=5)
+            self.assertAlmostEqual(ts[-1], t_stop, places=5)
+            self.assertAlmostEqual(xs[1,-1], 0.5, places=6)
+
+        ts, xs, [(te, xe)] = ark4(df, 0.0, x0, 20.0, 1e-8, events=[both],
+                                  events_only=True)
+        self.assertEqual(xs.shape, (2, 1))
+        self.assertAlmostEqual(ts[0], 20.0)
+        self.assertArrayEqual(te, numpy.pi/2 + numpy.pi*numpy.arange(6), places=5)
+
+    def test_stats(self):
+        '''
+        Tests the stats counters and cancelling from a progress callback.
+
+        '''
+        df = lambda t, x: numpy.array([x[1], -x[0]], dtype=numpy.float64)
+        x0 = numpy.array([1.0, 0.0], dtype=numpy.float64)
+        stats = Stats()
+        ts, xs = rk4(df, 0.0, x0, 0.01, 500, stats=stats)
+        self.assertEqual(stats.accepted, 500)
+        self.assertEqual(stats.nfev, 2000)
+        self.assertAlmostEqual(stats.min_dt, 0.01)
+        self.assertAlmostEqual(stats.fraction, 1.0)
+        self.assertFalse(stats.cancelled)
+        self.assertTrue(stats.total_time >= stats.dfunc_time > 0.0)
+
+        stats = Stats()
+        ts, xs = dopri5(df, 0.0, x0, 10.0, 1e-8, stats=stats)
+        self.assertEqual(stats.accepted, len(ts) - 1)
+        self.assertEqual(stats.nfev, 6*(stats.accepted + stats.rejected) + 2)
+        self.assertTrue(stats.min_dt <= stats.max_dt)
+
+        seen = []
+        def _progress(st):
+            seen.append(st.t)
+            return st.t >= 3.0
+        for integrator in (ark4, dopri5):
+            stats = Stats()
+            ts, xs = integrator(df, 0.0, x0, 10.0, 1e-8, stats=stats,
+                                progress=_progress, progress_every=10)
+            self.assertTrue(stats.cancelled)
+            self.assertTrue(3.0 <= ts[-1] < 10.0)
+            self.assertEqual(xs.shape, (2, len(ts)))
+            self.assertEqual(ts[-1], stats.t)
+        ts, xs = rk4(df, 0.0, x0, 0.01, 1000, progress=_progress,
+                     progress_every=100)
+        self.assertEqual(len(ts), 301)
+        self.assertArrayEqual(seen[-3:], [1.0, 2.0, 3.0], places=10)
+
+    def test_periodic(self):
+        '''
+        Tests wrapping the angle of a pendulum that swings over the top.
+
+        '''
+        import pendulum
+        pfunc = pendulum.pendulum(0.1, 0.1, 0.0)
+        x0 = numpy.array([0.0, 25.0], dtype=numpy.float64)
+        _, free = rk4(pfunc, 0.0, x0, 0.005, 2000, backend='numpy')
+        expected = numpy.mod(free[0], 2*numpy.pi)
+        self.assertGreater(free[0,-1], 4*numpy.pi)
+        for backend in ('numpy', 'auto'):
+            _, xs = rk4(pfunc, 0.0, x0, 0.005, 2000, backend=backend,
+                        periodic_dims=(0,))
+            self.assertArrayEqual(numpy.sin(xs[0]), numpy.sin(expected),
+                                  places=8)
+            self.assertTrue(((xs[0] >= 0) & (xs[0] < 2*numpy.pi)).all())
+        chunks = list(rk4_chunks(pfunc, 0.0, x0, 0.005, 2000, chunk_size=300,
+                                 periodic_dims={0: 2*numpy.pi}))
+        self.assertArrayEqual(numpy.concatenate([c[1][0] for c in chunks]),
+                              xs[0], places=9)
+        _, xss = rk4_ensemble(pfunc, 0.0, [x0, -x0], 0.005, 2000,
+                              periodic_dims=(0,))
+        self.assertArrayEqual(xss[0,0], xs[0], places=9)
+        self.assertTrue((xss[:,0] < 2*numpy.pi).all())
+        traj = dopri5(pfunc, 0.0, x0, 10.0, 1e-10, dense=True,
+                      periodic_dims=(0,))
+        unwrapped = dopri5(pfunc, 0.0, x0, 10.0, 1e-10, dense=True)
+        self.assertTrue((traj.xs[0] < 2*numpy.pi).all())
+        tq = numpy.linspace(0.0, 10.0, 101)
+        self.assertArrayEqual(traj(tq)[0],
+                              numpy.mod(unwrapped(tq)[0], 2*numpy.pi),
+                              places=6)
+        # Wrapping must not look like a crossing to the event functions.
+        half = event(lambda t, x: x[0] - numpy.pi)
+        odd = event(lambda t, x: numpy.sin(x[0]), direction=-1)
+        for integrate in (lambda **kw: rk4(pfunc, 0.0, x0, 0.005, 2000, **kw),
+                          lambda **kw: ark4(pfunc, 0.0, x0, 10.0, 1e-8, **kw)):
+            _, _, [(t_half, x_half)] = integrate(events=[half],
+                                                 periodic_dims=(0,))
+            _, _, [(t_odd, _)] = integrate(events=[odd])
+            self.assertGreater(len(t_odd), 2)
+            self.assertArrayEqual(t_half, t_odd, places=8)
+            self.assertArrayEqual(x_half[0], numpy.repeat(numpy.pi,
+                                                          len(t_half)))
+
+    def test_rosenbrock(self):
+        '''
+        Tests the Rosenbrock integrator on a heavily damped pendulum, which is
+        stiff enough to hold dopri5 at its stability limit.
+
+        '''
+        import pendulum
+        df = pendulum.pendulum(0.1, 0.1, 100.0)
+        x0 = numpy.array([3.0, 0.0], dtype=numpy.float64)
+        _, ref = dopri5(df, 0.0, x0, 50.0, 1e-10)
+        explicit = Stats()
+        dopri5(df, 0.0, x0, 50.0, 1e-5, stats=explicit)
+        self.assertGreater(explicit.accepted, 10000)
+        for source in (df.jacobian, 'fd', 'dual'):
+            stats = Stats()
+            ts, xs = rosenbrock(df, 0.0, x0, 50.0, 1e-5, jacobian=source,
+                                stats=stats)
+            self.assertLess(stats.accepted, 200)
+            # A rejected step retries from the same point with the same J.
+            self.assertEqual(stats.njev, stats.accepted)
+            self.assertArrayEqual(xs[:,-1], ref[:,-1], places=3)
+
+        # A constant Jacobian is kept, and W along with it.
+        rates = numpy.array([-1000.0, -0.1], dtype=numpy.float64)
+        stats = Stats()
+        ts, xs = rosenbrock(lambda t, x: (rates*x.T).T, 0.0, numpy.ones(2),
+                            10.0, 1e-6, jac_every=10000, stats=stats)
+        self.assertEqual(stats.njev, 1)
+        self.assertLess(stats.nlu, stats.accepted)
+        self.assertArrayEqual(xs[:,-1], numpy.exp(10.0*rates), places=4)
+
+    def test_jacobians(self):
+        '''
+        Tests the Jacobians the system factories carry against dual numbers.
+
+        '''
+        import dual
+        import lorenz
+        import mechanics
+        x0 = numpy.linspace(-1.0, 2.0, 18)
+        for (df, x) in ((lorenz.lorenz(10.0, 28.0, 8/3), x0[:3]),
+                        (mechanics.threebody(1.0, 0.5, 0.3, 0.2), x0)):
+            self.assertArrayEqual(df.jacobian(0.0, x).ravel(),
+                                  dual.jacobian(df, 0.0, x).ravel(), places=10)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
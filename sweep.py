@@ -0,0 +1,366 @@
+###############################################################################
+#
+# CSCI 4446 - Chaotic Dynamics
+#
+# File: sweep.py
+# Author: Ken Sheedlo
+#
+# Parallel parameter sweeps over the system factories.
+#
+###############################################################################
+
+'''
+Parameter sweeps over the system factories.
+
+A sweep builds a system from a factory (lorenz.lorenz, rossler.rossler,
+pendulum.pendulum, ...) at every point of a parameter grid, integrates it, and
+reduces each trajectory to a fixed-width row of summary values. The points are
+spread over a pool of worker processes, which write their rows straight into a
+shared-memory result array, so no trajectory is ever pickled. The workers are
+forked with the sweep already set up, so the factory, integration and summary
+can be any callables, lambdas included.
+
+Progress can be saved to a checkpoint file, and a sweep started again with the
+same checkpoint only computes the points that weren't done.
+'''
+
+from __future__ import division
+
+import chaostest
+import getopt
+import hashlib
+import multiprocessing
+import numpy
+import os
+import poincare
+import shutil
+import sys
+import tempfile
+import time
+
+def grid(axes, **fixed):
+    '''
+    Cartesian product of parameter values.
+
+    Params:
+        axes    A list of (name, values) pairs. The last axis varies fastest.
+        fixed   Parameters held constant at every point.
+
+    Returns: a list of keyword argument dicts for the factory, one per point,
+             in row-major order, so that sweep results can be reshaped to
+             [len(values) for (_, values) in axes] + [width].
+    '''
+    points = [dict(fixed)]
+    for (name, values) in axes:
+        points = [dict(p, **{name: v}) for p in points for v in values]
+    return points
+
+def final_state(ts, xs):
+    '''
+    Summary holding the last state of the trajectory.
+
+    '''
+    return xs[:,-1]
+
+def extrema(t_start=None):
+    '''
+    Summary holding the minimum and then the maximum of every component,
+    ignoring samples before t_start.
+
+    '''
+    def _extrema(ts, xs):
+        if t_start is not None:
+            xs = xs[:, ts >= t_start]
+        return numpy.concatenate((xs.min(axis=1), xs.max(axis=1)))
+    return _extrema
+
+def section(count, interval=1.0, t_start=0.0):
+    '''
+    Summary holding the first count points of a stroboscopic section (see
+    poincare.linear), flattened, and padded with NaN if there are fewer.
+
+    '''
+    def _section(ts, xs):
+        ps = poincare.linear(ts, xs.T, interval=interval, t_start=t_start)
+        row = numpy.empty((count, xs.shape[0]), dtype=numpy.float64)
+        row.fill(numpy.nan)
+        row[:min(count, len(ps))] = ps[:count]
+        return row.ravel()
+    return _section
+
+# The sweep the worker processes run, set before they are forked.
+_JOB = None
+
+class _Job(object):
+    def __init__(self, factory, points, integrate, summary, shared, width):
+        self.factory = factory
+        self.points = points
+        self.integrate = integrate
+        self.summary = summary
+        self.shared = shared
+        self.width = width
+
+def _summarize(job, i):
+    '''
+    Integrates point i of job. Returns the summary row, or NaNs and the error
+    if the integration blew up.
+
+    '''
+    try:
+        ts, xs = job.integrate(job.factory(**job.points[i]))[:2]
+        return numpy.asarray(job.summary(ts, xs), dtype=numpy.float64), None
+    except (ArithmeticError, RuntimeError) as err:
+        row = numpy.empty(job.width, dtype=numpy.float64)
+        row.fill(numpy.nan)
+        return row, '{0}: {1}'.format(type(err).__name__, err)
+
+def _run_point(i):
+    '''
+    Worker body: computes point i and writes its row into shared memory.
+
+    '''
+    row, error = _summarize(_JOB, i)
+    results = numpy.frombuffer(_JOB.shared, dtype=numpy.float64)
+    results[i*_JOB.width:(i+1)*_JOB.width] = row
+    return i, error
+
+def _fingerprint(points, width):
+    '''
+    Identifies a sweep by its grid, so that a checkpoint isn't resumed into a
+    different one.
+
+    '''
+    digest = hashlib.md5()
+    for p in points:
+        digest.update(repr(sorted(p.items())))
+    digest.update(repr(width))
+    return digest.hexdigest()
+
+def _load_checkpoint(filename, points):
+    '''
+    Returns (results, done) from a checkpoint, or None if there is none.
+
+    '''
+    if filename is None or not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as fp:
+        saved = numpy.load(fp)
+        results, done = saved['results'], saved['done']
+        fingerprint = str(saved['fingerprint'])
+    if fingerprint != _fingerprint(points, results.shape[1]):
+        raise ValueError('checkpoint {0} belongs to a different sweep'.format(
+                            filename))
+    return results, done
+
+def _save_checkpoint(filename, results, done, points):
+    '''
+    Writes the checkpoint atomically, so an interruption mid-write can't
+    destroy the previous one.
+
+    '''
+    tmp = '{0}.tmp'.format(filename)
+    with open(tmp, 'wb') as fp:
+        numpy.savez(fp, results=results, done=done,
+                    fingerprint=_fingerprint(points, results.shape[1]))
+    os.rename(tmp, filename)
+
+def sweep(factory, points, integrate, summary=final_state, **kwargs):
+    '''
+    Runs a parameter sweep.
+
+    Params:
+        factory     A system factory, called as factory(**point).
+        points      The parameter points, e.g. from grid.
+        integrate   A callable integrate(dfunc) returning (ts, xs), such as
+                    lambda df: rungekutta.dopri5(df, 0.0, x0, 100.0, 1e-6).
+        summary     A callable summary(ts, xs) reducing a trajectory to a 1-D
+                    array, the same length for every point. See final_state,
+                    extrema and section.
+
+    Keyword arguments:
+        processes   Number of worker processes. Defaults to the number of
+                    CPUs. With 1, the sweep runs in this process.
+        checkpoint  File to save progress to. If it exists, the points it
+                    records as done are not computed again.
+        checkpoint_every
+                    Seconds between checkpoint saves (default 30).
+
+    Returns: a tuple (results, errors) where
+        results     An array (len(points) x width) of summary rows. Points
+                    whose integration raised an arithmetic or runtime error
+                    get a row of NaN.
+        errors      A dict from point index to the error message, for those.
+                    With no points, the results are empty (0 x 0).
+    '''
+    global _JOB
+    points = list(points)
+    if not points:
+        return numpy.empty((0, 0), dtype=numpy.float64), {}
+    processes = kwargs.get('processes') or multiprocessing.cpu_count()
+    filename = kwargs.get('checkpoint')
+    every = kwargs.get('checkpoint_every', 30.0)
+    errors = {}
+
+    saved = _load_checkpoint(filename, points)
+    if saved is not None:
+        prior, done = saved
+        width = prior.shape[1]
+    else:
+        # The first point fixes the width of the result array.
+        first = _Job(factory, points, integrate, summary, None, None)
+        row, error = _summarize(first, 0)
+        if error is not None:
+            raise RuntimeError('sweep: first point failed, {0}'.format(error))
+        width = len(row)
+        prior = numpy.empty((len(points), width), dtype=numpy.float64)
+        prior.fill(numpy.nan)
+        prior[0] = row
+        done = numpy.zeros(len(points), dtype=bool)
+        done[0] = True
+
+    shared = multiprocessing.RawArray('d', len(points)*width)
+    results = numpy.frombuffer(shared, dtype=numpy.float64).reshape(
+                                                        (len(points), width))
+    results[:] = prior
+    todo = [i for i in xrange(len(points)) if not done[i]]
+
+    _JOB = _Job(factory, points, integrate, summary, shared, width)
+    pool = multiprocessing.Pool(processes) if processes > 1 and todo else None
+    last_save = time.time()
+    try:
+        finished = (pool.imap_unordered(_run_point, todo) if pool is not None
+                    else (_run_point(i) for i in todo))
+        for (i, error) in finished:
+            done[i] = True
+            if error is not None:
+                errors[i] = error
+            if filename is not None and time.time() - last_save > every:
+                _save_checkpoint(filename, results, done, points)
+                last_save = time.time()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if filename is not None:
+            _save_checkpoint(filename, results, done, points)
+        _JOB = None
+
+    return results.copy(), errors
+
+def _decay(rate):
+    '''
+    Exponential decay system, for testing.
+
+    '''
+    return lambda t, x: -rate*x
+
+class TestSweep(chaostest.TestCase):
+    '''
+    Unit tests for parameter sweeps.
+
+    Running this module starts its main program, so run these with
+    python -m unittest sweep.
+    '''
+    def setUp(self):
+        import rungekutta
+        self.points = grid([('rate', numpy.linspace(0.0, 2.0, 9))])
+        self.integrate = lambda df: rungekutta.rk4(
+                            df, 0.0, numpy.array([1.0]), 0.01, 100)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_grid(self):
+        points = grid([('a', (1, 2)), ('b', (3, 4, 5))], c=6)
+        self.assertEqual(len(points), 6)
+        self.assertEqual(points[1], {'a': 1, 'b': 4, 'c': 6})
+
+    def test_sweep(self):
+        '''
+        Tests a pooled sweep against the exact solution.
+
+        '''
+        results, errors = sweep(_decay, self.points, self.integrate,
+                                processes=3)
+        self.assertEqual(results.shape, (9, 1))
+        self.assertEqual(errors, {})
+        self.assertArrayEqual(results[:,0],
+                              numpy.exp(-numpy.linspace(0.0, 2.0, 9)),
+                              places=8)
+        results, _ = sweep(_decay, self.points, self.integrate,
+                           extrema(t_start=0.5), processes=1)
+        self.assertEqual(results.shape, (9, 2))
+        self.assertAlmostEqual(results[4,1], numpy.exp(-0.5), places=8)
+        results, errors = sweep(_decay, [], self.integrate)
+        self.assertEqual((results.shape, errors), ((0, 0), {}))
+
+    def test_resume(self):
+        '''
+        Tests that a checkpoint is resumed rather than recomputed.
+
+        '''
+        filename = os.path.join(self.tmpdir, 'sweep.npz')
+        expected, _ = sweep(_decay, self.points, self.integrate, processes=2,
+                            checkpoint=filename)
+        # Fake an interrupted run: half the points are done, and those hold
+        # values no integration would produce.
+        with open(filename, 'rb') as fp:
+            saved = numpy.load(fp)
+            results, done = saved['results'].copy(), saved['done'].copy()
+        done[5:] = False
+        results[:5] = -1.0
+        _save_checkpoint(filename, results, done, self.points)
+        resumed, _ = sweep(_decay, self.points, self.integrate, processes=2,
+                           checkpoint=filename)
+        self.assertArrayEqual(resumed[:5,0], -numpy.ones(5))
+        self.assertArrayEqual(resumed[5:,0], expected[5:,0])
+        self.assertRaises(ValueError, sweep, _decay, self.points[:4],
+                          self.integrate, checkpoint=filename)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    import lorenz
+    import plot
+    import rungekutta
+
+    file_prefix = None
+    processes = None
+    checkpoint = None
+
+    try:
+        options, args = getopt.getopt(argv[1:], 'f:p:c:')
+        for opt, arg in options:
+            if opt == '-f':
+                file_prefix = arg
+            elif opt == '-p':
+                processes = int(arg)
+            elif opt == '-c':
+                checkpoint = arg
+    except getopt.GetoptError as err:
+        print str(err)
+        return 2
+
+    rs = numpy.linspace(20.0, 200.0, 181)
+    x0 = numpy.array([-13.0, -12.0, 52.0], dtype=numpy.float64)
+    results, errors = sweep(
+                lorenz.lorenz,
+                grid([('r', rs)], a=16.0, b=4.0),
+                lambda df: rungekutta.dopri5(df, 0.0, x0, 100.0, 1e-6),
+                extrema(t_start=50.0),
+                processes=processes,
+                checkpoint=checkpoint
+            )
+    plot.render(rs, results[:,5], 'b', rs, results[:,2], 'r',
+            xlabel='r',
+            ylabel='z',
+            title='Lorenz z Extrema vs. r (a=16, b=4)',
+            legend=('max z', 'min z'),
+            file_prefix=file_prefix
+        )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
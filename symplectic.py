@@ -0,0 +1,362 @@
+###############################################################################
+#
+# CSCI 4446 - Chaotic Dynamics
+#
+# File: symplectic.py
+# Author: Ken Sheedlo
+#
+# Symplectic integrators for the n-body systems in mechanics.
+#
+###############################################################################
+
+'''
+Symplectic integrators for separable Hamiltonian systems.
+
+These work on the state layout of mechanics.twobody, threebody and nbody,
+[r1, v1, r2, v2, ...] with 3-vectors, and use the derivative function only for
+the accelerations it returns. Unlike RK4 their energy error stays bounded
+instead of drifting, so long orbits can be run with much larger steps.
+'''
+
+from __future__ import division
+
+import chaostest
+import mechanics
+import numpy
+import rungekutta
+import unittest
+
+# Substep weights of the compositions, each substep being one leapfrog step of
+# weight*dt. The fourth order scheme is the triple jump of Forest & Ruth and
+# Yoshida, and the sixth order one is Yoshida's solution A.
+_CBRT2 = 2 ** (1/3)
+LEAPFROG_WEIGHTS = (1.0,)
+
+# How much longer in t than ds/U a step in the logarithmic Hamiltonian time
+# may turn out. Through the pericenter of a very eccentric orbit it can take
+# up to 40% longer.
+LOGH_MARGIN = 1.5
+FOREST_RUTH_WEIGHTS = (
+    1/(2 - _CBRT2),
+    -_CBRT2/(2 - _CBRT2),
+    1/(2 - _CBRT2),
+)
+_YOSHIDA6_W = (0.784513610477560, 0.235573213359357, -1.17767998417887)
+YOSHIDA6_WEIGHTS = _YOSHIDA6_W + (1 - 2*sum(_YOSHIDA6_W),) + _YOSHIDA6_W[::-1]
+
+def leapfrog(dfunc, t0, x0, dt, nsteps, **kwargs):
+    '''
+    Leapfrog (velocity Verlet) integrator, second order.
+
+    Params and keyword arguments are those of compose.
+    '''
+    return compose(dfunc, t0, x0, dt, nsteps, LEAPFROG_WEIGHTS, **kwargs)
+
+def forest_ruth(dfunc, t0, x0, dt, nsteps, **kwargs):
+    '''
+    Forest-Ruth (Yoshida triple jump) integrator, fourth order, three force
+    evaluations per step.
+
+    '''
+    return compose(dfunc, t0, x0, dt, nsteps, FOREST_RUTH_WEIGHTS, **kwargs)
+
+def yoshida6(dfunc, t0, x0, dt, nsteps, **kwargs):
+    '''
+    Yoshida's sixth order composition, seven force evaluations per step.
+
+    '''
+    return compose(dfunc, t0, x0, dt, nsteps, YOSHIDA6_WEIGHTS, **kwargs)
+
+def compose(dfunc, t0, x0, dt, nsteps, weights, **kwargs):
+    '''
+    Composition of leapfrog steps, the engine behind the integrators above.
+
+    Params:
+        dfunc   An n-body derivative function, e.g. from mechanics.twobody.
+                Only the acceleration entries of its result are used, so the
+                positions must not depend on the velocities.
+        t0      Initial t-value for the integrator.
+        x0      Initial state, 6 entries per body.
+        dt      Time step.
+        nsteps  Number of steps to run the integrator.
+        weights Substep sizes as fractions of dt, summing to one.
+
+    Keyword arguments:
+        f_args      Extra positional arguments for dfunc.
+        inplace     As for rungekutta.rk4.
+        conserved   If True, also return mechanics.conserved of every step.
+                    dfunc must carry gravity and masses, as the mechanics
+                    systems do.
+
+    Returns: (ts, xs) as rungekutta.rk4 does, or (ts, xs, quantities) if
+             conserved is set.
+    '''
+    nbodies = len(x0) // 6
+    if 6*nbodies != len(x0):
+        raise ValueError('state length must be a multiple of 6')
+    f_args = kwargs.get('f_args', tuple())
+    deriv = rungekutta._deriv(dfunc, kwargs, f_args)
+
+    ts = t0 + (numpy.array(range(nsteps+1), dtype=numpy.float64) * dt)
+    xs = numpy.empty((len(x0), nsteps+1), dtype=numpy.float64)
+    xs[:,0] = x0
+
+    lf = _Leapfrog(deriv, x0, nbodies)
+    lf.forces(t0)
+    for i in xrange(1, nsteps+1):
+        lf.step(ts[i-1], dt, weights)
+        xs[:,i] = lf.st
+
+    if kwargs.get('conserved', False):
+        return ts, xs, mechanics.conserved(dfunc, xs)
+    return ts, xs
+
+class _Leapfrog(object):
+    '''
+    The state and work buffers of a composition integrator, viewed by body.
+
+    '''
+    def __init__(self, deriv, x0, nbodies):
+        self.deriv = deriv
+        self.st = numpy.array(x0, dtype=numpy.float64)
+        bodies = mechanics._bodies(self.st, nbodies)
+        self.pos, self.vel = bodies[:,0], bodies[:,1]
+        self.buf = numpy.empty_like(self.st)
+        self.acc = mechanics._bodies(self.buf, nbodies)[:,1]
+        self.kick = numpy.empty_like(self.acc)
+        self.drift = numpy.empty_like(self.pos)
+
+    def forces(self, t):
+        self.deriv(t, self.st, self.buf)
+
+    def step(self, t, dt, weights):
+        '''
+        One composition step of kick-drift-kick substeps.
+
+        The acceleration at the end of each substep is the one at the start of
+        the next, so every substep costs a single force evaluation. The
+        accelerations must be current when the step starts.
+        '''
+        pos, vel, acc, kick, drift = (self.pos, self.vel, self.acc, self.kick,
+                                      self.drift)
+        for w in weights:
+            h = w*dt
+            vel += numpy.multiply(acc, h/2, out=kick)
+            pos += numpy.multiply(vel, h, out=drift)
+            t += h
+            self.forces(t)
+            vel += numpy.multiply(acc, h/2, out=kick)
+
+    def logh_step(self, t, ds, weights, potential, kinetic, binding):
+        '''
+        One composition step of drift-kick-drift substeps in the logarithmic
+        Hamiltonian time s, where dt = ds/U on the exact solution. A drift
+        takes dt = ds/(T + B) and a kick dt = ds/U, where U is minus the
+        potential energy, T the kinetic energy and B minus the total energy,
+        so both agree along the orbit.
+
+        Returns: the time at the end of the step.
+        '''
+        pos, vel, acc, kick, drift = (self.pos, self.vel, self.acc, self.kick,
+                                      self.drift)
+        for w in weights:
+            h = w*ds/2
+            dt = h / (kinetic(self.st) + binding)
+            pos += numpy.multiply(vel, dt, out=drift)
+            t += dt
+            self.forces(t)
+            vel += numpy.multiply(acc, 2*h/-potential(self.st), out=kick)
+            dt = h / (kinetic(self.st) + binding)
+            pos += numpy.multiply(vel, dt, out=drift)
+            t += dt
+        return t
+
+def adaptive(dfunc, t0, x0, t_final, eta=0.02, **kwargs):
+    '''
+    Composition integrator whose step follows the close encounters.
+
+    Every step is eta times mechanics.encounter_time of the state it starts
+    from, so steps are long while the bodies are far apart and shrink as a
+    pair closes in. Changing the step breaks the exact symplectic property,
+    but the energy error still stays small through an encounter instead of
+    jumping, as it does with a fixed step that is too long for it.
+
+    With regularize set, the steps are taken in the logarithmic Hamiltonian
+    time of Mikkola & Tanikawa and Preto & Tremaine instead. That leapfrog
+    follows a two-body orbit exactly apart from its timing, whatever the
+    eccentricity, so encounters can be arbitrarily close. The step in s is
+    fixed so that the first step is eta times the encounter time, and only
+    shortened where it would take longer than dt_max in t.
+
+    Params:
+        dfunc   A system from mechanics that carries gravity and masses.
+        t0      Initial t-value for the integrator.
+        x0      Initial state, 6 entries per body.
+        t_final Final t-value.
+        eta     Step size as a fraction of the encounter time.
+
+    Keyword arguments:
+        weights     Substep weights of the composition (default
+                    FOREST_RUTH_WEIGHTS).
+        regularize  Whether to step in the logarithmic Hamiltonian time.
+        dt_max      Upper bound on the step size in t, in both modes.
+        f_args, inplace, conserved
+                    As for compose.
+        out_file    As for rungekutta.dopri5.
+
+    Returns: a tuple (ts, xs) of the steps taken, as rungekutta.dopri5 does,
+             or (ts, xs, quantities) if conserved is set.
+    '''
+    nbodies = len(x0) // 6
+    if 6*nbodies != len(x0):
+        raise ValueError('state length must be a multiple of 6')
+    f_args = kwargs.get('f_args', tuple())
+    weights = kwargs.get('weights', FOREST_RUTH_WEIGHTS)
+    dt_max = kwargs.get('dt_max', abs(t_final - t0))
+    gravity, masses = dfunc.gravity, dfunc.masses
+    softening = getattr(dfunc, 'softening', 0.0)
+    lf = _Leapfrog(rungekutta._deriv(dfunc, kwargs, f_args), x0, nbodies)
+    out = rungekutta._sink(len(x0), kwargs)
+
+    t = t0
+    out.append(t, lf.st)
+    regularize = kwargs.get('regularize', False)
+    if regularize:
+        potential = lambda st: mechanics.potential(gravity, masses, st,
+                                                   softening)
+        kinetic = lambda st: mechanics.kinetic(masses, st)
+        binding = -(kinetic(lf.st) + potential(lf.st))
+        ds = -eta*mechanics.encounter_time(gravity, masses, lf.st) * \
+                potential(lf.st)
+        saved = numpy.empty_like(lf.st)
+
+    # Whether the accelerations belong to the current state, as the ordinary
+    # steps need.
+    current = False
+    while t < t_final:
+        if regularize:
+            # A step in s only takes about ds/U in t, so it is shortened to
+            # fit under dt_max with room to spare, and the last stretch
+            # before t_final is left to ordinary steps, which end exactly on
+            # it. A step that still turns out too long is undone and taken
+            # as an ordinary step.
+            u = -potential(lf.st)
+            step_ds = min(ds, dt_max*u/LOGH_MARGIN)
+            if t + LOGH_MARGIN*step_ds/u < t_final:
+                saved[:] = lf.st
+                t_next = lf.logh_step(t, step_ds, weights, potential, kinetic,
+                                      binding)
+                current = False
+                if t_next - t <= dt_max and t_next < t_final:
+                    t = t_next
+                    out.append(t, lf.st)
+                    continue
+                lf.st[:] = saved
+        if not current:
+            lf.forces(t)
+            current = True
+        dt = eta*mechanics.encounter_time(gravity, masses, lf.st)
+        dt = min(dt, dt_max, t_final - t)
+        if t + dt == t:
+            raise RuntimeError('adaptive: step size underflow at '
+                               't={0}'.format(t))
+        lf.step(t, dt, weights)
+        t = t + dt
+        out.append(t, lf.st)
+
+    ts, xs = out.arrays()
+    if kwargs.get('conserved', False):
+        return ts, xs, mechanics.conserved(dfunc, xs)
+    return ts, xs
+
+class TestSymplectic(chaostest.TestCase):
+    '''
+    Unit tests for the symplectic integrators.
+
+    '''
+    def setUp(self):
+        self.df = mechanics.twobody(1.0, 0.5, 0.5)
+        # Circular orbit of period 2*pi about the common center of mass.
+        self.x0 = numpy.array([
+                        -0.5, 0, 0,
+                        0, -0.5, 0,
+                        0.5, 0, 0,
+                        0, 0.5, 0
+                    ], dtype=numpy.float64)
+
+    def test_order(self):
+        '''
+        Tests the convergence order of each integrator over one orbit.
+
+        '''
+        for (integrator, order) in ((leapfrog, 2), (forest_ruth, 4),
+                                    (yoshida6, 6)):
+            errs = []
+            for nsteps in (100, 200):
+                ts, xs = integrator(self.df, 0.0, self.x0,
+                                    2*numpy.pi/nsteps, nsteps)
+                errs.append(numpy.abs(xs[:,-1] - self.x0).max())
+            self.assertAlmostEqual(numpy.log2(errs[0]/errs[1]), order, delta=0.3)
+
+    def test_energy(self):
+        '''
+        Tests that energy stays bounded where RK4 drifts.
+
+        '''
+        x0 = self.x0.copy()
+        # An eccentric orbit shows the drift within a few dozen periods.
+        x0[4], x0[10] = -0.3, 0.3
+        e0 = mechanics.energy(1.0, (0.5, 0.5), x0)
+        ts, xs, cons = leapfrog(self.df, 0.0, x0, 0.02, 20000, conserved=True)
+        self.assertEqual(cons['energy'].shape, (20001,))
+        self.assertEqual(cons['momentum'].shape, (3, 20001))
+        leap_err = numpy.abs(cons['energy'] - e0)
+        _, rk_xs = rungekutta.rk4(self.df, 0.0, x0, 0.02, 20000, backend='numpy')
+        rk_err = numpy.abs(mechanics.energy(1.0, (0.5, 0.5), rk_xs) - e0)
+        # Leapfrog oscillates: its late error is no worse than its early one.
+        self.assertLess(leap_err[10000:].max(), 1.5*leap_err[:10000].max())
+        self.assertGreater(rk_err[-1], 5*rk_err[2000])
+        spin = cons['angular_momentum'][2]
+        self.assertArrayEqual(spin, numpy.repeat(spin[0], len(ts)), places=10)
+
+    def test_adaptive(self):
+        '''
+        Tests the adaptive and regularized modes on a very eccentric orbit,
+        which a fixed step of the same count can't follow.
+
+        '''
+        # Relative orbit with a=1 and e=0.999, starting from apocenter.
+        ecc = 0.999
+        speed = numpy.sqrt((1 - ecc)/(1 + ecc))
+        x0 = numpy.array([
+                    -(1 + ecc)/2, 0, 0,
+                    0, -speed/2, 0,
+                    (1 + ecc)/2, 0, 0,
+                    0, speed/2, 0
+                ], dtype=numpy.float64)
+        e0 = mechanics.energy(1.0, (0.5, 0.5), x0)
+        t_final = 6*numpy.pi
+        for (regularize, places) in ((False, 3), (True, 8)):
+            ts, xs, cons = adaptive(self.df, 0.0, x0, t_final, 0.02,
+                                    regularize=regularize, conserved=True)
+            self.assertEqual(ts[-1], t_final)
+            self.assertLess(len(ts), 5000)
+            self.assertAlmostEqual(numpy.abs(cons['energy']/e0 - 1).max(),
+                                   0.0, places=places)
+            # Three whole periods bring the bodies back to the start.
+            self.assertArrayEqual(xs[:,-1], x0, places=places-2)
+        _, _, cons = forest_ruth(self.df, 0.0, x0, t_final/len(ts), len(ts),
+                                 conserved=True)
+        self.assertGreater(numpy.abs(cons['energy']/e0 - 1).max(), 0.1)
+
+        # Far from pericenter the steps in s would be longer than dt_max, so
+        # they are shortened, and the orbit is still followed as closely.
+        ts, xs, cons = adaptive(self.df, 0.0, x0, t_final, 0.02,
+                                regularize=True, dt_max=0.05, conserved=True)
+        self.assertEqual(ts[-1], t_final)
+        self.assertTrue((numpy.diff(ts) <= 0.05).all())
+        self.assertAlmostEqual(numpy.abs(cons['energy']/e0 - 1).max(), 0.0,
+                               places=8)
+
+if __name__ == "__main__":
+    unittest.main()
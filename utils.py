@@ -67,9 +67,37 @@ def ufunc(nin, nout, dtype=object):
         return bind_kwargs(uf, dtype=dtype)
     return _decorator
 
-def mod2pi(theta):
-    modulus = int(numpy.floor(theta / (2*numpy.pi)))
-    return theta - (modulus*2*numpy.pi)
+def mod2pi(theta, out=None):
+    '''
+    Wraps an angle, or every angle of an array at once, into [0, 2*pi).
+
+    '''
+    return numpy.mod(theta, 2*numpy.pi, out=out)
+
+def periodic_dims(spec):
+    '''
+    Normalizes a periodic_dims spec into a list of (index, period) pairs.
+
+    The spec is None, a sequence of component indices, which are angles with
+    period 2*pi, or a dict from component index to period.
+    '''
+    if spec is None:
+        return []
+    if isinstance(spec, dict):
+        return sorted(spec.items())
+    return [(i, 2*numpy.pi) for i in spec]
+
+def wrap(xs, spec):
+    '''
+    Wraps the periodic components of a state in place and returns it.
+
+    xs is a state, or an array whose first axis runs over the components,
+    such as a (dim x n) block or trajectory, and spec is as for periodic_dims.
+    '''
+    for (i, period) in periodic_dims(spec):
+        row = xs[i:i+1]
+        numpy.mod(row, period, out=row)
+    return xs
 
 def suffixed(s, suffix):
     return None if s is None else '{0}{1}'.format(s, suffix)
\ No newline at end of file